@@ -0,0 +1,80 @@
+import hashlib
+import sqlite3
+import threading
+import time
+
+_LEDGER_WINDOW_SECONDS = 24 * 60 * 60
+
+
+# Persistent record of Weather Underground API calls made with an API key, kept in a local SQLite file so it
+# survives between runs and can be shared by every tool using the same key. Calls are counted over a rolling
+# 24 hour window against the daily call limit.
+class ApiQuotaLedger:
+    _daily_call_limit: int
+    _key_hash: str
+    _ledger_file_name: str
+
+    def __init__(self, ledger_file_name: str, api_key: str, daily_call_limit: int):
+
+        self._ledger_file_name = ledger_file_name
+        self._daily_call_limit = daily_call_limit
+        self._lock = threading.Lock()
+
+        # The API key itself isn't stored, only enough to tell keys apart
+        self._key_hash = hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+        with self._connect() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS ApiCalls (KeyHash TEXT NOT NULL, CallTime REAL NOT NULL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS IX_ApiCalls_KeyTime ON ApiCalls (KeyHash, CallTime)")
+            connection.execute("DELETE FROM ApiCalls WHERE CallTime < ?",
+                               (time.time() - 2 * _LEDGER_WINDOW_SECONDS,))
+
+    # Number of calls made in the last 24 hours
+    def calls_in_window(self) -> int:
+
+        with self._connect() as connection:
+            return self._count_calls(connection)
+
+    # Number of calls that can still be made before the daily limit is reached
+    def remaining_calls(self) -> int:
+
+        return max(0, self._daily_call_limit - self.calls_in_window())
+
+    # Records a call if the daily limit allows it. Returns False, recording nothing, if the limit has been reached.
+    # The check and the record are made in one transaction so other threads and processes can't overspend.
+    def try_reserve_call(self) -> bool:
+
+        with self._lock, self._connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+
+            if self._count_calls(connection) >= self._daily_call_limit:
+                return False
+
+            connection.execute("INSERT INTO ApiCalls (KeyHash, CallTime) VALUES (?, ?)", (self._key_hash, time.time()))
+            return True
+
+    def _count_calls(self, connection) -> int:
+
+        return connection.execute("SELECT COUNT(*) FROM ApiCalls WHERE KeyHash = ? AND CallTime >= ?",
+                                  (self._key_hash, time.time() - _LEDGER_WINDOW_SECONDS)).fetchone()[0]
+
+    def _connect(self):
+
+        return _LedgerConnection(self._ledger_file_name)
+
+
+# Opens a connection to the ledger file for the duration of a with block, committing on success
+class _LedgerConnection:
+
+    def __init__(self, ledger_file_name: str):
+        self._connection = sqlite3.connect(ledger_file_name, timeout=30, isolation_level=None)
+
+    def __enter__(self):
+        return self._connection
+
+    def __exit__(self, exception_type, value, trace_back):
+        try:
+            if self._connection.in_transaction:
+                self._connection.execute("ROLLBACK" if exception_type else "COMMIT")
+        finally:
+            self._connection.close()
@@ -0,0 +1,188 @@
+import logging
+import random
+import threading
+import time
+from datetime import datetime
+from datetime import timezone
+from email.utils import parsedate_to_datetime
+from RunMetrics import RunMetrics
+
+# Responses worth trying again: WU throttling the API key, and its servers failing, overloaded or unavailable
+RETRYABLE_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+# The breaker's pause doubles each time its trial call fails, up to this many times the first pause
+_MAX_PAUSE_MULTIPLE = 8
+
+
+# Decides whether and when Weather Underground API calls that failed are made again. One instance is shared by every
+# thread making API calls, like the RateLimiter, so that they back off together.
+# A failed call is made up to max_attempts times in all. Before each retry it waits for the Retry-After the response
+# asked for or, if there wasn't one, a random time of up to base_delay_seconds doubled for each attempt, so that
+# workers don't all retry at once. A call isn't retried if it would have to wait more than max_delay_seconds, or
+# once retry_budget retries have been made in the run, so an outage can't spend the day's API calls on retries.
+# After breaker_threshold failures in a row the circuit breaker opens, pausing every call for breaker_pause_seconds
+# without calling the API. Then one trial call is let through. If it succeeds the breaker closes and calls resume.
+# If it fails the breaker opens again for twice as long. Once the retry budget is spent, calls made while the breaker
+# is open fail straight away instead of pausing.
+class ApiRetryPolicy:
+    _base_delay_seconds: float = 2
+    _breaker_pause_seconds: float = 60
+    _breaker_threshold: int = 5
+    _max_attempts: int = 4
+    _max_delay_seconds: float = 120
+    _metrics: RunMetrics
+    _retry_budget: int = 20
+
+    def __init__(self, max_attempts: int = 4, base_delay_seconds: float = 2, max_delay_seconds: float = 120,
+                 retry_budget: int = 20, breaker_threshold: int = 5, breaker_pause_seconds: float = 60,
+                 metrics: RunMetrics = None):
+
+        self._max_attempts = max(1, int(max_attempts))
+        self._base_delay_seconds = max(0.0, float(base_delay_seconds))
+        self._max_delay_seconds = max(0.0, float(max_delay_seconds))
+        self._retry_budget = max(0, int(retry_budget))
+        self._breaker_threshold = max(1, int(breaker_threshold))
+        self._breaker_pause_seconds = max(0.0, float(breaker_pause_seconds))
+        self._metrics = metrics if metrics is not None else RunMetrics()
+        self._condition = threading.Condition()
+        self._retries_made = 0
+        self._failures_in_row = 0
+        self._pause_seconds = self._breaker_pause_seconds
+        self._open_until = None
+        self._trial_thread = None
+
+    # Retries that can still be made in this run
+    @property
+    def remaining_retries(self) -> int:
+
+        with self._condition:
+            return max(0, self._retry_budget - self._retries_made)
+
+    # Gives a new run its full retry budget
+    def reset_budget(self):
+
+        with self._condition:
+            self._retries_made = 0
+
+    # Blocks while the circuit breaker is open. Returns True once the call can be made, counting it against the
+    # retry budget if it's a retry, or False if it should fail without calling the API as the retry budget is spent.
+    # Once the pause is over, the first call through is the trial call and the others wait for its outcome.
+    def before_call(self, retry: bool = False) -> bool:
+
+        _paused_at = None
+
+        try:
+
+            with self._condition:
+
+                while self._open_until is not None:
+
+                    if self._retries_made >= self._retry_budget:
+                        return False
+
+                    _now = time.monotonic()
+
+                    if _now >= self._open_until and self._trial_thread is None:
+                        self._trial_thread = threading.get_ident()
+                        break
+
+                    _paused_at = _paused_at or time.perf_counter()
+                    self._condition.wait(max(0.0, self._open_until - _now) or None)
+
+                if retry:
+                    if self._retries_made >= self._retry_budget:
+                        return False
+                    self._retries_made += 1
+
+                return True
+
+        finally:
+
+            if _paused_at is not None:
+                self._metrics.observe("circuit_breaker_pause", time.perf_counter() - _paused_at)
+
+    # Records that the API answered, even if with an error that isn't worth retrying, closing the breaker if open
+    def record_success(self):
+
+        with self._condition:
+            self._failures_in_row = 0
+
+            if self._open_until is not None:
+                self._open_until = None
+                self._trial_thread = None
+                self._pause_seconds = self._breaker_pause_seconds
+                self._condition.notify_all()
+                logging.info("Weather Underground API calls resumed")
+
+    # Records a call that was let through but not made, so that it doesn't hold up other calls if it was the trial
+    def abandon_call(self):
+
+        with self._condition:
+
+            if self._trial_thread == threading.get_ident():
+                self._trial_thread = None
+                self._condition.notify_all()
+
+    # Records a failed call, opening the breaker if it's the breaker_threshold-th failure in a row or a failed trial
+    # call. retry_after is the seconds the response asked to wait, if any. Returns the seconds to wait before making
+    # the call again, or None if it shouldn't be retried.
+    def record_failure(self, attempt: int, retry_after: float = None):
+
+        with self._condition:
+            self._failures_in_row += 1
+
+            if self._trial_thread == threading.get_ident():
+                self._pause_seconds = min(self._pause_seconds * 2,
+                                          self._breaker_pause_seconds * _MAX_PAUSE_MULTIPLE)
+                self._open_breaker(retry_after)
+
+            elif self._open_until is None and self._failures_in_row >= self._breaker_threshold:
+                self._open_breaker(retry_after)
+
+            if attempt >= self._max_attempts or self._retries_made >= self._retry_budget:
+                return None
+
+            if retry_after is not None:
+                if retry_after > self._max_delay_seconds:
+                    return None
+                # A little jitter on top so that workers asked to wait the same time don't retry together
+                _delay = retry_after + random.uniform(0, self._base_delay_seconds)
+            else:
+                _delay = random.uniform(0, min(self._max_delay_seconds,
+                                               self._base_delay_seconds * 2 ** (attempt - 1)))
+
+            return _delay
+
+    # Called holding the lock
+    def _open_breaker(self, retry_after: float):
+
+        _pause_seconds = max(self._pause_seconds, retry_after or 0)
+        self._open_until = time.monotonic() + _pause_seconds
+        self._trial_thread = None
+        self._condition.notify_all()
+        self._metrics.increment("circuit_breaker_opens")
+        logging.warning(f"Weather Underground API calls paused for {_pause_seconds:.0f}s after "
+                        f"{self._failures_in_row} failures in a row")
+
+
+# Seconds to wait given by a Retry-After header, which is either a number of seconds or an HTTP date, or None if
+# there's no usable value
+def parse_retry_after(value: str):
+
+    if not value:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        _retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+
+    if _retry_at.tzinfo is None:
+        _retry_at = _retry_at.replace(tzinfo=timezone.utc)
+
+    return max(0.0, (_retry_at - datetime.now(timezone.utc)).total_seconds())
@@ -7,6 +7,7 @@ USE weathermanagertest;
 /* Add tables */
 CREATE TABLE Observations(
 	ObservationId INT PRIMARY KEY IDENTITY(1,1),
+	StationId VARCHAR(20) NOT NULL DEFAULT '', -- Weather Underground station the observation came from
 	ObservationTime DATETIME NOT NULL,
 	SolarRadiationHigh DECIMAL(5,1) NOT NULL CHECK(SolarRadiationHigh >= 0),
 	UvHigh DECIMAL(4,1) NOT NULL CHECK(UvHigh >= 0),
@@ -36,16 +37,176 @@ CREATE TABLE Observations(
 	PressureLow DECIMAL(6,2) NOT NULL CHECK(PressureLow >= 0),
 	PressureTrend DECIMAL(4,2),
 	PrecipitationRate DECIMAL(5,2) NOT NULL CHECK(PrecipitationRate >= 0),
-	PrecipitationTotal DECIMAL(5,2) NOT NULL CHECK(PrecipitationTotal >= 0)
+	PrecipitationTotal DECIMAL(5,2) NOT NULL CHECK(PrecipitationTotal >= 0),
+	CONSTRAINT UQ_Observations_StationTime UNIQUE (StationId, ObservationTime) -- One observation per station per hour
 )
 
 CREATE TABLE Extremes (
 	extremeId INT PRIMARY KEY IDENTITY(1,1),
+	StationId VARCHAR(20) NOT NULL DEFAULT '', -- Weather Underground station
 	Name VARCHAR(50) NOT NULL, -- Description of extreme
 	Date DATETIME NOT NULL, -- Date on which the extreme occurred
 	Rank TINYINT NOT NULL DEFAULT 0 CHECK(Rank >= 0), -- 1 = 1st etc
 	HighInt INT NOT NULL DEFAULT 0 CHECK(HighInt >= 0), -- Highest integer of the extreme
 	LowInt INT NOT NULL DEFAULT 0 CHECK(LowInt >= 0), -- Lowest integer of the extreme
-	HighFloat FLOAT NOT NULL DEFAULT 0 CHECK(HighFloat >= 0), -- Highest float of the extreme
-	LowFloat FLOAT NOT NULL DEFAULT 0 CHECK(LowFloat >= 0) -- Lowest float of the extreme
-)
\ No newline at end of file
+	HighFloat FLOAT NOT NULL DEFAULT 0, -- Highest float of the extreme
+	LowFloat FLOAT NOT NULL DEFAULT 0, -- Lowest float of the extreme, e.g. sub-zero temperatures
+	INDEX IX_Extremes_StationName (StationId, Name)
+)
+
+CREATE TABLE DownloadAttempts (
+	StationId VARCHAR(20) NOT NULL, -- Weather Underground station
+	ObservationDate DATE NOT NULL, -- Day that was downloaded with fewer than 24 observations
+	Attempts INT NOT NULL DEFAULT 0 CHECK(Attempts >= 0), -- Number of times the day has been downloaded
+	ObservationCount TINYINT NOT NULL DEFAULT 0 CHECK(ObservationCount >= 0), -- Observations returned last time
+	LastAttempt DATETIME NOT NULL, -- When the day was last downloaded
+	PRIMARY KEY (StationId, ObservationDate)
+)
+
+CREATE TABLE DailySummaries (
+	StationId VARCHAR(20) NOT NULL, -- Weather Underground station
+	SummaryDate DATE NOT NULL,
+	ObservationCount INT NOT NULL CHECK(ObservationCount >= 0), -- Hourly observations summarised
+	TemperatureHigh FLOAT,
+	TemperatureLow FLOAT,
+	TemperatureMean FLOAT, -- Means are weighted by the number of observations
+	DewPointHigh FLOAT,
+	DewPointLow FLOAT,
+	DewPointMean FLOAT,
+	HumidityHigh FLOAT,
+	HumidityLow FLOAT,
+	HumidityMean FLOAT,
+	PressureHigh FLOAT,
+	PressureLow FLOAT,
+	WindSpeedHigh FLOAT,
+	WindSpeedMean FLOAT,
+	WindGustHigh FLOAT,
+	SolarRadiationHigh FLOAT,
+	UvHigh FLOAT,
+	PrecipitationRateHigh FLOAT,
+	PrecipitationTotal FLOAT,
+	PRIMARY KEY (StationId, SummaryDate)
+)
+
+CREATE TABLE MonthlySummaries (
+	StationId VARCHAR(20) NOT NULL,
+	SummaryYear SMALLINT NOT NULL,
+	SummaryMonth SMALLINT NOT NULL,
+	DayCount SMALLINT NOT NULL CHECK(DayCount >= 0), -- Days with observations in the month
+	ObservationCount INT NOT NULL CHECK(ObservationCount >= 0), -- Hourly observations summarised
+	TemperatureHigh FLOAT,
+	TemperatureLow FLOAT,
+	TemperatureMean FLOAT, -- Means are weighted by the number of observations
+	DewPointHigh FLOAT,
+	DewPointLow FLOAT,
+	DewPointMean FLOAT,
+	HumidityHigh FLOAT,
+	HumidityLow FLOAT,
+	HumidityMean FLOAT,
+	PressureHigh FLOAT,
+	PressureLow FLOAT,
+	WindSpeedHigh FLOAT,
+	WindSpeedMean FLOAT,
+	WindGustHigh FLOAT,
+	SolarRadiationHigh FLOAT,
+	UvHigh FLOAT,
+	PrecipitationRateHigh FLOAT,
+	PrecipitationTotal FLOAT,
+	PRIMARY KEY (StationId, SummaryYear, SummaryMonth)
+)
+
+CREATE TABLE YearlySummaries (
+	StationId VARCHAR(20) NOT NULL,
+	SummaryYear SMALLINT NOT NULL,
+	DayCount SMALLINT NOT NULL CHECK(DayCount >= 0), -- Days with observations in the year
+	ObservationCount INT NOT NULL CHECK(ObservationCount >= 0), -- Hourly observations summarised
+	TemperatureHigh FLOAT,
+	TemperatureLow FLOAT,
+	TemperatureMean FLOAT, -- Means are weighted by the number of observations
+	DewPointHigh FLOAT,
+	DewPointLow FLOAT,
+	DewPointMean FLOAT,
+	HumidityHigh FLOAT,
+	HumidityLow FLOAT,
+	HumidityMean FLOAT,
+	PressureHigh FLOAT,
+	PressureLow FLOAT,
+	WindSpeedHigh FLOAT,
+	WindSpeedMean FLOAT,
+	WindGustHigh FLOAT,
+	SolarRadiationHigh FLOAT,
+	UvHigh FLOAT,
+	PrecipitationRateHigh FLOAT,
+	PrecipitationTotal FLOAT,
+	PRIMARY KEY (StationId, SummaryYear)
+
+)
+
+CREATE TABLE QuarantinedObservations (
+	QuarantineId INT AUTO_INCREMENT PRIMARY KEY,
+	StationId VARCHAR(20) NOT NULL, -- Weather Underground station
+	ObservationTime DATETIME NOT NULL,
+	Reason VARCHAR(500) NOT NULL, -- Why the observation failed validation
+	ObservationValues TEXT NOT NULL, -- The observation's columns as JSON
+	QuarantinedAt DATETIME NOT NULL,
+	INDEX IX_QuarantinedObservations_StationTime (StationId, ObservationTime)
+)
+
+CREATE TABLE BackfillShards (
+	ShardId INT AUTO_INCREMENT PRIMARY KEY,
+	StationId VARCHAR(20) NOT NULL, -- Weather Underground station
+	FirstDate DATE NOT NULL, -- First and last days of the shard
+	LastDate DATE NOT NULL,
+	Status VARCHAR(10) NOT NULL DEFAULT 'pending' CHECK(Status IN ('pending', 'claimed', 'done', 'failed')),
+	Attempts INT NOT NULL DEFAULT 0 CHECK(Attempts >= 0), -- Number of times the shard has been claimed
+	LeaseOwner VARCHAR(100), -- Worker holding the lease, as host:process:thread
+	LeaseExpires DATETIME, -- UTC. A shard can't be claimed again until its lease has expired
+	DaysSaved INT NOT NULL DEFAULT 0 CHECK(DaysSaved >= 0), -- Days saved by the worker that completed the shard
+	LastError VARCHAR(500), -- Why the shard last failed
+	CompletedAt DATETIME, -- UTC
+	CONSTRAINT UQ_BackfillShards_StationFirstDate UNIQUE (StationId, FirstDate),
+	INDEX IX_BackfillShards_Status (Status, LeaseExpires)
+)
+
+CREATE TABLE SchemaMigrations (
+	Version INT PRIMARY KEY, -- Applied by WMDownloader in version order, each exactly once
+	Description VARCHAR(200) NOT NULL,
+	StartedAt DATETIME NOT NULL,
+	CompletedAt DATETIME, -- Null while the migration is being applied
+	DurationSeconds FLOAT
+)
+
+CREATE TABLE ArchivedObservations( -- Observations older than ArchiveAfterDays, moved here by WMDownloader
+	StationId VARCHAR(20) NOT NULL,
+	ObservationTime DATETIME NOT NULL,
+	SolarRadiationHigh DECIMAL(5,1) NOT NULL CHECK(SolarRadiationHigh >= 0),
+	UvHigh DECIMAL(4,1) NOT NULL CHECK(UvHigh >= 0),
+	WindDirectionMean DECIMAL(3) NOT NULL CHECK(WindDirectionMean >= 0),
+	HumidityHigh TINYINT NOT NULL CHECK(HumidityHigh >= 0),
+	HumidityLow TINYINT NOT NULL CHECK(HumidityLow>=0),
+	HumidityMean DECIMAL(4,1) NOT NULL CHECK(HumidityMean>= 0),
+	TemperatureHigh DECIMAL(3,1) NOT NULL,
+	TemperatureLow DECIMAL(3,1) NOT NULL,
+	TemperatureMean DECIMAL(3,1) NOT NULL,
+	WindSpeedHigh DECIMAL(4,1) NOT NULL,
+	WindSpeedLow DECIMAL(4,1) NOT NULL,
+	WindSpeedMean DECIMAL(4,1) NOT NULL,
+	WindGustHigh DECIMAL(4,1) NOT NULL,
+	WindGustLow DECIMAL(4,1) NOT NULL,
+	WindGustMean DECIMAL(4,1) NOT NULL,
+	DewPointHigh DECIMAL(3,1) NOT NULL,
+	DewPointLow DECIMAL(3,1) NOT NULL,
+	DewPointMean DECIMAL(3,1) NOT NULL,
+	WindChillHigh DECIMAL(3,1) NOT NULL,
+	WindChillLow DECIMAL(3,1) NOT NULL,
+	WindChillMean DECIMAL(3,1) NOT NULL,
+	HeatIndexHigh DECIMAL(3,1) NOT NULL,
+	HeatIndexLow DECIMAL(3,1) NOT NULL,
+	HeatIndexMean DECIMAL(3,1) NOT NULL,
+	PressureHigh DECIMAL(6,2) NOT NULL CHECK(PressureHigh >= 0),
+	PressureLow DECIMAL(6,2) NOT NULL CHECK(PressureLow >= 0),
+	PressureTrend DECIMAL(4,2),
+	PrecipitationRate DECIMAL(5,2) NOT NULL CHECK(PrecipitationRate >= 0),
+	PrecipitationTotal DECIMAL(5,2) NOT NULL CHECK(PrecipitationTotal >= 0),
+	PRIMARY KEY (StationId, ObservationTime)
+) ROW_FORMAT=COMPRESSED
\ No newline at end of file
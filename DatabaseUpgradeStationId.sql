@@ -0,0 +1,6 @@
+/* Upgrades a Weather Manager database built before observations were keyed on station and time. */
+/* Run this script, then run WMDeduplicate.py to remove duplicate observations and add the unique key. */
+
+USE weathermanager;
+
+ALTER TABLE Observations ADD COLUMN StationId VARCHAR(20) NOT NULL DEFAULT '' AFTER ObservationId;
@@ -2,9 +2,37 @@ import abc
 
 
 class IWMDatabaseService(abc.ABC):
+    def save_list_of_observations(self, observations, station_id=None, update_summaries=True, check_daily_counts=True):
+        pass
+
+    @abc.abstractmethod
+    def save_recent_observations(self, observations, station_id=None, update_summaries=True):
+        pass
+
+    @abc.abstractmethod
+    def get_incomplete_observation_dates(self, start_date, end_date, max_download_attempts, station_id=None):
+        pass
+
+    @abc.abstractmethod
+    def record_download_attempt(self, observation_date, observation_count, station_id=None):
+        pass
+
     @abc.abstractmethod
-    def get_most_recent_observation_date(self, default_observation_date):
+    def export_observations(self):
         pass
 
-    def save_list_of_observations(self, observations):
+    @abc.abstractmethod
+    def archive_observations(self):
+        pass
+
+    @abc.abstractmethod
+    def update_summaries_and_extremes(self, station_id, dates_written):
+        pass
+
+    @abc.abstractmethod
+    def get_observations(self, station_id, start_time, end_time, columns=None, bucket="hour"):
+        pass
+
+    @abc.abstractmethod
+    def get_observation_arrays(self, station_id, start_time, end_time, columns=None, bucket="hour"):
         pass
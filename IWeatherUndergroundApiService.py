@@ -3,7 +3,7 @@ import abc
 
 class IWeatherUndergroundApiService(abc.ABC):
     @abc.abstractmethod
-    def get_hourly_observations_for_date(self, date):
+    def get_hourly_observations_for_date(self, date, station_id=None):
         pass
 
     @abc.abstractmethod
@@ -13,3 +13,15 @@ class IWeatherUndergroundApiService(abc.ABC):
     @abc.abstractmethod
     def stop_wu_api_session(self):
         pass
+
+    @abc.abstractmethod
+    def get_remaining_api_calls(self):
+        pass
+
+    @abc.abstractmethod
+    def get_remaining_retries(self):
+        pass
+
+    @abc.abstractmethod
+    def reset_retry_budget(self):
+        pass
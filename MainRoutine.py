@@ -5,32 +5,72 @@ from IDateTimeProvider import IDateTimeProvider
 from IWMDatabaseService import IWMDatabaseService
 from IWMErrorService import IWMErrorService
 from IWeatherUndergroundApiService import IWeatherUndergroundApiService
+import atexit
 import logging
+import logging.handlers
+import os
+import queue
+import socket
+import threading
+import time
+from RunMetrics import RunMetrics
+from WMBackfillService import WMBackfillService
 from WuApiException import WuApiException
+from WuApiUnavailableException import WuApiUnavailableException
+from collections import deque
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
 from datetime import datetime
 from datetime import timedelta
 from os.path import exists
 
 
-def _configure_logging(log_file_full_name: str):
+# Log records are handed to a queue and written to the log file by a background listener thread,
+# so that logging never waits on file I/O. The listener is stopped, writing any records left, at exit.
+# Called by the launcher before anything is logged, and by MainRoutine for when it is run some other way.
+def configure_logging(log_file_full_name: str):
+
+    # As with logging.basicConfig, logging that has already been configured is left alone
+    if logging.getLogger().handlers:
+        return
+
     _log_format = "%(asctime)s - %(levelname)s - %(message)s"
+    _log_queue = queue.SimpleQueue()
+    _queue_handler = logging.handlers.QueueHandler(_log_queue)
 
     if exists(log_file_full_name):
-        logging.basicConfig(filename=log_file_full_name, format=_log_format, level=logging.INFO)
+        _file_handler = logging.FileHandler(log_file_full_name)
+        logging.basicConfig(handlers=[_queue_handler], format=_log_format, level=logging.INFO)
     else:
-        logging.basicConfig(filename="WMDownloader.log", format=_log_format)
+        _file_handler = logging.FileHandler("WMDownloader.log")
+        logging.basicConfig(handlers=[_queue_handler], format=_log_format)
         logging.warning(f"Couldn't find the supplied log file {log_file_full_name}")
 
+    _listener = logging.handlers.QueueListener(_log_queue, _file_handler)
+    _listener.start()
+    atexit.register(_listener.stop)
+
 
 class MainRoutine:
+    _api_call_reserve: int = 0
     _api_throttling_limit: str
+    _checkpoint_days: int = 1
+    _daemon_mode: bool = False
     _database_service: IWMDatabaseService
     _date_time_provider: IDateTimeProvider
+    _fetch_workers: int = 1
     _initial_observation_date = None
+    _max_download_attempts: int = 3
+    _metrics: RunMetrics = None
+    _replay_from_cache: bool = False
+    _station_initial_observation_dates: dict
     _wm_error_service: IWMErrorService
     _wu_api_service: IWeatherUndergroundApiService
 
+    # station_initial_observation_dates maps each station to be downloaded to its initial observation date, where
+    # None means the initial_observation_date is used. If it isn't given, only the services' default station is
+    # downloaded.
     def __init__(self,
                  wm_database_service: IWMDatabaseService,
                  date_time_provider: IDateTimeProvider,
@@ -38,10 +78,17 @@ class MainRoutine:
                  wm_error_service: IWMErrorService,
                  api_throttling_limit: str,
                  initial_observation_date: str,
-                 log_file_full_name: str):
+                 log_file_full_name: str,
+                 fetch_workers: int = 1,
+                 checkpoint_days: int = 1,
+                 max_download_attempts: int = 3,
+                 replay_from_cache: bool = False,
+                 api_call_reserve: int = 0,
+                 station_initial_observation_dates: dict = None,
+                 metrics: RunMetrics = None):
 
         # Setup logging
-        _configure_logging(log_file_full_name)
+        configure_logging(log_file_full_name)
 
         # Store the injected services and parameters
         self._database_service = wm_database_service
@@ -50,98 +97,657 @@ class MainRoutine:
         self._wm_error_service = wm_error_service
         self._api_throttling_limit = api_throttling_limit
         self._initial_observation_date = initial_observation_date
-
-    # The controlling method that is called to drive the download of recent observations
+        self._fetch_workers = max(1, int(fetch_workers))
+        self._checkpoint_days = max(1, int(checkpoint_days))
+        self._max_download_attempts = max(1, int(max_download_attempts))
+        self._replay_from_cache = replay_from_cache
+        self._api_call_reserve = max(0, int(api_call_reserve))
+        self._station_initial_observation_dates = station_initial_observation_dates or {None: None}
+        self._metrics = metrics if metrics is not None else RunMetrics()
+
+    # The controlling method that is called to drive the download of recent observations for every station.
+    # The database is checked first so that a run with nothing to download exits without contacting
+    # Weather Underground at all, or archiving, which the run that last downloaded observations will have done.
+    # All stations share one Weather Underground session.
+    # When replaying from the response cache no API calls are made, so there's no check on today's
+    # observations and no throttling.
     def download_recent_observations(self) -> None:
 
-        self._not_currently_gathering_data_warner()
+        _start_time = time.perf_counter()
+        _dates_required_by_station = self._get_dates_required_by_station()
 
-        if self._initial_observation_date is None:
-            raise ValueError("Initial observation date is not configured")
+        if not any(_dates_required_by_station.values()):
+            self._wm_error_service.handle_error("Observations are already up to date", "Info")
+            self._publish_metrics(_start_time)
+            self._wm_error_service.finalise_error_handling()
+            return
 
-        _initial_observation_date = datetime.strptime(self._initial_observation_date, '%Y-%m-%d').date()
-        _most_recent_observation_date: date = \
-            self._database_service.get_most_recent_observation_date(_initial_observation_date)
+        self._wu_service.start_wu_api_session()
 
-        # We only get observations from up to TWO days ago, not up to yesterday. This is because the Weather
-        # Underground API is sometimes slow in providing the full set of observations for yesterday.
-        _fetch_up_to_date = self._apply_api_throttling_limit(self._date_time_provider.now() -
-                                                             timedelta(days=2),
-                                                             _most_recent_observation_date)
+        self._download_outstanding_days(_dates_required_by_station, check_today=True)
 
-        _retrieved_observations = self._retrieve_recent_observations(_most_recent_observation_date,
-                                                                     _fetch_up_to_date)
+        self._wu_service.stop_wu_api_session()
 
-        self._database_service.save_list_of_observations(_retrieved_observations)
+        self._database_service.export_observations()
+
+        self._database_service.archive_observations()
+
+        self._publish_metrics(_start_time)
 
         self._wm_error_service.finalise_error_handling()
 
-    # To avoid tripping the Weather Underground API throttling limit, this will restrict the number of
-    # recent observations downloaded to the value set in the config file. Outstanding observations will
-    # get downloaded on subsequent days.
-    def _apply_api_throttling_limit(self, yesterdays_date: date, most_recent_observation_date: date):
+    # Runs as a resident daemon until stop_event is set, keeping the Weather Underground session and database
+    # connections open between polls. Every poll, hourly observations for today and yesterday that are newer
+    # than those already saved are inserted. Once a day, when the date rolls over, missing days are filled in
+    # as in a normal run and the day that has just settled is downloaded again to revise it in place. The metrics
+    # are published then too, covering that run and the polls since the last one, and are then reset.
+    # Failed polls are logged and retried at the next poll rather than ending the daemon.
+    def run_daemon(self, poll_interval_seconds: float, stop_event: threading.Event) -> None:
+
+        self._daemon_mode = True
+        self._wm_error_service.handle_error(f"Daemon started, polling every {poll_interval_seconds:.0f}s", "Info")
+
+        _latest_observation_times = {}
+        _dates_polled = {}
+        _rolled_over_on = None
+
+        self._wu_service.start_wu_api_session()
+
+        try:
+
+            while not stop_event.is_set():
+
+                try:
+
+                    _today = self._date_time_provider.now()
+
+                    if _rolled_over_on != _today:
+                        _start_time = time.perf_counter()
+                        self._wu_service.reset_retry_budget()
+                        self._summarise_polled_days(_dates_polled)
+                        _downloaded_dates_by_station = \
+                            self._download_outstanding_days(self._get_dates_required_by_station(), check_today=False,
+                                                            stop_event=stop_event)
+
+                        if stop_event.is_set():
+                            break
+
+                        self._revise_settled_day(_today - timedelta(days=2), _downloaded_dates_by_station)
+                        self._database_service.export_observations()
+                        self._database_service.archive_observations()
+                        self._publish_metrics(_start_time)
+                        self._metrics.reset()
+                        self._wm_error_service.finalise_error_handling()
+                        _rolled_over_on = _today
+
+                    self._download_latest_observations(_today, _latest_observation_times, _dates_polled)
+
+                except (WuApiException, OSError) as ex:
 
-        _api_throttle_limit: timedelta = timedelta(days=float(self._api_throttling_limit))
+                    self._wm_error_service.handle_error(f"Daemon poll failed, will retry at the next poll: {ex}",
+                                                        "Error", exc_info=ex)
 
-        if yesterdays_date - most_recent_observation_date > _api_throttle_limit:
-            _throttled_date = most_recent_observation_date + _api_throttle_limit
-            self._wm_error_service.handle_error(f"Downloading throttled to avoid Weather Underground API throttling. "
-                                                f"Only observations up until {_throttled_date} will be downloaded. "
-                                                f"Later observations will be downloaded on later runs",
+                stop_event.wait(poll_interval_seconds)
+
+        finally:
+
+            self._wu_service.stop_wu_api_session()
+            self._summarise_polled_days(_dates_polled)
+            self._database_service.export_observations()
+            self._wm_error_service.handle_error("Daemon stopped", "Info")
+            self._wm_error_service.finalise_error_handling()
+
+    # Backfills the history of every station from first_date to last_date, recording it as shards of shard_days
+    # in the database and working through them with backfill_workers threads, each downloading one shard at a
+    # time. Other processes and hosts running the same backfill share out the shards between them, so a long
+    # history can be spread across several API keys. Days already saved are skipped, so a backfill that was
+    # stopped or crashed resumes where it left off when run again, and shards that failed are retried.
+    # The API quota and rate limits are still respected but ApiThrottlingLimit isn't applied.
+    # Progress is reported every progress_interval_seconds until every shard is done, there are no API calls
+    # left or stop_event is set. Returns the final progress of the backfill.
+    def run_backfill(self, backfill_service: WMBackfillService, first_date: date, last_date: date,
+                     shard_days: int, backfill_workers: int, progress_interval_seconds: float,
+                     stop_event: threading.Event) -> dict:
+
+        if None in self._station_initial_observation_dates:
+            raise ValueError("Backfilling requires the stations to be given")
+
+        _start_time = time.perf_counter()
+        _station_ids = list(self._station_initial_observation_dates)
+
+        for station_id in _station_ids:
+            _shards_added = backfill_service.create_shards(station_id, first_date, last_date, shard_days)
+            self._wm_error_service.handle_error(f"{self._station_name(station_id)}Backfilling {first_date} to "
+                                                f"{last_date}, {_shards_added} new shards of {shard_days} days",
                                                 "Info")
-            return _throttled_date
 
+        _days_done_at_start = backfill_service.get_progress(_station_ids)["done"]["days"]
+        _leases = {}
+        _lost_leases = set()
+        _leases_lock = threading.Lock()
+        _summaries_lock = threading.Lock()
+        _workers_running = max(1, int(backfill_workers))
+        _workers_finished = threading.Event()
+
+        def _backfill_worker(worker_number: int):
+
+            nonlocal _workers_running
+
+            try:
+                _claim_shards(f"{socket.gethostname()}:{os.getpid()}:{worker_number}"[-100:])
+            finally:
+                with _leases_lock:
+                    _workers_running -= 1
+                    if not _workers_running:
+                        _workers_finished.set()
+
+        def _claim_shards(worker_id: str):
+
+            while not stop_event.is_set():
+
+                if self._no_api_calls_left():
+                    self._wm_error_service.handle_error("No Weather Underground API calls left for the backfill "
+                                                        "today. Run it again to carry on", "Info")
+                    stop_event.set()
+                    break
+
+                _shard = backfill_service.claim_shard(worker_id, _station_ids)
+
+                if _shard is None:
+
+                    # Failed shards can be claimed again once their lease has run out
+                    if backfill_service.get_progress(_station_ids)["failed"]["shards"]:
+                        stop_event.wait(backfill_service.lease_seconds / 3)
+                        continue
+
+                    break
+
+                with _leases_lock:
+                    _leases[_shard.ShardId] = worker_id
+
+                try:
+
+                    _days_saved = self._backfill_shard(_shard, stop_event, _summaries_lock,
+                                                       lambda: _shard.ShardId in _lost_leases)
+
+                    if _days_saved is None:
+                        backfill_service.release_shard(_shard.ShardId, worker_id)
+                    else:
+                        backfill_service.complete_shard(_shard.ShardId, worker_id, _days_saved)
+
+                except WuApiUnavailableException as ex:
+
+                    # WU being unavailable isn't the shard's fault, so the shard is handed back without counting
+                    # the attempt. Other workers carry on while there are retries left.
+                    backfill_service.release_shard(_shard.ShardId, worker_id)
+
+                    if self._wu_service.get_remaining_retries() == 0:
+                        self._wm_error_service.handle_error(f"Weather Underground API unavailable and the retry "
+                                                            f"budget for the backfill is spent. Run it again to "
+                                                            f"carry on: {ex}", "Warning", send_email=True)
+                        stop_event.set()
+                        break
+
+                    stop_event.wait(backfill_service.lease_seconds / 3)
+
+                except (WuApiException, OSError) as ex:
+
+                    # Running out of API calls isn't the shard's fault, so it doesn't count as an attempt
+                    if self._no_api_calls_left():
+                        backfill_service.release_shard(_shard.ShardId, worker_id)
+                    else:
+                        backfill_service.fail_shard(_shard.ShardId, worker_id, str(ex))
+                        self._wm_error_service.handle_error(f"{self._station_name(_shard.StationId)}Backfill of "
+                                                            f"{_shard.FirstDate} to {_shard.LastDate} failed: {ex}",
+                                                            "Warning", send_email=True, batch_message=True)
+
+                finally:
+
+                    with _leases_lock:
+                        _leases.pop(_shard.ShardId, None)
+
+        self._wu_service.start_wu_api_session()
+
+        _workers = [threading.Thread(target=_backfill_worker, args=(worker_number,), daemon=True,
+                                     name=f"Backfill-{worker_number}")
+                    for worker_number in range(_workers_running)]
+
+        for worker in _workers:
+            worker.start()
+
+        # Leases are renewed well before they run out, and progress is reported, until the workers have finished
+        _renew_interval = backfill_service.lease_seconds / 3
+        _next_report = time.perf_counter() + progress_interval_seconds
+
+        while not _workers_finished.wait(min(_renew_interval, max(0.0, _next_report - time.perf_counter()))):
+
+            with _leases_lock:
+                _held_leases = dict(_leases)
+
+            _lost_leases.update(backfill_service.renew_leases(_held_leases))
+
+            if time.perf_counter() >= _next_report:
+                self._report_backfill_progress(backfill_service.get_progress(_station_ids),
+                                               _days_done_at_start, _start_time)
+                _next_report = time.perf_counter() + progress_interval_seconds
+
+        self._wu_service.stop_wu_api_session()
+
+        _progress = backfill_service.get_progress(_station_ids)
+        self._report_backfill_progress(_progress, _days_done_at_start, _start_time)
+
+        self._database_service.export_observations()
+        self._database_service.archive_observations()
+        self._publish_metrics(_start_time)
+        self._wm_error_service.finalise_error_handling()
+
+        return _progress
+
+    # Downloads the days of a backfill shard that haven't been saved yet. The summaries and weather records are
+    # updated once for every day of the shard rather than at every checkpoint, which also catches up days saved
+    # by a worker that died before it got that far. Only one shard at a time is summarised so that workers
+    # don't rank the same station's records at once. Returns the number of days saved, or None if the shard
+    # was given up part way through because stop_event was set or lease_lost() says another worker has it.
+    def _backfill_shard(self, shard, stop_event: threading.Event, summaries_lock: threading.Lock,
+                        lease_lost) -> int | None:
+
+        _dates_required = self._database_service.get_incomplete_observation_dates(shard.FirstDate, shard.LastDate,
+                                                                                  self._max_download_attempts,
+                                                                                  shard.StationId)
+        _shard_dates = [shard.FirstDate + timedelta(days=day)
+                        for day in range((shard.LastDate - shard.FirstDate).days + 1)]
+        _dates_saved = []
+        _pending_days = []
+
+        try:
+
+            for _retrieved_observations in self._retrieve_recent_observations(shard.StationId, _dates_required):
+                _pending_days.append(_retrieved_observations)
+
+                if len(_pending_days) >= self._checkpoint_days:
+                    _dates_saved += self._save_days(_pending_days, shard.StationId)
+                    _pending_days = []
+
+                    if stop_event.is_set() or lease_lost():
+                        return None
+
+            if _pending_days:
+                _dates_saved += self._save_days(_pending_days, shard.StationId)
+                _pending_days = []
+
+        finally:
+
+            # Keep the days that were downloaded before any failure so the API calls aren't wasted
+            if _pending_days:
+                _dates_saved += self._save_days(_pending_days, shard.StationId)
+
+            with summaries_lock:
+                self._database_service.update_summaries_and_extremes(shard.StationId, _shard_dates)
+
+        return len(_dates_saved)
+
+    # Saves downloaded days without updating the summaries, which their caller updates once it has saved all it's
+    # going to. Ranking the weather records reads a station's history, so doing it for every checkpoint would take
+    # far longer than saving the observations. Returns the days saved.
+    def _save_days(self, days: list, station_id: str) -> list[date]:
+
+        self._database_service.save_list_of_observations(days, station_id, update_summaries=False)
+
+        return [date.fromisoformat(day["observations"][0]["obsTimeLocal"][0:10]) for day in days]
+
+    def _report_backfill_progress(self, progress: dict, days_done_at_start: int, start_time: float):
+
+        _total_days = sum(state["days"] for state in progress.values())
+        _days_done = progress["done"]["days"]
+        _days_left = _total_days - _days_done - progress["abandoned"]["days"]
+        _elapsed_seconds = time.perf_counter() - start_time
+        _days_per_second = (_days_done - days_done_at_start) / _elapsed_seconds if _elapsed_seconds else 0
+
+        if not _days_left:
+            _eta = "finished"
+        elif _days_per_second:
+            _eta = f"ETA {timedelta(seconds=round(_days_left / _days_per_second))}"
         else:
-            return yesterdays_date
+            _eta = "ETA unknown"
+
+        self._wm_error_service.handle_error(f"Backfill {_days_done / max(_total_days, 1):.1%} done: "
+                                            f"{progress['done']['shards']} shards of "
+                                            f"{sum(state['shards'] for state in progress.values())} "
+                                            f"({_days_done} of {_total_days} days), "
+                                            f"{progress['claimed']['shards']} in progress, "
+                                            f"{progress['failed']['shards']} to retry, "
+                                            f"{progress['abandoned']['shards']} abandoned, {_eta}",
+                                            "Info")
+
+    # True when calls are being recorded and those left are down to the reserve kept for retries
+    def _no_api_calls_left(self) -> bool:
+
+        _remaining_api_calls = self._wu_service.get_remaining_api_calls()
+
+        return _remaining_api_calls is not None and _remaining_api_calls <= self._api_call_reserve
+
+    # Records the wall time of a run, logs where its time went and publishes the metrics gathered so far
+    def _publish_metrics(self, start_time: float):
+
+        self._metrics.observe("run", time.perf_counter() - start_time)
+
+        _http_count, _http_seconds = self._metrics.timer("http_request")
+        _, _decode_seconds = self._metrics.timer("json_decode")
+        _, _row_build_seconds = self._metrics.timer("row_build")
+        _, _write_seconds = self._metrics.timer("database_write")
+
+        if _http_count:
+            self._wm_error_service.handle_error(f"{_http_count} API calls ({self._metrics.counter('http_retries')} "
+                                                f"retries) took {_http_seconds:.2f}s, decoding "
+                                                f"{_decode_seconds:.2f}s, building rows {_row_build_seconds:.2f}s "
+                                                f"and writing {self._metrics.counter('rows_written')} rows "
+                                                f"{_write_seconds:.2f}s",
+                                                "Info")
+
+        _failures = self._metrics.counter("http_failures")
+
+        if _failures:
+            _, _retry_wait_seconds = self._metrics.timer("retry_wait")
+            _, _pause_seconds = self._metrics.timer("circuit_breaker_pause")
+            self._wm_error_service.handle_error(f"API calls failed {_failures} times "
+                                                f"({self._metrics.counter('http_throttled')} throttled), waiting "
+                                                f"{_retry_wait_seconds:.1f}s before retrying. The circuit breaker "
+                                                f"opened {self._metrics.counter('circuit_breaker_opens')} times, "
+                                                f"pausing calls for {_pause_seconds:.1f}s in all, and "
+                                                f"{self._metrics.counter('api_calls_given_up')} were given up, with "
+                                                f"{self._wu_service.get_remaining_retries()} retries left",
+                                                "Info")
+
+        try:
+            self._metrics.publish()
+        except OSError as ex:
+            self._wm_error_service.handle_error(f"Couldn't write run metrics: {ex}", "Warning")
+
+    # Finds the days that need downloading for every station
+    def _get_dates_required_by_station(self) -> dict:
+
+        return {station_id: self._get_dates_required(station_id, initial_observation_date)
+                for station_id, initial_observation_date in self._station_initial_observation_dates.items()}
+
+    # Downloads and saves the outstanding days for every station, after checking today's observations are being
+    # logged if check_today is set. Returns the days that were downloaded for each station. If stop_event is given
+    # and set part way through, the days downloaded so far are saved and the rest are left for later.
+    def _download_outstanding_days(self, dates_required_by_station: dict, check_today: bool,
+                                   stop_event: threading.Event = None) -> dict:
+
+        if not self._replay_from_cache:
+            if check_today:
+                for station_id in dates_required_by_station:
+                    self._not_currently_gathering_data_warner(station_id)
+
+            dates_required_by_station = self._apply_api_throttling_limit(dates_required_by_station)
+
+        for station_id, dates_required in dates_required_by_station.items():
+
+            if stop_event is not None and stop_event.is_set():
+                break
+
+            self._fetch_and_save_observations(station_id, dates_required, stop_event)
+
+        return dates_required_by_station
+
+    # Saves hourly observations for yesterday and today that are newer than the latest saved for each station.
+    # latest_observation_times holds the latest saved observation time for each station between polls.
+    # The days saved are added to the sets of dates_polled for each station, whose summaries are updated once a day
+    # by _summarise_polled_days rather than at every poll.
+    def _download_latest_observations(self, today: date, latest_observation_times: dict, dates_polled: dict):
+
+        for station_id in self._station_initial_observation_dates:
+
+            for date_required in (today - timedelta(days=1), today):
+
+                _retrieved_observations = self._wu_service.get_hourly_observations_for_date(date_required, station_id)
+
+                if not _retrieved_observations:
+                    continue
+
+                _latest_observation_time = latest_observation_times.get(station_id, "")
+                _new_observations = [hourly_observation
+                                     for hourly_observation in _retrieved_observations["observations"]
+                                     if hourly_observation["obsTimeLocal"] > _latest_observation_time]
+
+                if _new_observations:
+                    self._database_service.save_recent_observations([{"observations": _new_observations}], station_id,
+                                                                    update_summaries=False)
+                    latest_observation_times[station_id] = _new_observations[-1]["obsTimeLocal"]
+                    dates_polled.setdefault(station_id, set()).add(date_required)
+
+    # Brings the summaries and weather records up to date with the days saved by polls since they were last updated
+    def _summarise_polled_days(self, dates_polled: dict):
+
+        for station_id, dates in dates_polled.items():
+            self._database_service.update_summaries_and_extremes(station_id, sorted(dates))
+
+        dates_polled.clear()
+
+    # Downloads a day again once it has settled, replacing the provisional observations saved during polling.
+    # Stations for which the day has just been downloaded as an outstanding day are skipped.
+    def _revise_settled_day(self, settled_date: date, downloaded_dates_by_station: dict):
+
+        for station_id in self._station_initial_observation_dates:
+
+            if settled_date in downloaded_dates_by_station.get(station_id, []):
+                continue
+
+            _retrieved_observations = self._wu_service.get_hourly_observations_for_date(settled_date, station_id)
+
+            if _retrieved_observations and _retrieved_observations["observations"]:
+                self._database_service.save_recent_observations([_retrieved_observations], station_id)
+
+    # Finds the days that need downloading for a station.
+    # We only get observations from up to TWO days ago, not up to yesterday. This is because the Weather
+    # Underground API is sometimes slow in providing the full set of observations for yesterday.
+    # Every missing or partial day since the initial observation date is downloaded, not just the days
+    # after the most recent observation, so holes in the history get filled in.
+    def _get_dates_required(self, station_id: str, initial_observation_date: str) -> list[date]:
+
+        initial_observation_date = initial_observation_date or self._initial_observation_date
+
+        if initial_observation_date is None:
+            raise ValueError("Initial observation date is not configured")
+
+        _initial_observation_date = datetime.strptime(initial_observation_date, '%Y-%m-%d').date()
+
+        return self._database_service.get_incomplete_observation_dates(
+            _initial_observation_date + timedelta(days=1),
+            self._date_time_provider.now() - timedelta(days=2),
+            self._max_download_attempts,
+            station_id)
+
+    # To avoid tripping the Weather Underground API throttling limit, this plans how many days can be downloaded
+    # from the API calls actually left in the last 24 hours, less a reserve kept back for retries. Calls made by
+    # earlier runs and other tools using the same key are taken into account. The calls are shared fairly between
+    # stations, with any a station doesn't need going to the others. The number of days can also be capped per
+    # station per run by the ApiThrottlingLimit in the config file, where 0 means no cap.
+    # The earliest outstanding days are downloaded first. Outstanding observations will get downloaded on
+    # subsequent days.
+    def _apply_api_throttling_limit(self, dates_required_by_station: dict) -> dict:
+
+        _api_throttle_limit = int(float(self._api_throttling_limit or 0))
+        _remaining_api_calls = self._wu_service.get_remaining_api_calls()
+
+        if _remaining_api_calls is not None:
+            _calls_available = max(0, _remaining_api_calls - self._api_call_reserve)
+        else:
+            _calls_available = sum(len(dates_required) for dates_required in dates_required_by_station.values())
+
+        _throttled_dates_by_station = {}
+        _stations_left = len(dates_required_by_station)
+
+        # Stations needing fewest days are planned first so that their unused share passes to the others
+        for station_id, dates_required in sorted(dates_required_by_station.items(),
+                                                 key=lambda station_dates: len(station_dates[1])):
+
+            _station_limit = _calls_available // _stations_left
+
+            if _api_throttle_limit > 0:
+                _station_limit = min(_station_limit, _api_throttle_limit)
+
+            _throttled_dates = dates_required[:_station_limit]
+            _calls_available -= len(_throttled_dates)
+            _stations_left -= 1
+
+            if dates_required and not _throttled_dates:
+                self._wm_error_service.handle_error(f"{self._station_name(station_id)}No Weather Underground API "
+                                                    f"calls left for today. {len(dates_required)} outstanding days "
+                                                    f"will be downloaded on later runs",
+                                                    "Info")
+
+            elif len(_throttled_dates) < len(dates_required):
+                self._wm_error_service.handle_error(f"{self._station_name(station_id)}Downloading throttled to avoid "
+                                                    f"Weather Underground API throttling. Only observations up until "
+                                                    f"{_throttled_dates[-1]} will be downloaded. Later observations "
+                                                    f"will be downloaded on later runs",
+                                                    "Info")
+
+            _throttled_dates_by_station[station_id] = _throttled_dates
+
+        # Keep the stations in their configured order
+        return {station_id: _throttled_dates_by_station[station_id] for station_id in dates_required_by_station}
 
     # Alerts user to the fact that no data has been logged to Weather Underground today.
     # Weather station may be offline for some reason.
-    def _not_currently_gathering_data_warner(self):
+    def _not_currently_gathering_data_warner(self, station_id: str = None):
 
-        try:
+        if self._wu_service.get_remaining_api_calls() == 0:
+            self._wm_error_service.handle_error(f"{self._station_name(station_id)}No Weather Underground API calls "
+                                                f"left to check today's observations",
+                                                "Info")
+            return
 
-            self._wu_service.start_wu_api_session()
+        try:
 
-            _retrieved_observations = self._wu_service.get_hourly_observations_for_date(datetime.now().date())
+            _retrieved_observations = self._wu_service.get_hourly_observations_for_date(
+                self._date_time_provider.now(), station_id)
 
             if _retrieved_observations is None:
-                self._wm_error_service.handle_error("Weather Underground is not logging observations today",
+                self._wm_error_service.handle_error(f"{self._station_name(station_id)}Weather Underground is not "
+                                                    f"logging observations today",
                                                     "Warning", send_email=True)
 
-            self._wu_service.stop_wu_api_session()
+        except WuApiUnavailableException as ex:
+
+            self._wm_error_service.handle_error(f"{self._station_name(station_id)}Couldn't check today's "
+                                                f"observations: {ex}", "Warning", send_email=True, batch_message=True)
 
         except WuApiException as ex:
 
-            self._wm_error_service.handle_error(str(ex), "Critical", send_email=True, terminate=True, exc_info=ex)
+            self._wm_error_service.handle_error(str(ex), "Critical", send_email=True,
+                                                terminate=not self._daemon_mode, exc_info=ex)
 
-    # Repeatedly call the Weather Underground API to fetch recent observations
-    def _retrieve_recent_observations(self, most_recent_observation_date: date, fetch_up_to_date: date):
+    # Streams observations from Weather Underground into the database. Days are saved as they arrive,
+    # checkpoint_days at a time in their own transaction, so every saved day is a durable checkpoint.
+    # If the run fails part way through, the next run only downloads the days that are still missing.
+    # Downloading stops between days once stop_event, if given, is set.
+    def _fetch_and_save_observations(self, station_id: str, dates_required: list[date],
+                                     stop_event: threading.Event = None):
 
-        _observation_list = []
+        _pending_days = []
+        _dates_saved = []
 
-        _date_counter: date = most_recent_observation_date + timedelta(days=1)
+        try:
+
+            for _retrieved_observations in self._retrieve_recent_observations(station_id, dates_required):
+                _pending_days.append(_retrieved_observations)
+
+                if len(_pending_days) >= self._checkpoint_days:
+                    _dates_saved += self._save_days(_pending_days, station_id)
+                    _pending_days = []
+
+                if stop_event is not None and stop_event.is_set():
+                    break
+
+            if _pending_days:
+                _dates_saved += self._save_days(_pending_days, station_id)
+                _pending_days = []
+
+        except WuApiException as ex:
+
+            # Keep the days that were downloaded before the failure so the API calls aren't wasted
+            if _pending_days:
+                _dates_saved += self._save_days(_pending_days, station_id)
+                _pending_days = []
+
+            self._database_service.update_summaries_and_extremes(station_id, _dates_saved)
+            _dates_saved = []
+
+            # WU being unavailable for now needn't end the run. The days missed are downloaded by a later run.
+            if isinstance(ex, WuApiUnavailableException):
+                self._wm_error_service.handle_error(f"{self._station_name(station_id)}Downloading stopped, later "
+                                                    f"days will be downloaded by the next run: {ex}",
+                                                    "Warning", send_email=True, batch_message=True)
+            else:
+                self._wm_error_service.handle_error(str(ex), "Critical", send_email=True,
+                                                    terminate=not self._daemon_mode)
+
+        # The summaries are brought up to date once for every day saved for the station
+        self._database_service.update_summaries_and_extremes(station_id, _dates_saved)
+
+    # Repeatedly call the Weather Underground API to fetch the required days, yielding each day
+    # that has data in date order. With more than one fetch worker the days are requested concurrently.
+    # Only a small window of days is fetched ahead of the consumer, so memory use doesn't grow with the range.
+    # Days that come back incomplete are recorded so they are only retried a limited number of times.
+    def _retrieve_recent_observations(self, station_id: str, dates_required: list[date]):
+
+        _fetch_ahead_limit = self._fetch_workers * 2
+        _in_flight_days: deque[tuple[date, Future]] = deque()
+        _dates_to_submit = iter(dates_required)
+        _all_submitted = False
+
+        _executor = ThreadPoolExecutor(max_workers=self._fetch_workers)
 
         try:
 
-            self._wu_service.start_wu_api_session()
+            while not _all_submitted or _in_flight_days:
+
+                while not _all_submitted and len(_in_flight_days) < _fetch_ahead_limit:
+                    _date_counter = next(_dates_to_submit, None)
+
+                    if _date_counter is None:
+                        _all_submitted = True
+                    else:
+                        _in_flight_days.append(
+                            (_date_counter,
+                             _executor.submit(self._wu_service.get_hourly_observations_for_date,
+                                              _date_counter, station_id)))
 
-            while _date_counter <= fetch_up_to_date:
+                if not _in_flight_days:
+                    break
 
-                _retrieved_observations = self._wu_service.get_hourly_observations_for_date(_date_counter)
+                _date_required, _future = _in_flight_days.popleft()
+                _retrieved_observations = _future.result()
 
-                if not _retrieved_observations["observations"]:
-                    self._wm_error_service.handle_error(f"No data for {_date_counter} retrieved "
-                                                        f"from Weather Underground",
+                if self._replay_from_cache:
+                    # A day missing from the cache wasn't a download attempt, so isn't recorded as one
+                    if _retrieved_observations and _retrieved_observations["observations"]:
+                        self._metrics.increment("days_downloaded")
+                        yield _retrieved_observations
+
+                elif not _retrieved_observations or not _retrieved_observations["observations"]:
+                    self._database_service.record_download_attempt(_date_required, 0, station_id)
+                    self._wm_error_service.handle_error(f"{self._station_name(station_id)}No data for "
+                                                        f"{_date_required} retrieved from Weather Underground",
                                                         "Warning", send_email=True, batch_message=True)
                 else:
-                    _observation_list.append(_retrieved_observations)
-
-                _date_counter = _date_counter + timedelta(days=1)
+                    self._metrics.increment("days_downloaded")
 
-            self._wu_service.stop_wu_api_session()
+                    if len(_retrieved_observations["observations"]) < 24:
+                        self._database_service.record_download_attempt(_date_required,
+                                                                       len(_retrieved_observations["observations"]),
+                                                                       station_id)
+                    yield _retrieved_observations
 
-        except WuApiException as ex:
+        finally:
+            # Don't spend API calls on outstanding days if something has gone wrong
+            _executor.shutdown(cancel_futures=True)
 
-            self._wm_error_service.handle_error(str(ex), "Critical", send_email=True, terminate=True)
+    # Prefix for messages so that batched alerts show which station they're about
+    @staticmethod
+    def _station_name(station_id: str) -> str:
 
-        return _observation_list
+        return f"{station_id}: " if station_id else ""
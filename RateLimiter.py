@@ -0,0 +1,58 @@
+import threading
+import time
+
+
+# A single token bucket. Tokens are added continuously at refill_rate per second up to capacity.
+class _TokenBucket:
+
+    def __init__(self, capacity: float, refill_rate: float):
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.refill_rate)
+        self.last_refill = now
+
+    # Seconds until a whole token will be available
+    def wait_time(self) -> float:
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.refill_rate
+
+
+# Limits the rate of Weather Underground API calls to a number of requests per second and per minute.
+# One instance is shared by every thread making API calls so concurrent fetching can't exceed either limit.
+# A limit of zero or less means that limit is not applied.
+class RateLimiter:
+
+    def __init__(self, requests_per_second: float = 0, requests_per_minute: float = 0):
+        self._lock = threading.Lock()
+        self._buckets = []
+
+        if requests_per_second > 0:
+            self._buckets.append(_TokenBucket(requests_per_second, requests_per_second))
+
+        if requests_per_minute > 0:
+            self._buckets.append(_TokenBucket(requests_per_minute, requests_per_minute / 60))
+
+    # Blocks until a call is permitted by every bucket, then consumes a token from each
+    def acquire(self):
+
+        while True:
+
+            with self._lock:
+                _now = time.monotonic()
+
+                for bucket in self._buckets:
+                    bucket.refill(_now)
+
+                _wait = max((bucket.wait_time() for bucket in self._buckets), default=0.0)
+
+                if _wait == 0:
+                    for bucket in self._buckets:
+                        bucket.tokens -= 1
+                    return
+
+            time.sleep(_wait)
@@ -0,0 +1,165 @@
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+_METRIC_PREFIX = "wmdownloader"
+
+# Description of each metric, as given in the Prometheus HELP line
+_METRIC_HELP = {
+    "http_requests": "Weather Underground API requests made",
+    "http_retries": "Retries of Weather Underground API requests that failed",
+    "http_failures": "Weather Underground API requests that were throttled, failed on the server or couldn't connect",
+    "http_throttled": "Weather Underground API requests answered with 429 Too Many Requests",
+    "retry_wait": "Time spent waiting before retrying Weather Underground API requests",
+    "circuit_breaker_opens": "Times Weather Underground API calls were paused after repeated failures",
+    "circuit_breaker_pause": "Time API calls spent paused by the circuit breaker",
+    "api_calls_given_up": "Weather Underground API calls given up on after retrying or while paused",
+    "http_request": "Time spent waiting for Weather Underground API responses, including retries",
+    "cache_hits": "Days served from the response cache instead of the API",
+    "json_decode": "Time spent decoding Weather Underground responses",
+    "days_downloaded": "Days of observations downloaded",
+    "row_build": "Time spent building database rows from observations",
+    "validation": "Time spent validating database rows before they are written",
+    "rows_quarantined": "Observations that failed validation and were quarantined instead of written",
+    "database_write": "Time spent executing and committing database writes",
+    "rows_written": "Observations written to the database",
+    "summary_update": "Time spent updating the summaries and weather records",
+    "records_imported": "Readings read from imported export files",
+    "rows_archived": "Observations moved from the Observations table to the archive",
+    "query_cache_hits": "Observation queries answered from the query cache",
+    "run": "Wall time of downloader runs",
+}
+
+
+# Thread-safe record of the work done by each phase of a run: counters of things done and timers of how long
+# they took. A daemon resets the metrics once each daily run is published, so every publication covers the time
+# since the last one rather than the life of the process.
+# Published as a Prometheus textfile for the node exporter's textfile collector and as a JSON summary.
+class RunMetrics:
+    _counters: dict
+    _prometheus_file_name: str = ""
+    _summary_file_name: str = ""
+    _timers: dict
+
+    # Nothing is written for a file name that is empty
+    def __init__(self, prometheus_file_name: str = "", summary_file_name: str = ""):
+
+        self._prometheus_file_name = prometheus_file_name
+        self._summary_file_name = summary_file_name
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._timers = {}
+        self._started = datetime.now()
+
+    def increment(self, name: str, amount: int = 1):
+
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    # Records one timing of a phase in seconds
+    def observe(self, name: str, seconds: float):
+
+        with self._lock:
+            _count, _total, _maximum = self._timers.get(name, (0, 0.0, 0.0))
+            self._timers[name] = (_count + 1, _total + seconds, max(_maximum, seconds))
+
+    # Times the body of a with block
+    def time(self, name: str):
+
+        return _Timing(self, name)
+
+    # Number of timings and total seconds recorded for a phase
+    def timer(self, name: str) -> tuple:
+
+        with self._lock:
+            _count, _total, _ = self._timers.get(name, (0, 0.0, 0.0))
+            return _count, _total
+
+    def counter(self, name: str) -> int:
+
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    # Clears every counter and timer to start measuring a new run
+    def reset(self):
+
+        with self._lock:
+            self._counters = {}
+            self._timers = {}
+            self._started = datetime.now()
+
+    # Writes the Prometheus textfile and the JSON summary, where configured
+    def publish(self):
+
+        if self._prometheus_file_name:
+            _write_atomically(self._prometheus_file_name, self._format_prometheus())
+
+        if self._summary_file_name:
+            _write_atomically(self._summary_file_name, json.dumps(self.summary(), indent=2))
+
+    def summary(self) -> dict:
+
+        with self._lock:
+            return {"started": self._started.isoformat(timespec="seconds"),
+                    "published": datetime.now().isoformat(timespec="seconds"),
+                    "counters": dict(sorted(self._counters.items())),
+                    "timers": {name: {"count": count,
+                                      "total_seconds": round(total, 6),
+                                      "mean_seconds": round(total / count, 6) if count else 0.0,
+                                      "max_seconds": round(maximum, 6)}
+                               for name, (count, total, maximum) in sorted(self._timers.items())}}
+
+    def _format_prometheus(self) -> str:
+
+        _lines = []
+
+        with self._lock:
+
+            for name, value in sorted(self._counters.items()):
+                _metric = f"{_METRIC_PREFIX}_{name}_total"
+                _lines += [f"# HELP {_metric} {_METRIC_HELP.get(name, name)}",
+                           f"# TYPE {_metric} counter",
+                           f"{_metric} {value}"]
+
+            for name, (count, total, maximum) in sorted(self._timers.items()):
+                _metric = f"{_METRIC_PREFIX}_{name}_seconds"
+                _lines += [f"# HELP {_metric} {_METRIC_HELP.get(name, name)}",
+                           f"# TYPE {_metric} summary",
+                           f"{_metric}_sum {total:.6f}",
+                           f"{_metric}_count {count}",
+                           f"# HELP {_metric}_max Longest single timing of {_metric}",
+                           f"# TYPE {_metric}_max gauge",
+                           f"{_metric}_max {maximum:.6f}"]
+
+        _lines += [f"# HELP {_METRIC_PREFIX}_last_publish_timestamp_seconds When these metrics were written",
+                   f"# TYPE {_METRIC_PREFIX}_last_publish_timestamp_seconds gauge",
+                   f"{_METRIC_PREFIX}_last_publish_timestamp_seconds {time.time():.0f}"]
+
+        return "\n".join(_lines) + "\n"
+
+
+class _Timing:
+
+    def __init__(self, metrics: RunMetrics, name: str):
+        self._metrics = metrics
+        self._name = name
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exception_type, value, trace_back):
+        self._metrics.observe(self._name, time.perf_counter() - self._start)
+
+
+# Writes to a temporary file first so that a collector never reads a partly written file
+def _write_atomically(file_name: str, content: str):
+
+    _temporary_file_name = f"{file_name}.{os.getpid()}.tmp"
+
+    with open(_temporary_file_name, "w", encoding="utf-8") as metrics_file:
+        metrics_file.write(content)
+
+    os.replace(_temporary_file_name, file_name)
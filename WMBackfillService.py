@@ -0,0 +1,226 @@
+import sqlalchemy.exc
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+from IWMErrorService import IWMErrorService
+from sqlalchemy import and_, insert, or_, select, update
+from WMSchema import BackfillShard
+
+
+# Records historical backfills as shards of days in the BackfillShards table and hands them out to workers.
+# Workers may be threads, processes or other hosts sharing the database, each with its own API key. A worker
+# claims a shard by taking out a lease on it, which it renews while it works. If the worker dies, its lease
+# runs out and the shard is claimed by another. A shard that fails is retried, after its lease has run out,
+# until it has been claimed max_attempts times.
+# Lease times are in UTC from each host's own clock, so lease_seconds should be well above any clock drift.
+class WMBackfillService:
+    _engine = None
+    _error_service: IWMErrorService
+    _lease_seconds: int = 300
+    _max_attempts: int = 3
+
+    def __init__(self, engine, error_service: IWMErrorService, lease_seconds: int = 300, max_attempts: int = 3):
+
+        self._engine = engine
+        self._error_service = error_service
+        self._lease_seconds = max(1, int(lease_seconds))
+        self._max_attempts = max(1, int(max_attempts))
+
+    @property
+    def lease_seconds(self) -> int:
+        return self._lease_seconds
+
+    # Splits the days from first_date to last_date into shards of shard_days for a station, leaving out days already
+    # in a recorded shard, so running the same or a longer backfill again resumes it. Returns the number of shards
+    # added.
+    def create_shards(self, station_id: str, first_date: date, last_date: date, shard_days: int) -> int:
+
+        _shard_days = max(1, int(shard_days))
+
+        try:
+
+            with self._engine.connect() as connection:
+
+                _recorded = connection.execute(select(BackfillShard.FirstDate, BackfillShard.LastDate)
+                                               .where(BackfillShard.StationId == station_id,
+                                                      BackfillShard.LastDate >= first_date,
+                                                      BackfillShard.FirstDate <= last_date)
+                                               .order_by(BackfillShard.FirstDate)).all()
+                _new_shards = []
+                _first_date = first_date
+
+                # Days are split into shards up to each recorded shard, which is skipped, and then up to last_date
+                for recorded_first_date, recorded_last_date in [*_recorded, (last_date + timedelta(days=1), None)]:
+
+                    while _first_date < recorded_first_date:
+                        _last_date = min(_first_date + timedelta(days=_shard_days - 1),
+                                         recorded_first_date - timedelta(days=1))
+                        _new_shards.append({"StationId": station_id, "FirstDate": _first_date,
+                                            "LastDate": _last_date})
+                        _first_date = _last_date + timedelta(days=1)
+
+                    if recorded_last_date is not None:
+                        _first_date = max(_first_date, recorded_last_date + timedelta(days=1))
+
+                if _new_shards:
+                    connection.execute(insert(BackfillShard), _new_shards)
+                    connection.commit()
+
+                return len(_new_shards)
+
+        except sqlalchemy.exc.DBAPIError as ex:
+
+            self._error_service.handle_error(f"Database access error while creating backfill shards: {ex}",
+                                             "Error", send_email=True, terminate=True, exc_info=ex)
+
+    # Claims the earliest shard of the given stations that is free, taking out a lease on it for worker_id.
+    # Returns the shard's row, or None if there's nothing left to claim.
+    # Candidates are read first and then claimed with an UPDATE that only succeeds if the shard is still free,
+    # so two workers racing for the same shard can't both get it, whatever the backend's locking.
+    def claim_shard(self, worker_id: str, station_ids: list[str]):
+
+        _now = _utc_now()
+
+        try:
+
+            with self._engine.connect() as connection:
+
+                while True:
+
+                    _candidate_ids = connection.execute(select(BackfillShard.ShardId)
+                                                        .where(BackfillShard.StationId.in_(station_ids),
+                                                               self._claimable(_now))
+                                                        .order_by(BackfillShard.FirstDate, BackfillShard.StationId)
+                                                        .limit(10)).scalars().all()
+
+                    if not _candidate_ids:
+                        return None
+
+                    for shard_id in _candidate_ids:
+
+                        _claimed = connection.execute(update(BackfillShard)
+                                                      .where(BackfillShard.ShardId == shard_id,
+                                                             self._claimable(_now))
+                                                      .values(Status="claimed",
+                                                              Attempts=BackfillShard.Attempts + 1,
+                                                              LeaseOwner=worker_id,
+                                                              LeaseExpires=self._lease_expiry(_now)))
+                        connection.commit()
+
+                        if _claimed.rowcount == 1:
+                            return connection.execute(select(BackfillShard.__table__)
+                                                      .where(BackfillShard.ShardId == shard_id)).one()
+
+        except sqlalchemy.exc.DBAPIError as ex:
+
+            self._error_service.handle_error(f"Database access error while claiming a backfill shard: {ex}",
+                                             "Error", send_email=True, terminate=True, exc_info=ex)
+
+    # Extends the leases held on the given shards, a dict of shard id to worker id. Returns the ids of shards whose
+    # lease has been lost, because it ran out and another worker has claimed the shard.
+    def renew_leases(self, leases: dict) -> set:
+
+        _lost = set()
+        _now = _utc_now()
+
+        try:
+
+            with self._engine.connect() as connection:
+
+                for shard_id, worker_id in leases.items():
+                    if connection.execute(self._update_held(shard_id, worker_id)
+                                          .values(LeaseExpires=self._lease_expiry(_now))).rowcount != 1:
+                        _lost.add(shard_id)
+
+                connection.commit()
+
+        except sqlalchemy.exc.DBAPIError as ex:
+
+            # The leases are renewed again well before they run out, so one failure isn't fatal
+            self._error_service.handle_error(f"Database access error while renewing backfill leases: {ex}",
+                                             "Warning", exc_info=ex)
+
+        return _lost
+
+    # Marks a shard as done. Returns False if the worker no longer held the lease.
+    def complete_shard(self, shard_id: int, worker_id: str, days_saved: int) -> bool:
+
+        return self._end_lease(shard_id, worker_id, "completing", Status="done", DaysSaved=days_saved,
+                               LeaseExpires=None, LastError=None, CompletedAt=_utc_now())
+
+    # Marks a shard as failed. It's retried once its lease has run out, if it has attempts left.
+    def fail_shard(self, shard_id: int, worker_id: str, error: str) -> bool:
+
+        return self._end_lease(shard_id, worker_id, "failing", Status="failed", LastError=error[:500])
+
+    # Hands a shard back without counting the attempt, e.g. when the worker has run out of API calls
+    def release_shard(self, shard_id: int, worker_id: str) -> bool:
+
+        return self._end_lease(shard_id, worker_id, "releasing", Status="pending", LeaseExpires=None,
+                               Attempts=BackfillShard.Attempts - 1)
+
+    # Days and shards of the given stations' backfills by state, where "abandoned" shards are those that have
+    # failed and have no attempts left
+    def get_progress(self, station_ids: list[str]) -> dict:
+
+        _progress = {state: {"shards": 0, "days": 0} for state in ("pending", "claimed", "done", "failed",
+                                                                    "abandoned")}
+
+        try:
+
+            with self._engine.connect() as connection:
+
+                for shard in connection.execute(select(BackfillShard.Status, BackfillShard.Attempts,
+                                                       BackfillShard.FirstDate, BackfillShard.LastDate)
+                                                .where(BackfillShard.StationId.in_(station_ids))):
+
+                    _state = "abandoned" if shard.Status == "failed" and shard.Attempts >= self._max_attempts \
+                        else shard.Status
+                    _progress[_state]["shards"] += 1
+                    _progress[_state]["days"] += (shard.LastDate - shard.FirstDate).days + 1
+
+        except sqlalchemy.exc.DBAPIError as ex:
+
+            self._error_service.handle_error(f"Database access error while reading backfill progress: {ex}",
+                                             "Warning", exc_info=ex)
+
+        return _progress
+
+    # A shard can be claimed if it isn't done, hasn't run out of attempts and has no lease that's still running
+    def _claimable(self, now: datetime):
+
+        return and_(BackfillShard.Status != "done",
+                    BackfillShard.Attempts < self._max_attempts,
+                    or_(BackfillShard.LeaseExpires.is_(None), BackfillShard.LeaseExpires < now))
+
+    def _lease_expiry(self, now: datetime) -> datetime:
+
+        return now + timedelta(seconds=self._lease_seconds)
+
+    # UPDATE of a shard that only succeeds while the worker still holds its lease
+    @staticmethod
+    def _update_held(shard_id: int, worker_id: str):
+
+        return update(BackfillShard).where(BackfillShard.ShardId == shard_id,
+                                           BackfillShard.Status == "claimed",
+                                           BackfillShard.LeaseOwner == worker_id)
+
+    def _end_lease(self, shard_id: int, worker_id: str, action: str, **values) -> bool:
+
+        try:
+
+            with self._engine.connect() as connection:
+                _updated = connection.execute(self._update_held(shard_id, worker_id).values(**values)).rowcount
+                connection.commit()
+                return _updated == 1
+
+        except sqlalchemy.exc.DBAPIError as ex:
+
+            self._error_service.handle_error(f"Database access error while {action} backfill shard {shard_id}: {ex}",
+                                             "Error", send_email=True, terminate=True, exc_info=ex)
+
+
+def _utc_now() -> datetime:
+
+    return datetime.now(timezone.utc).replace(tzinfo=None)
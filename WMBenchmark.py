@@ -0,0 +1,269 @@
+# Benchmarks WMDownloader end to end against the local stub of the Weather Underground API, so that changes to
+# fetching, parsing and saving can be compared run by run without spending API calls.
+#
+# Each scenario runs WMDownloader.py in a process of its own, downloading a number of days of synthetic observations
+# for its own benchmark station into the database in the configuration file, after first deleting anything stored
+# for that station. Use a scratch database, not the one holding your real observations. The run's start-up, schema
+# check, export and archiving are timed along with the download, and the peak memory reported is that process's
+# alone. E-mail alerts are sent to a closed local port so that they fail without being sent.
+#
+# Run every scenario:        python WMBenchmark.py config.ini
+# Run one with a slow API:   python WMBenchmark.py config.ini --scenario backfill --latency 0.25 --error-rate 0.05
+#
+# Results are appended to the results file and each run is compared with the previous run of the same scenario.
+
+import argparse
+import configparser
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from datetime import timedelta
+from DateTimeProvider import DateTimeProvider
+from IWMErrorService import IWMErrorService
+from sqlalchemy import delete, func, select
+from WMDatabaseService import WMDatabaseService
+from WMSchema import ArchivedObservation, DailySummary, DownloadAttempt, Extreme, MonthlySummary, Observation, \
+    QuarantinedObservation, YearlySummary
+from WuStubServer import start_stub_server
+
+_REPOSITORY_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+# Scenario name and the number of days it downloads
+_SCENARIOS = {
+    "daily": 1,
+    "backfill": 500,
+    "multiyear": 5 * 365,
+}
+
+
+# Error service that only logs, so that a benchmark never sends e-mail or ends the run
+class _BenchmarkErrorService(IWMErrorService):
+
+    def finalise_error_handling(self):
+        pass
+
+    def handle_error(self, message: str, severity: str = 'Warning', send_email: bool = False,
+                     batch_message: bool = False, terminate: bool = False, exc_info=None):
+        logging.log(logging.INFO if severity == "Info" else logging.WARNING, message)
+
+
+# Runs WMDownloader.py with a configuration file, returning its wall time in seconds and its peak resident set
+# size in MB, or None where that can't be measured. The peak is read from the process's own resource usage when
+# it's waited for, so it isn't mixed up with that of this process or of earlier scenarios.
+def _run_downloader(config_file_name: str) -> tuple:
+
+    _start = time.perf_counter()
+    _downloader = subprocess.Popen([sys.executable, os.path.join(_REPOSITORY_DIRECTORY, "WMDownloader.py"),
+                                    config_file_name], cwd=_REPOSITORY_DIRECTORY)
+
+    if hasattr(os, "wait4"):
+        _, _status, _usage = os.wait4(_downloader.pid, 0)
+        _downloader.returncode = os.waitstatus_to_exitcode(_status)
+        _peak_rss_mb = round(_usage.ru_maxrss / 1024 / (1024 if sys.platform == "darwin" else 1), 1)
+    else:
+        _downloader.wait()
+        _peak_rss_mb = None
+
+    _wall_seconds = time.perf_counter() - _start
+
+    if _downloader.returncode:
+        raise RuntimeError(f"WMDownloader.py failed with exit code {_downloader.returncode}")
+
+    return _wall_seconds, _peak_rss_mb
+
+
+def _git_revision():
+
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=_REPOSITORY_DIRECTORY, timeout=10).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def _clear_station(database_service: WMDatabaseService, station_id: str):
+
+    with database_service.engine.connect() as connection:
+        for table in (Observation, DownloadAttempt, DailySummary, MonthlySummary, YearlySummary, Extreme,
+                      QuarantinedObservation, ArchivedObservation):
+            connection.execute(delete(table).where(table.StationId == station_id))
+        connection.commit()
+
+
+def _count_observations(database_service: WMDatabaseService, station_id: str) -> int:
+
+    with database_service.engine.connect() as connection:
+        return connection.execute(select(func.count()).select_from(Observation)
+                                  .where(Observation.StationId == station_id)).scalar()
+
+
+# Copies the configuration for a scenario, downloading the given number of days up to two days ago for the benchmark
+# station from the stub, with nothing from the cache, no API calls counted against the quota and the metrics
+# written to summary_file_name
+def _write_scenario_config(config, station_id: str, days: int, api_url: str, config_file_name: str,
+                           summary_file_name: str):
+
+    _scenario_config = configparser.ConfigParser(interpolation=None)
+    _scenario_config.read_dict(config)
+
+    _initial_observation_date = DateTimeProvider().now() - timedelta(days=days + 2)
+
+    for section, options in {"WeatherUnderground": {"StationId": station_id, "StationIds": None,
+                                                    "ApiKey": "benchmark", "ApiUrl": api_url,
+                                                    "InitialObservationDate": _initial_observation_date.isoformat()},
+                             "Downloader": {"ApiThrottlingLimit": "0", "ApiCallReserve": "0",
+                                            "QuotaLedgerFile": None},
+                             # Retries are paced as configured, but the budget allows for every day so that the
+                             # error rate can't end a scenario early
+                             "Retry": {"Budget": str(days)},
+                             "Cache": {"Directory": None},
+                             "Metrics": {"PrometheusFile": None, "SummaryFile": summary_file_name},
+                             "EMail": {"Host": "127.0.0.1", "Port": "1"}}.items():
+
+        if not _scenario_config.has_section(section):
+            _scenario_config.add_section(section)
+
+        for option, value in options.items():
+            if value is None:
+                _scenario_config.remove_option(section, option)
+            else:
+                _scenario_config.set(section, option, value)
+
+    with open(config_file_name, "w", encoding="utf-8") as config_file:
+        _scenario_config.write(config_file)
+
+
+# Runs one scenario, downloading the given number of days up to two days ago, and returns its measurements
+def _run_scenario(config, scenario: str, days: int, api_url: str, latency: float, error_rate: float) -> dict:
+
+    _station_id = f"BENCH{days}"
+    _error_service = _BenchmarkErrorService()
+
+    _database_service = WMDatabaseService(config.get("Database", "IPAddress"),
+                                          config.get("Database", "Port"),
+                                          config.get("Database", "UserId"),
+                                          config.get("Database", "Password"),
+                                          config.get("Database", "DatabaseName"),
+                                          _error_service,
+                                          station_id=_station_id,
+                                          backend=config.get("Database", "Backend", fallback="mariadb"))
+    _clear_station(_database_service, _station_id)
+
+    with tempfile.TemporaryDirectory() as scenario_directory:
+
+        _config_file_name = os.path.join(scenario_directory, "config.ini")
+        _summary_file_name = os.path.join(scenario_directory, "metrics.json")
+        _write_scenario_config(config, _station_id, days, api_url, _config_file_name, _summary_file_name)
+
+        _wall_seconds, _peak_rss_mb = _run_downloader(_config_file_name)
+
+        with open(_summary_file_name, "r", encoding="utf-8") as summary_file:
+            _metrics = json.load(summary_file)
+
+    _rows = _count_observations(_database_service, _station_id)
+    _database_service.dispose()
+
+    def _counter(name: str) -> int:
+        return _metrics["counters"].get(name, 0)
+
+    def _seconds(name: str) -> float:
+        return round(_metrics["timers"].get(name, {}).get("total_seconds", 0.0), 3)
+
+    return {"scenario": scenario,
+            "days": days,
+            "rows": _rows,
+            "recorded": datetime.now().isoformat(timespec="seconds"),
+            "revision": _git_revision(),
+            "fetch_workers": config.getint("Downloader", "FetchWorkers", fallback=1),
+            "write_mode": config.get("Database", "WriteMode", fallback="upsert"),
+            "latency": latency,
+            "error_rate": error_rate,
+            "wall_seconds": round(_wall_seconds, 3),
+            "days_per_second": round(days / _wall_seconds, 2),
+            "rows_per_second": round(_rows / _wall_seconds, 1),
+            "peak_rss_mb": _peak_rss_mb,
+            "http_calls": _counter("http_requests"),
+            "http_retries": _counter("http_retries"),
+            "http_seconds": _seconds("http_request"),
+            "parse_seconds": _seconds("json_decode"),
+            "row_build_seconds": _seconds("row_build"),
+            "validation_seconds": _seconds("validation"),
+            "database_seconds": _seconds("database_write"),
+            "summary_seconds": _seconds("summary_update")}
+
+
+def _load_results(results_file_name: str) -> list:
+
+    if not os.path.exists(results_file_name):
+        return []
+
+    with open(results_file_name, "r", encoding="utf-8") as results_file:
+        return json.load(results_file)
+
+
+def _save_results(results_file_name: str, results: list):
+
+    with open(results_file_name, "w", encoding="utf-8") as results_file:
+        json.dump(results, results_file, indent=2)
+
+
+def _report(result: dict, previous: dict):
+
+    print(f"{result['scenario']}: {result['days']} days, {result['rows']} rows in {result['wall_seconds']:.2f}s - "
+          f"{result['days_per_second']} days/sec, {result['rows_per_second']} rows/sec, "
+          f"peak RSS {result['peak_rss_mb']} MB")
+    print(f"    {result['http_calls']} HTTP calls ({result['http_retries']} retries): "
+          f"http {result['http_seconds']:.2f}s, parse {result['parse_seconds']:.2f}s, "
+          f"row build {result['row_build_seconds']:.2f}s, validation {result['validation_seconds']:.2f}s, "
+          f"database {result['database_seconds']:.2f}s, "
+          f"summaries {result['summary_seconds']:.2f}s")
+
+    if previous is not None:
+        _change = (result["rows_per_second"] / previous["rows_per_second"] - 1) * 100 \
+            if previous["rows_per_second"] else 0
+        print(f"    {_change:+.1f}% rows/sec compared with {previous['recorded']} "
+              f"(revision {previous['revision']}, {previous['rows_per_second']} rows/sec)")
+
+
+if __name__ == "__main__":
+    _parser = argparse.ArgumentParser(description="Benchmark WMDownloader against a local stub of the WU API")
+    _parser.add_argument("ConfigFile", metavar="configfile", type=str,
+                         help="Fully qualified name of config file. Its database should be a scratch database")
+    _parser.add_argument("--scenario", choices=["all"] + list(_SCENARIOS), default="all")
+    _parser.add_argument("--days", type=int, help="Override the number of days downloaded by the scenario")
+    _parser.add_argument("--latency", type=float, default=0.05, help="Seconds the stub delays each response")
+    _parser.add_argument("--error-rate", type=float, default=0.0,
+                         help="Fraction of requests the stub answers with 503 Service Unavailable")
+    _parser.add_argument("--results", default="benchmark-results.json", help="File the results are appended to")
+    _arguments = _parser.parse_args()
+
+    if not os.path.isfile(_arguments.ConfigFile):
+        print("The supplied configuration file name does not exist")
+        sys.exit()
+
+    _config = configparser.ConfigParser(interpolation=None)
+    _config.read(_arguments.ConfigFile)
+
+    _stub_server = start_stub_server(0, _arguments.latency, _arguments.error_rate)
+    _api_url = f"http://127.0.0.1:{_stub_server.server_address[1]}/v2/pws/history/"
+    _results = _load_results(_arguments.results)
+
+    for _scenario, _days in _SCENARIOS.items():
+
+        if _arguments.scenario not in ("all", _scenario):
+            continue
+
+        _result = _run_scenario(_config, _scenario, _arguments.days or _days, _api_url,
+                                _arguments.latency, _arguments.error_rate)
+        _previous = next((result for result in reversed(_results) if result["scenario"] == _scenario), None)
+        _report(_result, _previous)
+
+        _results.append(_result)
+        _save_results(_arguments.results, _results)
+
+    _stub_server.shutdown()
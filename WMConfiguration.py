@@ -0,0 +1,11 @@
+import configparser
+
+
+# Stations to download, in their configured order. StationIds lists several stations and takes precedence over
+# StationId, which names one. Either may be left out of the [WeatherUnderground] section.
+def read_station_ids(config: configparser.ConfigParser) -> list[str]:
+
+    _station_ids = config.get("WeatherUnderground", "StationIds", fallback=None) \
+        or config.get("WeatherUnderground", "StationId", fallback="")
+
+    return [station_id.strip() for station_id in _station_ids.split(",") if station_id.strip()]
@@ -1,122 +1,582 @@
+import json
 import sys
+import time
 
 import sqlalchemy.orm
+from collections import Counter
 from datetime import date
 from datetime import datetime
+from datetime import timedelta
+from DateTimeProvider import DateTimeProvider
+from IDateTimeProvider import IDateTimeProvider
 from IWMDatabaseService import IWMDatabaseService
 from IWMErrorService import IWMErrorService
-from sqlalchemy import create_engine, func, MetaData
+from operator import itemgetter
+from RunMetrics import RunMetrics
+from sqlalchemy import create_engine, event, func, insert, text
 from sqlalchemy import exc
-from sqlalchemy.ext.automap import automap_base
+from sqlalchemy.dialects import mysql
+from sqlalchemy.dialects import sqlite
 from typing import Any
+from WMExtremesService import WMExtremesService
+from WMMigrationService import WMMigrationService
+from WMObservationValidator import WMObservationValidator
+from WMParquetExporter import WMParquetExporter
+from WMQueryService import WMQueryService
+from WMRetentionService import WMRetentionService
+from WMSchema import DownloadAttempt, Observation, QuarantinedObservation, WMBase, as_date, as_datetime, \
+    select_all_tiers
+from WMSummaryService import WMSummaryService
+
+# Observations columns and the Weather Underground fields they're taken from, in the order of the table's columns.
+# The first are at the top level of an hourly observation and the rest in its block of metric units.
+_HOURLY_FIELDS = {"SolarRadiationHigh": "solarRadiationHigh",
+                  "UvHigh": "uvHigh",
+                  "WindDirectionMean": "winddirAvg",
+                  "HumidityHigh": "humidityHigh",
+                  "HumidityLow": "humidityLow",
+                  "HumidityMean": "humidityAvg"}
+_METRIC_FIELDS = {"TemperatureHigh": "tempHigh",
+                  "TemperatureLow": "tempLow",
+                  "TemperatureMean": "tempAvg",
+                  "WindSpeedHigh": "windspeedHigh",
+                  "WindSpeedLow": "windspeedLow",
+                  "WindSpeedMean": "windspeedAvg",
+                  "WindGustHigh": "windgustHigh",
+                  "WindGustLow": "windgustLow",
+                  "WindGustMean": "windgustAvg",
+                  "DewPointHigh": "dewptHigh",
+                  "DewPointLow": "dewptLow",
+                  "DewPointMean": "dewptAvg",
+                  "WindChillHigh": "windchillHigh",
+                  "WindChillLow": "windchillLow",
+                  "WindChillMean": "windchillAvg",
+                  "HeatIndexHigh": "heatindexHigh",
+                  "HeatIndexLow": "heatindexLow",
+                  "HeatIndexMean": "heatindexAvg",
+                  "PressureHigh": "pressureMax",
+                  "PressureLow": "pressureMin",
+                  "PressureTrend": "pressureTrend",
+                  "PrecipitationRate": "precipRate",
+                  "PrecipitationTotal": "precipTotal"}
+_ROW_COLUMNS = ("StationId", "ObservationTime", *_HOURLY_FIELDS, *_METRIC_FIELDS)
+_get_hourly_fields = itemgetter(*_HOURLY_FIELDS.values())
+_get_metric_fields = itemgetter(*_METRIC_FIELDS.values())
 
 
 # Service to handle all interactions with the Weather Manager database
 class WMDatabaseService(IWMDatabaseService):
     engine = None
+    _backend: str = "mariadb"
+    _batch_size: int = 1000
+    _date_time_provider: IDateTimeProvider
+    download_attempts: Any = DownloadAttempt
     _error_service: IWMErrorService
-    base = automap_base()
-    observations: Any = None
-
-    def __init__(self, url, port, username, password, dbname, error_service: IWMErrorService):
+    _extremes_service: WMExtremesService
+    _insert_statements: dict
+    _metrics: RunMetrics = None
+    _months_written: set
+    _observation_validator: WMObservationValidator
+    _parquet_exporter: WMParquetExporter = None
+    _station_id: str = ""
+    _summary_service: WMSummaryService
+    _write_mode: str = "upsert"
+    observations: Any = Observation
+
+    # write_mode is "upsert" for batched INSERT ... ON DUPLICATE KEY UPDATE, "bulk" for batched multi-row inserts
+    # or "orm" to add each observation through an ORM session. In upsert and bulk modes batch_size rows are
+    # written and committed at a time. station_id is the default station for methods that aren't given one.
+    # extremes_rank_depth is the number of places kept for each weather record. If an export_directory is given,
+    # the months written are exported there as Parquet whenever export_observations is called.
+    # backend is "mariadb" for a MariaDB server or "sqlite" for a local SQLite file, in which case dbname is the
+    # name of the file and the server details aren't used. date_time_provider gives today's date, from which the
+    # age of observations to archive and the years of observations to partition are counted, and on which download
+    # attempts and quarantined observations are recorded.
+    def __init__(self, url, port, username, password, dbname, error_service: IWMErrorService,
+                 write_mode: str = "upsert", batch_size: int = 1000, station_id: str = "",
+                 extremes_rank_depth: int = 10, export_directory: str = "", metrics: RunMetrics = None,
+                 backend: str = "mariadb", query_cache_bytes: int = 64 * 2 ** 20, archive_after_days: int = 0,
+                 date_time_provider: IDateTimeProvider = None):
 
         self._error_service = error_service
 
-        try:
+        if write_mode not in ("upsert", "bulk", "orm"):
+            raise ValueError(f"Unknown database write mode '{write_mode}'")
+
+        if backend not in ("mariadb", "sqlite"):
+            raise ValueError(f"Unknown database backend '{backend}'")
+
+        self._write_mode = write_mode
+        self._batch_size = max(1, int(batch_size))
+        self._station_id = station_id
+        self._metrics = metrics if metrics is not None else RunMetrics()
+        self._backend = backend
+        self._date_time_provider = date_time_provider if date_time_provider is not None else DateTimeProvider()
+
+        if backend == "sqlite":
+            self.engine = self._create_sqlite_engine(dbname)
+        else:
+            # The engine doesn't connect until it's first used, and the tables are mapped declaratively in WMSchema,
+            # so constructing the service makes no round trips to the database.
+            # Connections are recycled hourly so a long-running daemon never uses one the server has timed out.
+            self.engine = create_engine(f"mariadb+mariadbconnector://{username}:{password}@{url}:{port}/{dbname}",
+                                        pool_recycle=3600)
+
+        self._summary_service = WMSummaryService(self.engine, error_service)
+        self._extremes_service = WMExtremesService(self.engine, error_service, extremes_rank_depth)
+        self._migration_service = WMMigrationService(self.engine, error_service, station_id,
+                                                     self._date_time_provider)
+        self._query_service = WMQueryService(self.engine, error_service, query_cache_bytes, self._metrics)
+        self._retention_service = WMRetentionService(self.engine, error_service, archive_after_days, self._metrics,
+                                                     self._date_time_provider)
+        self._months_written = set()
+        self._insert_statements = {}
+        self._observation_validator = WMObservationValidator(_ROW_COLUMNS)
+
+        # Bulk rows are passed to the driver as they are, so observation times are given in the form the
+        # backend stores them. SQLite stores them as text.
+        _time_type = Observation.__table__.c.ObservationTime.type
+        self._store_time = _time_type.dialect_impl(self.engine.dialect).bind_processor(self.engine.dialect)
+
+        if export_directory:
+            self._parquet_exporter = WMParquetExporter(self.engine, error_service, export_directory)
 
-            self.engine = create_engine(f"mariadb+mariadbconnector://{username}:{password}@{url}:{port}/{dbname}")
+    def dispose(self):
+        self.engine.dispose()
 
-            # First, check what tables exist using raw metadata
-            metadata = MetaData()
-            metadata.reflect(bind=self.engine)
-            raw_table_names = list(metadata.tables.keys())
+    # A SQLite database is a local file, so its tables are created when it's first opened rather than by the
+    # DatabaseInitialBuild.sql script. Write-ahead logging lets readers such as WMPresenter query the file
+    # while observations are being saved.
+    @staticmethod
+    def _create_sqlite_engine(database_file_name: str):
 
-            self.base.prepare(self.engine, reflect=True)
+        _engine = create_engine(f"sqlite:///{database_file_name}")
 
-            # Check if an "observations" table exists in reflected tables
-            available_tables = list(self.base.classes.keys())
+        @event.listens_for(_engine, "connect")
+        def _configure_connection(dbapi_connection, connection_record):
+            _cursor = dbapi_connection.cursor()
+            _cursor.execute("PRAGMA journal_mode=WAL")
+            _cursor.execute("PRAGMA synchronous=NORMAL")
+            _cursor.execute("PRAGMA busy_timeout=30000")
+            _cursor.close()
 
-            if not available_tables:
-                # Tables exist, but automap couldn't map them
-                if raw_table_names:
-                    raw_tables_str = ", ".join(raw_table_names)
-                    self._error_service.handle_error(
-                        f"Database {dbname} contains tables ({raw_tables_str}) but SQLAlchemy automap could not reflect them. "
-                        f"This typically means the 'Observations' table is missing a PRIMARY KEY constraint. "
-                        f"Please add a PRIMARY KEY to the Observations table (e.g., ALTER TABLE Observations ADD PRIMARY KEY (ObservationTime);)",
-                        "Error", send_email=True, terminate=True)
-                else:
-                    self._error_service.handle_error(
-                        f"No tables found in database {dbname}. Please ensure the database is initialized with the required schema.",
-                        "Error", send_email=True, terminate=True)
-
-            # Try to find the "observations" table (case-insensitive)
-            observations_table = None
-            for table_name in available_tables:
-                if table_name.lower() == 'observations':
-                    observations_table = table_name
-                    break
-
-            if observations_table is None:
-                available_tables_str = ", ".join(available_tables)
-                self._error_service.handle_error(
-                    f"Table 'observations' not found in database {dbname}. "
-                    f"Available tables: {available_tables_str}. "
-                    f"Please run DatabaseInitialBuild.sql to create the required schema.",
-                    "Error", send_email=True, terminate=True)
-
-            # At this point, observations_table is guaranteed to be a string (not None)
-            assert observations_table is not None, "observations_table should not be None at this point"
-
-            # Use the actual table name from the database
-            self.observations = getattr(self.base.classes, observations_table)
-
-        except sqlalchemy.exc.TimeoutError:
-
-            self._error_service.handle_error(f"Timeout connecting to database {url}:{port}/{dbname}",
-                                             "Error", send_email=True, terminate=True)
+        WMBase.metadata.create_all(_engine)
+        return _engine
+
+    # Creates an INSERT for the table that updates the row already stored with the same key instead of failing.
+    # update_columns is given the columns of the row being inserted and returns the columns to update.
+    def _create_upsert_statement(self, table, key_columns: list[str], update_columns):
+
+        if self._backend == "sqlite":
+            _statement = sqlite.insert(table)
+            return _statement.on_conflict_do_update(index_elements=key_columns,
+                                                    set_=update_columns(_statement.excluded))
+
+        _statement = mysql.insert(table)
+        return _statement.on_duplicate_key_update(update_columns(_statement.inserted))
+
+    # Gets the dates between start_date and end_date inclusive that have fewer than 24 observations stored,
+    # from a single grouped query. Days that have already been downloaded max_download_attempts times without
+    # coming back complete are left out, as Weather Underground doesn't have any more data for them.
+    # Days that are partially stored are only included in upsert mode, where re-saving them is safe.
+    def get_incomplete_observation_dates(self, start_date: date, end_date: date,
+                                         max_download_attempts: int, station_id: str = None) -> list[date]:
+
+        station_id = station_id or self._station_id
+
+        try:
+
+            with self.engine.connect() as connection:
+
+                _observations = select_all_tiers(["ObservationTime"], station_id, start_date,
+                                                 end_date + timedelta(days=1))
+                _observation_date = func.date(_observations.c.ObservationTime)
+                _query = sqlalchemy.select(_observation_date, func.count()) \
+                    .group_by(_observation_date)
+
+                _observation_counts = {as_date(row[0]): row[1] for row in connection.execute(_query)}
+
+                _attempts_query = sqlalchemy.select(self.download_attempts.ObservationDate,
+                                                    self.download_attempts.Attempts) \
+                    .where(self.download_attempts.StationId == station_id,
+                           self.download_attempts.ObservationDate.between(start_date, end_date))
+                _download_attempts = {as_date(row[0]): row[1] for row in connection.execute(_attempts_query)}
 
         except sqlalchemy.exc.DBAPIError as ex:
 
-            self._error_service.handle_error(f"Database access error: {ex}",
+            self._error_service.handle_error(f"Database access error while finding incomplete observation days: {ex}",
                                              "Error", send_email=True, terminate=True)
+            sys.exit(1)
 
-        except AttributeError as ex:
+        _incomplete_dates = []
+        _date_counter = start_date
 
-            self._error_service.handle_error(
-                f"Failed to map database table: {ex}. "
-                f"Please verify the database schema is correctly initialized.",
-                "Error", send_email=True, terminate=True)
+        while _date_counter <= end_date:
 
-    def dispose(self):
-        self.engine.dispose()
+            _observation_count = _observation_counts.get(_date_counter, 0)
+
+            if _observation_count < 24 \
+                    and (_observation_count == 0 or self._write_mode == "upsert") \
+                    and _download_attempts.get(_date_counter, 0) < max_download_attempts:
+                _incomplete_dates.append(_date_counter)
+
+            _date_counter = _date_counter + timedelta(days=1)
+
+        return _incomplete_dates
 
-    # Gets the date of the most recent observation from the "observations" table.
-    # If there are no observations, then the default observation date is returned.
-    def get_most_recent_observation_date(self, default_observation_date: date) -> date:
+    # Records that a day was downloaded but came back with fewer than 24 observations
+    def record_download_attempt(self, observation_date: date, observation_count: int, station_id: str = None):
 
         try:
 
-            session_factory = sqlalchemy.orm.sessionmaker()
-            session_factory.configure(bind=self.engine)
-            session = session_factory()
-            result: datetime = session.query(func.max(self.observations.ObservationTime)).scalar()
-            session.close()
+            with self.engine.connect() as connection:
 
-            if result is None:
-                return default_observation_date
-            else:
-                return result.date()
+                connection.execute(self._create_download_attempt_statement(),
+                                   dict(StationId=station_id or self._station_id,
+                                        ObservationDate=observation_date,
+                                        Attempts=1,
+                                        ObservationCount=observation_count,
+                                        LastAttempt=self._now()))
+                connection.commit()
 
         except sqlalchemy.exc.DBAPIError as ex:
 
-            self._error_service.handle_error(f"Database access error while getting most recent observation date: {ex}",
-                                             "Error", send_email=True, terminate=True)
-            sys.exit(1)
+            self._error_service.handle_error(f"Database access error while recording a download attempt: {ex}",
+                                             "Error", send_email=True, terminate=True, exc_info=ex)
+
+    # Adds a download attempt for a day, or counts another attempt if one is already recorded
+    def _create_download_attempt_statement(self):
+
+        _table = self.download_attempts.__table__
+
+        return self._create_upsert_statement(_table, ["StationId", "ObservationDate"],
+                                             lambda inserted: dict(Attempts=_table.c.Attempts + 1,
+                                                                   ObservationCount=inserted.ObservationCount,
+                                                                   LastAttempt=inserted.LastAttempt))
 
     # Saves observations to the database. Observations are provided as a list of hourly
     # observations for a multiple of days. These need to be reformatted before writing.
-    def save_list_of_observations(self, observations):
+    # The summaries and weather records are brought up to date too, unless update_summaries is False, when the
+    # caller is left to call update_summaries_and_extremes once it has saved a larger range of days.
+    # Days with fewer than 24 observations are logged unless check_daily_counts is False.
+    def save_list_of_observations(self, observations, station_id: str = None, update_summaries: bool = True,
+                                  check_daily_counts: bool = True):
+
+        station_id = station_id or self._station_id
+
+        if self._write_mode == "orm":
+            self._save_observations_with_orm(observations, station_id, update_summaries, check_daily_counts)
+        else:
+            self._save_observations_in_bulk(observations, station_id, check_daily_counts=check_daily_counts,
+                                            update_summaries=update_summaries)
+
+    # Saves observations that may still be revised, such as today's observations so far. Observations that
+    # already exist are always updated in place, whatever the write mode, and days aren't checked for completeness.
+    # As with save_list_of_observations, update_summaries can be False to leave updating the summaries to the caller.
+    def save_recent_observations(self, observations, station_id: str = None, update_summaries: bool = True):
+
+        self._save_observations_in_bulk(observations, station_id or self._station_id,
+                                        upsert=True, check_daily_counts=False, update_summaries=update_summaries)
+
+    # Deletes observations that duplicate another observation for the same station and time, keeping the
+    # earliest saved. Observations saved before the StationId column was added are first assigned to this
+    # service's station. Returns the number of observations deleted.
+    def remove_duplicate_observations(self) -> int:
+
+        try:
+
+            with self.engine.connect() as connection:
+
+                connection.execute(text("UPDATE Observations SET StationId = :station_id WHERE StationId = ''"),
+                                   {"station_id": self._station_id})
+
+                # MariaDB can't delete from a table that a subquery of the DELETE reads, so joins instead
+                if self._backend == "sqlite":
+                    _result = connection.execute(text(
+                        "DELETE FROM Observations "
+                        "WHERE ObservationId NOT IN (SELECT MIN(ObservationId) "
+                        "                            FROM Observations "
+                        "                            GROUP BY StationId, ObservationTime)"))
+                else:
+                    _result = connection.execute(text(
+                        "DELETE o FROM Observations o "
+                        "JOIN (SELECT StationId, ObservationTime, MIN(ObservationId) AS KeepId "
+                        "      FROM Observations "
+                        "      GROUP BY StationId, ObservationTime "
+                        "      HAVING COUNT(*) > 1) d "
+                        "ON o.StationId = d.StationId AND o.ObservationTime = d.ObservationTime "
+                        "WHERE o.ObservationId <> d.KeepId"))
+
+                connection.commit()
+                self._query_service.clear()
+                return _result.rowcount
+
+        except sqlalchemy.exc.DBAPIError as ex:
+
+            self._error_service.handle_error(f"Database access error while removing duplicate observations: {ex}",
+                                             "Error", send_email=True, terminate=True, exc_info=ex)
+
+    # Adds the unique key on station and observation time if the observations table doesn't have it.
+    # Duplicates must be removed first. Returns True if the key was added.
+    def add_observation_key(self) -> bool:
+
+        try:
+
+            _inspector = sqlalchemy.inspect(self.engine)
+            _table_name = self.observations.__table__.name
+            _key_columns = ["StationId", "ObservationTime"]
+
+            for _index in _inspector.get_indexes(_table_name) + _inspector.get_unique_constraints(_table_name):
+                if _index.get("unique", True) and _index["column_names"] == _key_columns:
+                    return False
+
+            # SQLite can't add a constraint to an existing table, but a unique index has the same effect
+            if self._backend == "sqlite":
+                _statement = f"CREATE UNIQUE INDEX UQ_Observations_StationTime ON {_table_name} " \
+                             f"({', '.join(_key_columns)})"
+            else:
+                _statement = f"ALTER TABLE {_table_name} ADD CONSTRAINT UQ_Observations_StationTime " \
+                             f"UNIQUE ({', '.join(_key_columns)})"
+
+            with self.engine.connect() as connection:
+                connection.execute(text(_statement))
+                connection.commit()
+
+            return True
+
+        except sqlalchemy.exc.DBAPIError as ex:
+
+            self._error_service.handle_error(f"Database access error while adding the observation key: {ex}",
+                                             "Error", send_email=True, terminate=True, exc_info=ex)
+
+    # Applies the schema migrations not yet applied to the database. Returns lines reporting what was done,
+    # including query times before and after if any were applied.
+    def migrate_schema(self) -> list[str]:
+
+        return self._migration_service.apply_migrations()
+
+    # Yields (time, measurement, ...) for each hour, or each "day" or "week" bucket, of a station from start_time up
+    # to but not including end_time, with the given columns or every measurement. See WMQueryService.
+    def get_observations(self, station_id: str, start_time, end_time, columns=None, bucket: str = "hour"):
+
+        return self._query_service.get_observations(station_id, start_time, end_time, columns, bucket)
+
+    # The same result as get_observations as a dict of NumPy arrays, one per column
+    def get_observation_arrays(self, station_id: str, start_time, end_time, columns=None,
+                               bucket: str = "hour") -> dict:
+
+        return self._query_service.get_observation_arrays(station_id, start_time, end_time, columns, bucket)
+
+    # Moves observations older than ArchiveAfterDays to the archive table, if it's set, and adds next year's
+    # partition of observations once it's needed. Called at the end of each run that saves observations.
+    # Returns the number moved.
+    def archive_observations(self) -> int:
+
+        self._migration_service.add_next_year_partition()
+        return self._retention_service.archive_observations()
+
+    # Rebuilds the daily, monthly and yearly summaries from every stored observation.
+    # Returns the number of days summarised.
+    def rebuild_summaries(self) -> int:
+
+        return self._summary_service.rebuild_summaries()
+
+    # Rebuilds the weather records from the summaries. Returns the number of records written.
+    def rebuild_extremes(self) -> int:
+
+        return self._extremes_service.rebuild_extremes()
+
+    # Exports the months written since the last export to the Parquet export directory, if there is one
+    def export_observations(self):
+
+        if self._parquet_exporter is None or not self._months_written:
+            return
+
+        _start_time = time.perf_counter()
+        _partitions_written = self._parquet_exporter.export_months(self._months_written)
+        self._months_written = set()
+
+        self._error_service.handle_error(f"Exported {_partitions_written} monthly partitions of observations "
+                                         f"in {time.perf_counter() - _start_time:.2f}s", "Info")
+
+    # Exports every month of observations to the Parquet export directory. Returns the number of partitions written.
+    def export_all_observations(self) -> int:
+
+        if self._parquet_exporter is None:
+            raise ValueError("No export directory has been configured")
+
+        self._months_written = set()
+        return self._parquet_exporter.export_all()
+
+    # Brings the summaries and weather records up to date with observations just saved for a station, and notes
+    # the months to be exported
+    def update_summaries_and_extremes(self, station_id: str, dates_written):
+
+        if not dates_written:
+            return
+
+        with self._metrics.time("summary_update"):
+            self._summary_service.update_summaries(station_id, dates_written)
+            self._extremes_service.update_extremes(station_id, dates_written)
+
+        self._months_written.update((station_id, day.year, day.month) for day in dates_written)
+
+    # Writes observations with multi-row INSERTs, committing every batch_size rows
+    def _save_observations_in_bulk(self, observations, station_id: str, upsert: bool = None,
+                                   check_daily_counts: bool = True, update_summaries: bool = True):
+
+        if upsert is None:
+            upsert = self._write_mode == "upsert"
+
+        _pending_rows = []
+        _rows_written = 0
+        _dates_written = set()
+        _start_time = time.perf_counter()
+
+        try:
+
+            with self.engine.connect() as connection:
+
+                for daily_observation in observations:
+
+                    if daily_observation["observations"]:
+
+                        with self._metrics.time("row_build"):
+                            _pending_rows += [self._create_observation_parameters(hourly_observation, station_id)
+                                              for hourly_observation in daily_observation["observations"]]
+
+                        _dates_written.add(
+                            date.fromisoformat(daily_observation["observations"][-1]["obsTimeLocal"][0:10]))
+
+                        if check_daily_counts:
+                            self._check_daily_observation_count(daily_observation, station_id)
+
+                    if len(_pending_rows) >= self._batch_size:
+                        _rows_written += self._insert_batch(connection, _pending_rows, upsert)
+                        _pending_rows = []
+
+                if _pending_rows:
+                    _rows_written += self._insert_batch(connection, _pending_rows, upsert)
+
+        except sqlalchemy.exc.DBAPIError as ex:
+
+            self._error_service.handle_error(f"Database access error while saving list of observations: {ex}",
+                                             "Error", send_email=True, terminate=True, exc_info=ex)
+
+        self._report_write_rate(_rows_written, time.perf_counter() - _start_time, "upsert" if upsert else "bulk")
+        self._query_service.invalidate(station_id, _dates_written)
+
+        if update_summaries:
+            self.update_summaries_and_extremes(station_id, _dates_written)
+
+    # Validates a batch of parameter tuples, then inserts those that pass with a single executemany by the driver
+    # and quarantines the rest, in one transaction. Returns the number of rows written.
+    def _insert_batch(self, connection, rows, upsert: bool) -> int:
+
+        with self._metrics.time("validation"):
+            _rows, _invalid_rows = self._observation_validator.validate(rows)
+
+        with self._metrics.time("database_write"):
+            if _rows:
+                self._remove_archived_copies(connection, _rows)
+                connection.exec_driver_sql(self._get_insert_sql(upsert), _rows)
+            if _invalid_rows:
+                self._quarantine_observations(connection, _invalid_rows)
+            connection.commit()
+
+        self._metrics.increment("rows_written", len(_rows))
+        return len(_rows)
+
+    # Removes archived copies of rows about to be saved, through a connection or session whose transaction the
+    # caller commits, so that every hour is only in one of the tables. Only rows older than the archive boundary
+    # can have a copy.
+    def _remove_archived_copies(self, connection, rows):
+
+        _archive_before = self._retention_service.archive_before
+
+        if _archive_before is None:
+            return
+
+        _keys = [(row[0], as_datetime(row[1])) for row in rows]
+        self._retention_service.remove_archived_observations(
+            connection, [key for key in _keys if key[1] < _archive_before])
+
+    # The time now on the day given by the date provider, so that the times recorded agree with the days the
+    # downloads are planned for
+    def _now(self) -> datetime:
+
+        return datetime.combine(self._date_time_provider.now(), datetime.now().time())
+
+    # Writes observations that failed validation to the quarantine table with the reasons they failed, through a
+    # connection or session whose transaction the caller commits.
+    # The days they're from are left incomplete, so each counts as a download attempt with the hours that are
+    # missing. That way a day Weather Underground never corrects is only downloaded again MaxDownloadAttempts times.
+    def _quarantine_observations(self, connection, invalid_rows):
+
+        _quarantined_at = self._now()
+        _hours_quarantined = Counter((row[0], as_datetime(row[1]).date()) for row, _ in invalid_rows)
+
+        connection.execute(self._create_download_attempt_statement(),
+                           [dict(StationId=station_id,
+                                 ObservationDate=observation_date,
+                                 Attempts=1,
+                                 ObservationCount=max(0, 24 - hours),
+                                 LastAttempt=_quarantined_at)
+                            for (station_id, observation_date), hours in _hours_quarantined.items()])
+
+        connection.execute(insert(QuarantinedObservation),
+                           [{"StationId": row[0],
+                             "ObservationTime": as_datetime(row[1]),
+                             "Reason": reason[:500],
+                             "ObservationValues": json.dumps(dict(zip(_ROW_COLUMNS[2:], row[2:])), default=str),
+                             "QuarantinedAt": _quarantined_at}
+                            for row, reason in invalid_rows])
+
+        self._metrics.increment("rows_quarantined", len(invalid_rows))
+
+        _first_row, _first_reason = invalid_rows[0]
+        self._error_service.handle_error(f"Quarantined {len(invalid_rows)} observations for {_first_row[0]} that "
+                                         f"failed validation, the first at {as_datetime(_first_row[1])}: "
+                                         f"{_first_reason}",
+                                         "Warning", send_email=True, batch_message=True)
+
+    # SQL of the insert statement with positional parameters in the order of _ROW_COLUMNS, compiled once
+    def _get_insert_sql(self, upsert: bool) -> str:
+
+        if upsert not in self._insert_statements:
+            _compiled = self._create_insert_statement(upsert).compile(dialect=self.engine.dialect,
+                                                                      column_keys=list(_ROW_COLUMNS))
+
+            if tuple(_compiled.positiontup) != _ROW_COLUMNS:
+                raise ValueError(f"Observation insert parameters are out of order: {_compiled.positiontup}")
+
+            self._insert_statements[upsert] = str(_compiled)
+
+        return self._insert_statements[upsert]
+
+    # When upserting, an observation that already exists for the station and time is updated in place,
+    # so re-downloading a date range is safe.
+    def _create_insert_statement(self, upsert: bool):
+
+        _table = self.observations.__table__
+
+        if not upsert:
+            return insert(_table)
+
+        return self._create_upsert_statement(
+            _table, ["StationId", "ObservationTime"],
+            lambda inserted: {column.name: inserted[column.name] for column in _table.columns
+                              if column.name not in ("ObservationId", "StationId", "ObservationTime")})
+
+    # Writes observations by adding an ORM object per hour to a session with a single commit at the end
+    def _save_observations_with_orm(self, observations, station_id: str, update_summaries: bool = True,
+                                    check_daily_counts: bool = True):
+
+        _valid_rows = []
+        _invalid_rows = []
+        _rows_written = 0
+        _dates_written = set()
+        _start_time = time.perf_counter()
 
         try:
 
@@ -126,64 +586,84 @@ class WMDatabaseService(IWMDatabaseService):
 
             for daily_observation in observations:
 
-                _hourly_observation_counter = 0
-
                 if daily_observation["observations"]:
 
-                    _date_of_observations = daily_observation["observations"][0]["obsTimeLocal"][0:10]
+                    with self._metrics.time("row_build"):
+                        _rows = [tuple(self._create_observation_row(hourly_observation, station_id).values())
+                                 for hourly_observation in daily_observation["observations"]]
+
+                    with self._metrics.time("validation"):
+                        _rows, _day_invalid_rows = self._observation_validator.validate(_rows)
 
-                    for hourly_observation in daily_observation["observations"]:
-                        session.add(self._create_formatted_observation(hourly_observation))
-                        _hourly_observation_counter += 1
+                    session.add_all(self.observations(**dict(zip(_ROW_COLUMNS, row))) for row in _rows)
+                    _valid_rows += _rows
+                    _invalid_rows += _day_invalid_rows
+                    _rows_written += len(_rows)
 
-                    if _hourly_observation_counter == 24:
-                        self._error_service.handle_error(f"Observations recorded for {_date_of_observations}",
-                                                         "Info")
-                    else:
-                        self._error_service.handle_error(f"Only {_hourly_observation_counter} "
-                                                         f"observations were recorded for {_date_of_observations}",
-                                                         "Warning", send_email=True, batch_message=True)
+                    _dates_written.add(
+                        date.fromisoformat(daily_observation["observations"][-1]["obsTimeLocal"][0:10]))
+
+                    if check_daily_counts:
+                        self._check_daily_observation_count(daily_observation, station_id)
+
+            with self._metrics.time("database_write"):
+                self._remove_archived_copies(session, _valid_rows)
+                if _invalid_rows:
+                    self._quarantine_observations(session, _invalid_rows)
+                session.commit()
 
-            session.commit()
             session.close()
+            self._metrics.increment("rows_written", _rows_written)
 
         except sqlalchemy.exc.DBAPIError as ex:
 
             self._error_service.handle_error(f"Database access error while saving list of observations: {ex}",
                                              "Error", send_email=True, terminate=True, exc_info=ex)
 
-    # Creates and returns a single SQLAlchemy observation object from an hourly observation
-    # that was returned from Weather Underground.
-    def _create_formatted_observation(self, hourly_observation):
-
-        return self.observations(ObservationTime=hourly_observation["obsTimeLocal"],
-                                 SolarRadiationHigh=hourly_observation["solarRadiationHigh"],
-                                 UvHigh=hourly_observation["uvHigh"],
-                                 WindDirectionMean=hourly_observation["winddirAvg"],
-                                 HumidityHigh=hourly_observation["humidityHigh"],
-                                 HumidityLow=hourly_observation["humidityLow"],
-                                 HumidityMean=hourly_observation["humidityAvg"],
-                                 TemperatureHigh=hourly_observation["metric"]["tempHigh"],
-                                 TemperatureLow=hourly_observation["metric"]["tempLow"],
-                                 TemperatureMean=hourly_observation["metric"]["tempAvg"],
-                                 WindSpeedHigh=hourly_observation["metric"]["windspeedHigh"],
-                                 WindSpeedLow=hourly_observation["metric"]["windspeedLow"],
-                                 WindSpeedMean=hourly_observation["metric"]["windspeedAvg"],
-                                 WindGustHigh=hourly_observation["metric"]["windgustHigh"],
-                                 WindGustLow=hourly_observation["metric"]["windgustLow"],
-                                 WindGustMean=hourly_observation["metric"]["windgustAvg"],
-                                 DewPointHigh=hourly_observation["metric"]["dewptHigh"],
-                                 DewPointLow=hourly_observation["metric"]["dewptLow"],
-                                 DewPointMean=hourly_observation["metric"]["dewptAvg"],
-                                 WindChillHigh=hourly_observation["metric"]["windchillHigh"],
-                                 WindChillLow=hourly_observation["metric"]["windchillLow"],
-                                 WindChillMean=hourly_observation["metric"]["windchillAvg"],
-                                 HeatIndexHigh=hourly_observation["metric"]["heatindexHigh"],
-                                 HeatIndexLow=hourly_observation["metric"]["heatindexLow"],
-                                 HeatIndexMean=hourly_observation["metric"]["heatindexAvg"],
-                                 PressureHigh=hourly_observation["metric"]["pressureMax"],
-                                 PressureLow=hourly_observation["metric"]["pressureMin"],
-                                 PressureTrend=hourly_observation["metric"]["pressureTrend"],
-                                 PrecipitationRate=hourly_observation["metric"]["precipRate"],
-                                 PrecipitationTotal=hourly_observation["metric"]["precipTotal"]
-                                 )
+        self._report_write_rate(_rows_written, time.perf_counter() - _start_time, "orm")
+        self._query_service.invalidate(station_id, _dates_written)
+
+        if update_summaries:
+            self.update_summaries_and_extremes(station_id, _dates_written)
+
+    # Logs whether a full day of 24 hourly observations was received
+    def _check_daily_observation_count(self, daily_observation, station_id: str):
+
+        _date_of_observations = daily_observation["observations"][0]["obsTimeLocal"][0:10]
+        _hourly_observation_counter = len(daily_observation["observations"])
+
+        if _hourly_observation_counter == 24:
+            self._error_service.handle_error(f"Observations recorded for {station_id} on {_date_of_observations}",
+                                             "Info")
+        else:
+            self._error_service.handle_error(f"Only {_hourly_observation_counter} observations were recorded "
+                                             f"for {station_id} on {_date_of_observations}",
+                                             "Warning", send_email=True, batch_message=True)
+
+    def _report_write_rate(self, rows_written: int, elapsed_seconds: float, write_mode: str):
+
+        if rows_written:
+            self._error_service.handle_error(f"Wrote {rows_written} observations in {elapsed_seconds:.2f}s "
+                                             f"({rows_written / max(elapsed_seconds, 1e-6):.0f} rows/sec, "
+                                             f"{write_mode} mode)",
+                                             "Info")
+
+    # Maps an hourly observation returned from Weather Underground straight onto a tuple of insert parameters,
+    # in the order of _ROW_COLUMNS. Much smaller and quicker to build than a dict or ORM object per row.
+    def _create_observation_parameters(self, hourly_observation, station_id: str) -> tuple:
+
+        _observation_time = datetime.fromisoformat(hourly_observation["obsTimeLocal"])
+
+        return (station_id,
+                self._store_time(_observation_time) if self._store_time else _observation_time,
+                *_get_hourly_fields(hourly_observation),
+                *_get_metric_fields(hourly_observation["metric"]))
+
+    # Maps an hourly observation returned from Weather Underground onto the columns of the observations table
+    def _create_observation_row(self, hourly_observation, station_id: str) -> dict:
+
+        return dict(zip(_ROW_COLUMNS,
+                        (station_id,
+                         datetime.fromisoformat(hourly_observation["obsTimeLocal"]),
+                         *_get_hourly_fields(hourly_observation),
+                         *_get_metric_fields(hourly_observation["metric"]))))
@@ -0,0 +1,52 @@
+import argparse
+import configparser
+import os
+import sys
+from WMConfiguration import read_station_ids
+from WMDatabaseService import WMDatabaseService
+from WMErrorService import WMErrorService
+
+
+# One-off tool to collapse duplicate observations in an existing Weather Manager database and then add
+# the unique key on station and observation time, so that later downloads can upsert safely.
+# Run DatabaseUpgradeStationId.sql first on databases built before the StationId column existed.
+# Observations saved before then are assigned to the configured station, or the first of several.
+
+command_line_parser = argparse.ArgumentParser(description="Remove duplicate observations from the database")
+command_line_parser.add_argument("ConfigFile", metavar="configfile", type=str,
+                                 help="Fully qualified name of config file")
+command_line_arguments = command_line_parser.parse_args()
+if not os.path.isfile(command_line_arguments.ConfigFile):
+    print("The supplied configuration file name does not exist")
+    sys.exit()
+
+_config = configparser.ConfigParser(interpolation=None)
+_config.read(command_line_arguments.ConfigFile)
+
+error_service = WMErrorService(_config.get("EMail", "Host"),
+                               _config.get("EMail", "Port"),
+                               _config.get("EMail", "Username"),
+                               _config.get("EMail", "Password"),
+                               _config.get("EMail", "FromAddress"),
+                               _config.get("EMail", "FromName"),
+                               _config.get("EMail", "ToAddress"),
+                               _config.get("EMail", "ToName"))
+
+database_service = WMDatabaseService(_config.get("Database", "IPAddress"),
+                                     _config.get("Database", "Port"),
+                                     _config.get("Database", "UserId"),
+                                     _config.get("Database", "Password"),
+                                     _config.get("Database", "DatabaseName"),
+                                     error_service,
+                                     backend=_config.get("Database", "Backend", fallback="mariadb"),
+                                     station_id=next(iter(read_station_ids(_config)), ""))
+
+_duplicates_removed = database_service.remove_duplicate_observations()
+print(f"Removed {_duplicates_removed} duplicate observations")
+
+if database_service.add_observation_key():
+    print("Added unique key on station and observation time")
+else:
+    print("Unique key on station and observation time already exists")
+
+database_service.dispose()
@@ -1,13 +1,27 @@
+import time
+_process_start_time = time.perf_counter()
+
 import argparse
 import configparser
 import os
+import signal
 import sys
+import threading
 import traceback
+from datetime import date
 from DateTimeProvider import DateTimeProvider
-from MainRoutine import MainRoutine
+from ApiQuotaLedger import ApiQuotaLedger
+from ApiRetryPolicy import ApiRetryPolicy
+from MainRoutine import configure_logging, MainRoutine
+from RateLimiter import RateLimiter
+from RunMetrics import RunMetrics
 from WeatherUndergroundApiService import WeatherUndergroundApiService
+from WMBackfillService import WMBackfillService
+from WMConfiguration import read_station_ids
+from WuResponseCache import WuResponseCache
 from WMDatabaseService import WMDatabaseService
 from WMErrorService import WMErrorService
+from WMObservationImporter import WMObservationImporter
 
 
 # Launches the Weather Manager Downloader
@@ -25,6 +39,29 @@ def _catch_unhandled_exceptions(exception_type, value, trace_back):
 command_line_parser = argparse.ArgumentParser(description="Download observations from Weather Underground")
 command_line_parser.add_argument("ConfigFile", metavar="configfile", type=str,
                                  help="Fully qualified name of config file")
+command_line_parser.add_argument("--replay-cache", dest="ReplayCache", action="store_true",
+                                 help="Rebuild missing observations from the response cache without calling the API")
+command_line_parser.add_argument("--daemon", dest="Daemon", action="store_true",
+                                 help="Keep running, polling Weather Underground for new observations")
+command_line_parser.add_argument("--rebuild-summaries", dest="RebuildSummaries", action="store_true",
+                                 help="Rebuild the daily, monthly and yearly summaries from the observations and exit")
+command_line_parser.add_argument("--rebuild-extremes", dest="RebuildExtremes", action="store_true",
+                                 help="Rebuild the weather records from the summaries and exit")
+command_line_parser.add_argument("--export-parquet", dest="ExportParquet", action="store_true",
+                                 help="Export every month of observations to the Parquet export directory and exit")
+command_line_parser.add_argument("--backfill", dest="Backfill", nargs=2, metavar=("FIRSTDATE", "LASTDATE"),
+                                 type=date.fromisoformat,
+                                 help="Download every station's history between two dates, e.g. 2015-01-01 "
+                                      "2019-12-31, in shards shared with any other backfill of the same database")
+command_line_parser.add_argument("--migrate", dest="Migrate", action="store_true",
+                                 help="Apply any schema migrations not yet applied, report query times before and "
+                                      "after, and exit")
+command_line_parser.add_argument("--import", dest="Import", nargs=2, metavar=("FORMAT", "FILE"),
+                                 help="Import observations from a file exported by a station's software and exit. "
+                                      "FORMAT is wu (JSON Lines of WU history responses), weewx (CSV of the WeeWX "
+                                      "archive table) or ecowitt (Ecowitt CSV export)")
+command_line_parser.add_argument("--station", dest="Station", type=str,
+                                 help="Station to import observations for, if not the first of StationIds")
 command_line_arguments = command_line_parser.parse_args()
 if not os.path.isfile(command_line_arguments.ConfigFile):
     print("The supplied configuration file name does not exist")
@@ -39,8 +76,28 @@ if _config is None:
     input("Press return to continue")
     sys.exit()
 
+# Logging goes to the log file from the start, so that messages logged before the MainRoutine is created, such as the
+# report of schema migrations applied, aren't lost
+configure_logging(_config.get("Downloader", "LogFile"))
+
+# Several stations can be downloaded in one run. Each can have its own initial observation date
+# in an optional [Station <id>] section.
+_station_ids = read_station_ids(_config)
+if not _station_ids:
+    print("No StationId or StationIds in the [WeatherUnderground] section of the configuration file")
+    sys.exit()
+_station_initial_observation_dates = {station_id: _config.get(f"Station {station_id}", "InitialObservationDate",
+                                                              fallback=None)
+                                      for station_id in _station_ids}
+
 # Instance the services for WU Api, database, date and errors
 
+date_time_provider = DateTimeProvider()
+
+# Time spent in each phase of a run is shared by the services and published at the end of each run
+run_metrics = RunMetrics(_config.get("Metrics", "PrometheusFile", fallback=""),
+                         _config.get("Metrics", "SummaryFile", fallback=""))
+
 error_service = WMErrorService(_config.get("EMail", "Host"),
                                _config.get("EMail", "Port"),
                                _config.get("EMail", "Username"),
@@ -55,12 +112,101 @@ database_service = WMDatabaseService(_config.get("Database", "IPAddress"),
                                      _config.get("Database", "UserId"),
                                      _config.get("Database", "Password"),
                                      _config.get("Database", "DatabaseName"),
-                                     error_service)
+                                     error_service,
+                                     _config.get("Database", "WriteMode", fallback="upsert"),
+                                     _config.getint("Database", "BatchSize", fallback=1000),
+                                     _station_ids[0],
+                                     _config.getint("Database", "ExtremesRankDepth", fallback=10),
+                                     _config.get("Export", "Directory", fallback=""),
+                                     run_metrics,
+                                     _config.get("Database", "Backend", fallback="mariadb"),
+                                     _config.getint("Database", "QueryCacheMegabytes", fallback=64) * 2 ** 20,
+                                     _config.getint("Database", "ArchiveAfterDays", fallback=0),
+                                     date_time_provider)
 
-date_time_provider = DateTimeProvider()
+# Schema migrations are applied by whichever run first finds them missing, so every run brings the database up
+# to date before using it
+_migration_report = database_service.migrate_schema()
+if command_line_arguments.Migrate:
+    print("\n".join(_migration_report) if _migration_report else "The schema is up to date")
+    database_service.dispose()
+    sys.exit()
+
+# Summaries and weather records are otherwise kept up to date as observations are saved.
+# Records are ranked from the summaries so rebuilding the summaries rebuilds the records too.
+if command_line_arguments.RebuildSummaries or command_line_arguments.RebuildExtremes:
+    if command_line_arguments.RebuildSummaries:
+        print(f"Summarised {database_service.rebuild_summaries()} days of observations")
+    print(f"Ranked {database_service.rebuild_extremes()} weather records")
+    database_service.dispose()
+    sys.exit()
+
+# Parquet files are otherwise exported for just the months written by each run
+if command_line_arguments.ExportParquet:
+    if not _config.get("Export", "Directory", fallback=""):
+        print("Exporting to Parquet requires an export Directory in the configuration file")
+        sys.exit()
+    print(f"Exported {database_service.export_all_observations()} monthly partitions of observations")
+    database_service.dispose()
+    sys.exit()
+
+# Imported observations are saved just as downloaded ones are, then exported and archived as at the end of a run
+if command_line_arguments.Import:
+    _importer = WMObservationImporter(database_service, error_service, run_metrics)
+    _hours_imported = _importer.import_file(command_line_arguments.Import[1], command_line_arguments.Import[0],
+                                            command_line_arguments.Station or _station_ids[0])
+    database_service.export_observations()
+    database_service.archive_observations()
+    print(f"Imported {_hours_imported} hourly observations")
+    error_service.finalise_error_handling()
+    database_service.dispose()
+    sys.exit()
+
+# Raw API responses are cached on disk if a cache directory is configured
+_cache_directory = _config.get("Cache", "Directory", fallback="")
+response_cache = None
+if _cache_directory:
+    response_cache = WuResponseCache(_cache_directory,
+                                     date_time_provider,
+                                     _config.getfloat("Cache", "MaxSizeMB", fallback=0),
+                                     _config.getint("Cache", "MaxAgeDays", fallback=0))
+elif command_line_arguments.ReplayCache:
+    print("Replaying from the cache requires a cache Directory in the configuration file")
+    sys.exit()
+
+# One rate limiter is shared by all fetch workers so concurrent fetching stays within the WU limits
+_fetch_workers = _config.getint("Downloader", "FetchWorkers", fallback=1)
+api_rate_limiter = RateLimiter(_config.getfloat("Downloader", "MaxRequestsPerSecond", fallback=0),
+                               _config.getfloat("Downloader", "MaxRequestsPerMinute", fallback=0))
 
-wu_underground_api_service = WeatherUndergroundApiService(_config.get("WeatherUnderground", "StationId"),
-                                                          _config.get("WeatherUnderground", "ApiKey"))
+# Every API call is recorded in a persistent ledger so each run is planned from the calls actually left today
+_quota_ledger_file = _config.get("Downloader", "QuotaLedgerFile", fallback="")
+api_quota_ledger = None
+if _quota_ledger_file:
+    api_quota_ledger = ApiQuotaLedger(_quota_ledger_file,
+                                      _config.get("WeatherUnderground", "ApiKey"),
+                                      _config.getint("Downloader", "DailyApiCallLimit", fallback=1500))
+
+# Failed API calls are retried within a budget per run, pausing all calls while WU keeps failing
+api_retry_policy = ApiRetryPolicy(_config.getint("Retry", "MaxAttempts", fallback=4),
+                                  _config.getfloat("Retry", "BaseDelaySeconds", fallback=2),
+                                  _config.getfloat("Retry", "MaxDelaySeconds", fallback=120),
+                                  _config.getint("Retry", "Budget", fallback=20),
+                                  _config.getint("Retry", "BreakerThreshold", fallback=5),
+                                  _config.getfloat("Retry", "BreakerPauseSeconds", fallback=60),
+                                  run_metrics)
+
+wu_underground_api_service = WeatherUndergroundApiService(_station_ids[0],
+                                                          _config.get("WeatherUnderground", "ApiKey"),
+                                                          api_rate_limiter,
+                                                          _fetch_workers,
+                                                          _config.get("WeatherUnderground", "ApiUrl",
+                                                                      fallback=None),
+                                                          response_cache,
+                                                          command_line_arguments.ReplayCache,
+                                                          api_quota_ledger,
+                                                          run_metrics,
+                                                          api_retry_policy)
 
 # Assign function to log unhandled exceptions
 sys.excepthook = _catch_unhandled_exceptions
@@ -71,9 +217,49 @@ main_routine = MainRoutine(database_service,
                            date_time_provider,
                            wu_underground_api_service,
                            error_service,
-                           _config.get("Downloader", "ApiThrottlingLimit"),
+                           _config.get("Downloader", "ApiThrottlingLimit", fallback="0"),
                            _config.get("WeatherUnderground", "InitialObservationDate"),
-                           _config.get("Downloader", "LogFile"))
+                           _config.get("Downloader", "LogFile"),
+                           _fetch_workers,
+                           _config.getint("Downloader", "CheckpointDays", fallback=1),
+                           _config.getint("Downloader", "MaxDownloadAttempts", fallback=3),
+                           command_line_arguments.ReplayCache,
+                           _config.getint("Downloader", "ApiCallReserve", fallback=0),
+                           _station_initial_observation_dates,
+                           run_metrics)
+
+error_service.handle_error(f"WMDownloader started in {(time.perf_counter() - _process_start_time) * 1000:.0f} ms",
+                           "Info")
+
+# Run the MainRoutine, either once, as a daemon until stopped by a signal or to backfill a range of history
+if command_line_arguments.Backfill:
+    _stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signal_number, frame: _stop_event.set())
+    signal.signal(signal.SIGINT, lambda signal_number, frame: _stop_event.set())
+
+    backfill_service = WMBackfillService(database_service.engine,
+                                         error_service,
+                                         _config.getint("Backfill", "LeaseSeconds", fallback=300),
+                                         _config.getint("Backfill", "MaxAttempts", fallback=3))
+    _progress = main_routine.run_backfill(backfill_service,
+                                          command_line_arguments.Backfill[0],
+                                          command_line_arguments.Backfill[1],
+                                          _config.getint("Backfill", "ShardDays", fallback=30),
+                                          _config.getint("Backfill", "Workers", fallback=2),
+                                          _config.getfloat("Backfill", "ProgressIntervalSeconds", fallback=60),
+                                          _stop_event)
+    print(f"Backfill: {_progress['done']['days']} days done, {_progress['pending']['days']} pending, "
+          f"{_progress['claimed']['days']} in progress, {_progress['failed']['days']} to retry, "
+          f"{_progress['abandoned']['days']} abandoned")
+    database_service.dispose()
+elif command_line_arguments.Daemon:
+    _stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signal_number, frame: _stop_event.set())
+    signal.signal(signal.SIGINT, lambda signal_number, frame: _stop_event.set())
+
+    main_routine.run_daemon(_config.getfloat("Daemon", "PollIntervalMinutes", fallback=15) * 60, _stop_event)
+    database_service.dispose()
+else:
+    main_routine.download_recent_observations()
 
-# Run the MainRoutine
-main_routine.download_recent_observations()
+error_service.handle_error(f"WMDownloader finished in {time.perf_counter() - _process_start_time:.2f} s", "Info")
@@ -1,14 +1,14 @@
 import logging
-import smtplib
+import queue
 import sys
-from email.mime.text import MIMEText
-from email.header import Header
-from email.utils import formataddr
+import threading
+import time
 from IWMErrorService import IWMErrorService
 
 
 # Handles WMDownloader errors of whatever severity. Options to perform logging,
 # send e-mail alerts and terminate the program.
+# E-mails are sent by a background dispatcher so that a slow mail server never holds up downloading.
 class WMErrorService(IWMErrorService):
     host = None
     port = None
@@ -19,8 +19,16 @@ class WMErrorService(IWMErrorService):
     to_address = None
     to_name = None
     stored_email_messages: str = None
+    _dispatcher = None
+    _smtp_connection = None
 
-    def __init__(self, host, port, username, password, from_address, from_name, to_address, to_name):
+    # Alerts queued within coalesce_seconds of each other are sent in one e-mail, and an alert identical to one
+    # sent in the last dedup_window_seconds isn't sent again. So that a steady stream of alerts is still sent, an
+    # e-mail is sent once it has been gathering alerts for max_coalesce_seconds or holds max_alerts_per_email
+    # different alerts. finalise_error_handling waits at most flush_timeout_seconds for queued alerts to be sent.
+    def __init__(self, host, port, username, password, from_address, from_name, to_address, to_name,
+                 coalesce_seconds: float = 2, dedup_window_seconds: float = 300, flush_timeout_seconds: float = 30,
+                 max_coalesce_seconds: float = 30, max_alerts_per_email: int = 100):
         self.host = host
         self.port = port
         self.username = username
@@ -29,16 +37,32 @@ class WMErrorService(IWMErrorService):
         self.from_name = from_name
         self.to_address = to_address
         self.to_name = to_name
+        self._coalesce_seconds = coalesce_seconds
+        self._dedup_window_seconds = dedup_window_seconds
+        self._flush_timeout_seconds = flush_timeout_seconds
+        self._max_coalesce_seconds = max_coalesce_seconds
+        self._max_alerts_per_email = max_alerts_per_email
+        self._dispatcher_lock = threading.Lock()
+        self._stored_email_messages_lock = threading.Lock()
 
     # Called at the end of processing to send an e-mail with batched together messages, if any.
+    # Waits a limited time for every queued e-mail to be sent, then closes the mail server connection.
     def finalise_error_handling(self):
 
-        if self.stored_email_messages is not None:
-            self._send_email(self.stored_email_messages)
+        with self._stored_email_messages_lock:
+            _stored_email_messages = self.stored_email_messages
+            self.stored_email_messages = None
+
+        if _stored_email_messages is not None:
+            self._send_email(_stored_email_messages)
+
+        if self._dispatcher is not None and not self._dispatcher.flush(self._flush_timeout_seconds):
+            logging.warning(f"Gave up waiting for e-mail alerts to be sent after {self._flush_timeout_seconds}s")
 
     # Handles error logging, alert e-mail sending and program termination as necessary.
     # If batch_message = true and send_email = True then an e-mail will not be generated.
     # Rather the message will be stored and an email sent only when finalise_error_handling is called.
+    # May be called from any thread, e.g. the workers of a backfill.
     def handle_error(self,
                      message: str,
                      severity: str = 'Warning',
@@ -62,10 +86,11 @@ class WMErrorService(IWMErrorService):
 
         if send_email:
             if batch_message:
-                if self.stored_email_messages is None:
-                    self.stored_email_messages = message
-                else:
-                    self.stored_email_messages = (self.stored_email_messages + "\n" + message)
+                with self._stored_email_messages_lock:
+                    if self.stored_email_messages is None:
+                        self.stored_email_messages = message
+                    else:
+                        self.stored_email_messages = (self.stored_email_messages + "\n" + message)
             else:
                 self._send_email(message)
 
@@ -73,7 +98,27 @@ class WMErrorService(IWMErrorService):
             self.finalise_error_handling()
             sys.exit()
 
+    # Queues an e-mail to be sent by the background dispatcher, which is started by the first e-mail
     def _send_email(self, message):
+
+        with self._dispatcher_lock:
+            if self._dispatcher is None:
+                self._dispatcher = _AlertDispatcher(self._deliver_email, self._close_smtp_connection,
+                                                    self._coalesce_seconds, self._dedup_window_seconds,
+                                                    self._max_coalesce_seconds, self._max_alerts_per_email)
+
+        self._dispatcher.submit(message)
+
+    # Sends an e-mail over the mail server connection, which is kept open between e-mails. A connection the
+    # server has since closed is reopened once. Only called from the dispatcher's thread.
+    def _deliver_email(self, message):
+
+        # Imported here as most runs never send an e-mail
+        import smtplib
+        from email.mime.text import MIMEText
+        from email.header import Header
+        from email.utils import formataddr
+
         # Create message
         msg = MIMEText(message, 'plain', 'utf-8')
         msg['Subject'] = Header("WMDownloader alert", 'utf-8')
@@ -81,14 +126,119 @@ class WMErrorService(IWMErrorService):
         msg['To'] = self.to_address
 
         # Send message
+        for _attempt in range(2):
+            try:
+                if self._smtp_connection is None:
+                    self._smtp_connection = smtplib.SMTP_SSL(self.host, self.port, timeout=30)
+                    self._smtp_connection.login(self.username, self.password)
+
+                self._smtp_connection.sendmail(self.from_address, [self.to_address], msg.as_string())
+                return True
+
+            except smtplib.SMTPServerDisconnected:
+                self._smtp_connection = None
+
+            except (smtplib.SMTPException, OSError):
+                logging.warning(f'Failed to send e-mail message "{message}"', exc_info=True)
+                self._close_smtp_connection()
+                return False
+
+        logging.warning(f'Failed to send e-mail message "{message}", the mail server closed the connection')
+        return False
+
+    def _close_smtp_connection(self):
+
+        if self._smtp_connection is None:
+            return
+
         try:
-            with smtplib.SMTP_SSL(self.host, self.port) as server:
-                server.login(self.username, self.password)
+            self._smtp_connection.quit()
+        except Exception:
+            pass
+
+        self._smtp_connection = None
+
+
+# Asks the dispatcher to send what it has queued straight away, and is set done once that's happened
+class _FlushRequest:
+
+    def __init__(self):
+        self.done = threading.Event()
+
+
+# Sends queued alerts on a background thread. Alerts arriving close together are coalesced into one e-mail, up to
+# a limit of time and of alerts, and repeats of an alert sent recently are suppressed, so a burst of identical
+# failures sends a single e-mail.
+class _AlertDispatcher:
+
+    def __init__(self, deliver, close_connection, coalesce_seconds: float, dedup_window_seconds: float,
+                 max_coalesce_seconds: float, max_alerts_per_email: int):
+
+        self._deliver = deliver
+        self._close_connection = close_connection
+        self._coalesce_seconds = coalesce_seconds
+        self._dedup_window_seconds = dedup_window_seconds
+        self._max_coalesce_seconds = max_coalesce_seconds
+        self._max_alerts_per_email = max(1, max_alerts_per_email)
+        self._queue = queue.Queue()
+        self._last_sent = {}
+
+        threading.Thread(target=self._run, name="AlertDispatcher", daemon=True).start()
+
+    def submit(self, message: str):
+
+        self._queue.put(message)
+
+    # Sends everything queued so far without waiting to coalesce, then closes the connection.
+    # Returns False if that takes longer than timeout_seconds.
+    def flush(self, timeout_seconds: float) -> bool:
+
+        _flush_request = _FlushRequest()
+        self._queue.put(_flush_request)
+        return _flush_request.done.wait(timeout_seconds)
+
+    def _run(self):
+
+        while True:
+            _messages = {}
+            _item = self._queue.get()
+            _send_by = time.monotonic() + self._max_coalesce_seconds
+
+            # Gather whatever else arrives within the coalescing window, up to the limits of one e-mail
+            while _item is not None and not isinstance(_item, _FlushRequest):
+                _messages[_item] = _messages.get(_item, 0) + 1
+                _time_left = _send_by - time.monotonic()
+
+                if _time_left <= 0 or len(_messages) >= self._max_alerts_per_email:
+                    break
+
+                try:
+                    _item = self._queue.get(timeout=min(self._coalesce_seconds, _time_left))
+                except queue.Empty:
+                    _item = None
+
+            self._send(_messages)
+
+            if isinstance(_item, _FlushRequest):
+                self._close_connection()
+                _item.done.set()
+
+    def _send(self, messages: dict):
+
+        _now = time.monotonic()
+        _lines = []
+
+        for message, count in messages.items():
 
-                server.sendmail(self.from_address, [self.to_address], msg.as_string())
-                server.quit()
+            if _now - self._last_sent.get(message, -self._dedup_window_seconds) < self._dedup_window_seconds:
+                logging.info(f'Not e-mailing alert sent in the last {self._dedup_window_seconds:.0f}s: "{message}"')
+                continue
 
-            return True
+            self._last_sent[message] = _now
+            _lines.append(message if count == 1 else f"{message} (repeated {count} times)")
 
-        except (smtplib.SMTPException, TimeoutError):
-            logging.warning(f'Failed to send e-mail message "{message}"', exc_info=True)
+        if _lines:
+            try:
+                self._deliver("\n".join(_lines))
+            except Exception:
+                logging.warning("Unexpected error sending e-mail alert", exc_info=True)
@@ -0,0 +1,226 @@
+import calendar
+import sqlalchemy
+from IWMErrorService import IWMErrorService
+from sqlalchemy import delete, insert, select, tuple_
+from WMSchema import DailySummary, Extreme, MonthlySummary
+
+# Records kept for single days, from the daily summaries: name, summary column and whether the highest or
+# lowest value wins. Each is also kept for every calendar month, e.g. "Hottest day in March".
+_DAILY_RECORDS = [
+    ("Hottest day", "TemperatureHigh", "High"),
+    ("Coldest day", "TemperatureLow", "Low"),
+    ("Wettest day", "PrecipitationTotal", "High"),
+    ("Strongest gust", "WindGustHigh", "High"),
+    ("Highest pressure", "PressureHigh", "High"),
+    ("Lowest pressure", "PressureLow", "Low"),
+]
+
+# Records kept for whole months, from the monthly summaries. Each is also kept for every calendar month by
+# replacing "month" in the name, e.g. "Wettest March". Only months with every day summarised are ranked.
+_MONTHLY_RECORDS = [
+    ("Warmest month", "TemperatureMean", "High"),
+    ("Coldest month", "TemperatureMean", "Low"),
+    ("Wettest month", "PrecipitationTotal", "High"),
+    ("Driest month", "PrecipitationTotal", "Low"),
+]
+
+_MONTH_NAMES = list(calendar.month_name)
+
+
+# Maintains the ranked weather records in the Extremes table. Records are computed with vectorised passes over
+# the daily and monthly summaries. After a full build they're updated incrementally, ranking only the days and
+# months that have just been written against the records already held.
+class WMExtremesService:
+    _engine = None
+    _error_service: IWMErrorService
+    _rank_depth: int = 10
+
+    # rank_depth is the number of places kept for each record
+    def __init__(self, engine, error_service: IWMErrorService, rank_depth: int = 10):
+
+        self._engine = engine
+        self._error_service = error_service
+        self._rank_depth = max(1, int(rank_depth))
+
+    # Re-ranks the records that could include the given days of a station. New first places are reported.
+    def update_extremes(self, station_id: str, dates_written) -> None:
+
+        _dates_written = sorted(set(dates_written))
+
+        if not _dates_written:
+            return
+
+        try:
+
+            with self._engine.connect() as connection:
+                self._update_station_extremes(connection, station_id, _dates_written)
+                connection.commit()
+
+        except sqlalchemy.exc.DBAPIError as ex:
+
+            self._error_service.handle_error(f"Database access error while updating extremes: {ex}",
+                                             "Error", send_email=True, terminate=True, exc_info=ex)
+
+    # Rebuilds every record for every station from the summaries. Returns the number of records written.
+    def rebuild_extremes(self) -> int:
+
+        try:
+
+            with self._engine.connect() as connection:
+                connection.execute(delete(Extreme))
+
+                _station_ids = connection.execute(select(DailySummary.StationId).distinct()).scalars().all()
+                _records_written = 0
+
+                for station_id in _station_ids:
+                    _records = self._rank(self._load_candidates(connection, station_id))
+                    _records_written += self._write_records(connection, station_id, _records)
+
+                connection.commit()
+
+            return _records_written
+
+        except sqlalchemy.exc.DBAPIError as ex:
+
+            self._error_service.handle_error(f"Database access error while rebuilding extremes: {ex}",
+                                             "Error", send_email=True, terminate=True, exc_info=ex)
+
+    def _update_station_extremes(self, connection, station_id: str, dates_written) -> None:
+
+        import pandas as pd
+
+        _months_written = sorted({(day.year, day.month) for day in dates_written})
+        _new_candidates = self._load_candidates(connection, station_id, dates_written, _months_written)
+
+        if _new_candidates.empty:
+            return
+
+        # Only the records that the new days and months could appear in are touched
+        _names = _new_candidates["Name"].unique().tolist()
+        _held = self._load_records(connection, station_id, _names,
+                                   _new_candidates[["Name", "Direction"]].drop_duplicates())
+
+        # A day or month that has been written again replaces its old value. If it held a place it may now
+        # rank lower than a period that isn't loaded, so those records are ranked again from full history.
+        _new_keys = pd.MultiIndex.from_frame(_new_candidates[["Name", "Date"]])
+        _replaced = pd.MultiIndex.from_frame(_held[["Name", "Date"]]).isin(_new_keys)
+        _full_names = _held.loc[_replaced, "Name"].unique()
+
+        _records = self._rank(pd.concat([_held[~_replaced & ~_held["Name"].isin(_full_names)],
+                                         _new_candidates[~_new_candidates["Name"].isin(_full_names)]]))
+
+        if len(_full_names):
+            _history = self._load_candidates(connection, station_id)
+            _records = pd.concat([_records, self._rank(_history[_history["Name"].isin(_full_names)])])
+
+        self._report_new_records(station_id, _held, _records, _new_candidates)
+
+        connection.execute(delete(Extreme).where(Extreme.StationId == station_id, Extreme.Name.in_(_names)))
+        self._write_records(connection, station_id, _records)
+
+    # Loads the values that compete for each record, one row per record name and period, optionally limited
+    # to the given days and months
+    def _load_candidates(self, connection, station_id: str, dates=None, months=None):
+
+        import pandas as pd
+
+        _daily_query = select(DailySummary.SummaryDate.label("Date"),
+                              *[getattr(DailySummary, column) for column in {c for _, c, _ in _DAILY_RECORDS}]) \
+            .where(DailySummary.StationId == station_id)
+        _monthly_query = select(MonthlySummary.SummaryYear, MonthlySummary.SummaryMonth, MonthlySummary.DayCount,
+                                *[getattr(MonthlySummary, column)
+                                  for column in {c for _, c, _ in _MONTHLY_RECORDS}]) \
+            .where(MonthlySummary.StationId == station_id)
+
+        if dates is not None:
+            _daily_query = _daily_query.where(DailySummary.SummaryDate.in_(dates))
+            _monthly_query = _monthly_query.where(
+                tuple_(MonthlySummary.SummaryYear, MonthlySummary.SummaryMonth).in_(months))
+
+        _daily = pd.read_sql(_daily_query, connection)
+        _daily["Date"] = pd.to_datetime(_daily["Date"])
+
+        _monthly = pd.read_sql(_monthly_query, connection)
+        _monthly["Date"] = pd.to_datetime(pd.DataFrame({"year": _monthly["SummaryYear"],
+                                                        "month": _monthly["SummaryMonth"], "day": 1}))
+        _monthly = _monthly[_monthly["DayCount"] == _monthly["Date"].dt.days_in_month]
+
+        _candidates = [self._candidates(_daily, record, False) for record in _DAILY_RECORDS] + \
+                      [self._candidates(_monthly, record, True) for record in _MONTHLY_RECORDS]
+
+        return pd.concat(_candidates, ignore_index=True)
+
+    # Builds the candidates for one record, both over all time and for the calendar month of each period
+    @staticmethod
+    def _candidates(periods, record, monthly: bool):
+
+        import numpy as np
+        import pandas as pd
+
+        _name, _column, _direction = record
+        _periods = periods.loc[periods[_column].notna(), ["Date", _column]].rename(columns={_column: "Value"})
+        _month_names = np.array(_MONTH_NAMES)[_periods["Date"].dt.month.to_numpy()]
+
+        if monthly:
+            _before, _after = _name.split("month")
+            _calendar_names = np.char.add(np.char.add(_before, _month_names), _after)
+        else:
+            _calendar_names = np.char.add(f"{_name} in ", _month_names)
+
+        _overall = _periods.assign(Name=_name)
+        _by_month = _periods.assign(Name=_calendar_names.astype(object))
+
+        return pd.concat([_overall, _by_month], ignore_index=True).assign(Direction=_direction)
+
+    # Keeps the best rank_depth candidates of each record and numbers their places. Ties keep date order.
+    def _rank(self, candidates):
+
+        _sort_key = candidates["Value"].where(candidates["Direction"] == "Low", -candidates["Value"])
+        _ranked = candidates.assign(SortKey=_sort_key) \
+            .sort_values(["Name", "SortKey", "Date"], kind="stable") \
+            .groupby("Name", sort=False).head(self._rank_depth)
+
+        return _ranked.assign(Rank=_ranked.groupby("Name", sort=False).cumcount() + 1) \
+            .drop(columns="SortKey").reset_index(drop=True)
+
+    # Loads the records already held for the given names, in the same shape as the candidates
+    @staticmethod
+    def _load_records(connection, station_id: str, names, directions):
+
+        import pandas as pd
+
+        _held = pd.read_sql(select(Extreme.Name, Extreme.Date, Extreme.Rank, Extreme.HighFloat, Extreme.LowFloat)
+                            .where(Extreme.StationId == station_id, Extreme.Name.in_(names)), connection)
+        _held["Date"] = pd.to_datetime(_held["Date"])
+        _held = _held.merge(directions, on="Name")
+        _held["Value"] = _held["HighFloat"].where(_held["Direction"] == "High", _held["LowFloat"])
+
+        return _held[["Date", "Value", "Name", "Direction", "Rank"]]
+
+    # Reports records whose first place has been taken by one of the days or months just written
+    def _report_new_records(self, station_id: str, held, records, new_candidates) -> None:
+
+        _first_places = records[records["Rank"] == 1].merge(new_candidates[["Name", "Date"]], on=["Name", "Date"])
+        _held_first_places = held.loc[held["Rank"] == 1, ["Name", "Date", "Value"]]
+        _new = _first_places.merge(_held_first_places, on=["Name", "Date", "Value"], how="left", indicator=True)
+        _new = _new[(_new["_merge"] == "left_only") & _new["Name"].isin(_held_first_places["Name"])]
+
+        for name, record_date, value in _new[["Name", "Date", "Value"]].itertuples(index=False):
+            self._error_service.handle_error(f"New record for {station_id}: {name} of {value:g} "
+                                             f"on {record_date.date()}",
+                                             "Info", send_email=True, batch_message=True)
+
+    @staticmethod
+    def _write_records(connection, station_id: str, records) -> int:
+
+        if records.empty:
+            return 0
+
+        _high = records["Direction"] == "High"
+        _rows = records.assign(StationId=station_id,
+                               HighFloat=records["Value"].where(_high, 0.0),
+                               LowFloat=records["Value"].where(~_high, 0.0)) \
+            [["StationId", "Name", "Date", "Rank", "HighFloat", "LowFloat"]]
+
+        connection.execute(insert(Extreme), _rows.to_dict("records"))
+        return len(_rows)
@@ -0,0 +1,90 @@
+import argparse
+import configparser
+import os
+import sys
+import time
+from sqlalchemy import insert, select
+from WMDatabaseService import WMDatabaseService
+from WMErrorService import WMErrorService
+from WMSchema import ArchivedObservation, BackfillShard, DailySummary, DownloadAttempt, Extreme, MonthlySummary, \
+    Observation, QuarantinedObservation, YearlySummary
+
+
+# One-off tool to copy a MariaDB Weather Manager database to a SQLite database file. Every table is copied
+# as it is, keeping observation ids, in batches so memory use doesn't grow with the size of the history.
+# Afterwards set Backend = sqlite and DatabaseName to the file in config.ini to use the copy.
+# The database copied is read with the Backend in config.ini, so a SQLite database can be copied too.
+
+_BATCH_SIZE = 10000
+
+command_line_parser = argparse.ArgumentParser(description="Copy the MariaDB database to a SQLite database file")
+command_line_parser.add_argument("ConfigFile", metavar="configfile", type=str,
+                                 help="Fully qualified name of config file giving the MariaDB database")
+command_line_parser.add_argument("SqliteFile", metavar="sqlitefile", type=str,
+                                 help="Name of the SQLite database file to create")
+command_line_parser.add_argument("--overwrite", action="store_true",
+                                 help="Replace the SQLite database file if it already exists")
+command_line_arguments = command_line_parser.parse_args()
+if not os.path.isfile(command_line_arguments.ConfigFile):
+    print("The supplied configuration file name does not exist")
+    sys.exit()
+
+_config = configparser.ConfigParser(interpolation=None)
+_config.read(command_line_arguments.ConfigFile)
+_source_backend = _config.get("Database", "Backend", fallback="mariadb")
+
+if _source_backend == "sqlite" and os.path.exists(_config.get("Database", "DatabaseName")) and \
+        os.path.exists(command_line_arguments.SqliteFile) and \
+        os.path.samefile(_config.get("Database", "DatabaseName"), command_line_arguments.SqliteFile):
+    print("The SQLite database file to create is the database being copied")
+    sys.exit()
+
+if os.path.exists(command_line_arguments.SqliteFile):
+    if not command_line_arguments.overwrite:
+        print(f"{command_line_arguments.SqliteFile} already exists. Use --overwrite to replace it")
+        sys.exit()
+
+    for _file_name in (command_line_arguments.SqliteFile, f"{command_line_arguments.SqliteFile}-wal",
+                       f"{command_line_arguments.SqliteFile}-shm"):
+        if os.path.exists(_file_name):
+            os.remove(_file_name)
+
+error_service = WMErrorService(_config.get("EMail", "Host"),
+                               _config.get("EMail", "Port"),
+                               _config.get("EMail", "Username"),
+                               _config.get("EMail", "Password"),
+                               _config.get("EMail", "FromAddress"),
+                               _config.get("EMail", "FromName"),
+                               _config.get("EMail", "ToAddress"),
+                               _config.get("EMail", "ToName"))
+
+source_database_service = WMDatabaseService(_config.get("Database", "IPAddress"),
+                                            _config.get("Database", "Port"),
+                                            _config.get("Database", "UserId"),
+                                            _config.get("Database", "Password"),
+                                            _config.get("Database", "DatabaseName"),
+                                            error_service,
+                                            backend=_source_backend)
+
+target_database_service = WMDatabaseService(None, None, None, None, command_line_arguments.SqliteFile,
+                                            error_service, backend="sqlite")
+
+with source_database_service.engine.connect() as source_connection, \
+        target_database_service.engine.connect() as target_connection:
+
+    for _table in (Observation, DownloadAttempt, DailySummary, MonthlySummary, YearlySummary, Extreme,
+                   QuarantinedObservation, BackfillShard, ArchivedObservation):
+
+        _start_time = time.perf_counter()
+        _rows_copied = 0
+        _rows = source_connection.execution_options(yield_per=_BATCH_SIZE).execute(select(_table.__table__))
+
+        for _batch in _rows.mappings().partitions():
+            target_connection.execute(insert(_table.__table__), [dict(row) for row in _batch])
+            target_connection.commit()
+            _rows_copied += len(_batch)
+
+        print(f"Copied {_rows_copied} rows of {_table.__tablename__} in {time.perf_counter() - _start_time:.1f}s")
+
+source_database_service.dispose()
+target_database_service.dispose()
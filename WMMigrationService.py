@@ -0,0 +1,341 @@
+import sqlalchemy.exc
+import time
+from datetime import datetime
+from datetime import timedelta
+from DateTimeProvider import DateTimeProvider
+from IDateTimeProvider import IDateTimeProvider
+from IWMErrorService import IWMErrorService
+from sqlalchemy import delete, func, insert, select, text, update
+from sqlalchemy.schema import CreateIndex, CreateTable
+from WMSchema import ArchivedObservation, BackfillShard, DailySummary, DownloadAttempt, Extreme, MonthlySummary
+from WMSchema import Observation, QuarantinedObservation, SchemaMigration, YearlySummary, as_datetime
+
+# First year given its own partition when Observations is partitioned by year. Earlier observations share one.
+_FIRST_PARTITION_YEAR = 2000
+
+
+# Brings the schema of a Weather Manager database up to date by applying the migrations below in version order,
+# each exactly once per database. Applied versions are recorded in the SchemaMigrations table, which is created
+# if it doesn't exist. Migrations are only ever added to the end of the list, never changed once released.
+# Each migration has the statements to run for each backend, or a method returning them where they depend on the
+# data. An empty list means the migration doesn't apply to the backend, and it's recorded as applied.
+# Every run checks for migrations to apply before doing anything else, so when there are none that check is a single
+# query of SchemaMigrations. Tables added by a migration are created only if missing, as databases built by
+# DatabaseInitialBuild.sql or upgraded by hand may already have them.
+# MariaDB commits each schema change as it's made, so a migration that fails part way is left partly applied, and
+# it's applied again from the start by the next run. Every statement must therefore be safe to run again, or left
+# out by a method that reads what has already been done.
+class WMMigrationService:
+    _date_time_provider: IDateTimeProvider
+    _engine = None
+    _error_service: IWMErrorService
+    _station_id: str = ""
+
+    # station_id is the station whose observations are used for the query timings. The years partitioned are
+    # counted from today as given by date_time_provider.
+    def __init__(self, engine, error_service: IWMErrorService, station_id: str = "",
+                 date_time_provider: IDateTimeProvider = None):
+
+        self._engine = engine
+        self._error_service = error_service
+        self._station_id = station_id
+        self._date_time_provider = date_time_provider if date_time_provider is not None else DateTimeProvider()
+
+    @property
+    def _migrations(self) -> list:
+
+        return [
+            (1, "Add an index on observation time for date range queries across stations",
+             {"mariadb": ["CREATE INDEX IF NOT EXISTS IX_Observations_Time ON Observations (ObservationTime)"],
+              "sqlite": ["CREATE INDEX IF NOT EXISTS IX_Observations_Time ON Observations (ObservationTime)"]}),
+
+            (2, "Add covering indexes for temperature and rainfall over a time window",
+             {"mariadb": _COVERING_INDEXES,
+              "sqlite": _COVERING_INDEXES}),
+
+            (3, "Partition observations by year",
+             {"mariadb": self._partition_observations_by_year,
+              "sqlite": []}),
+
+            (4, "Add the archive table for observations older than ArchiveAfterDays",
+             {"mariadb": _create_tables(ArchivedObservation),
+              "sqlite": _create_tables(ArchivedObservation)}),
+
+            (5, "Add the table of days downloaded with fewer than 24 observations",
+             {"mariadb": _create_tables(DownloadAttempt),
+              "sqlite": _create_tables(DownloadAttempt)}),
+
+            (6, "Add the daily, monthly and yearly summary tables",
+             {"mariadb": _create_tables(DailySummary, MonthlySummary, YearlySummary),
+              "sqlite": _create_tables(DailySummary, MonthlySummary, YearlySummary)}),
+
+            (7, "Let the Extremes table hold records of several stations, including sub-zero temperatures",
+             {"mariadb": self._add_extremes_station,
+              "sqlite": _create_indexes(Extreme)}),
+
+            (8, "Add the table of historical backfill shards",
+             {"mariadb": _create_tables(BackfillShard),
+              "sqlite": _create_tables(BackfillShard)}),
+
+            (9, "Add the table of observations that failed validation",
+             {"mariadb": _create_tables(QuarantinedObservation),
+              "sqlite": _create_tables(QuarantinedObservation)}),
+        ]
+
+    # Applies every migration not yet applied. Query times are measured before and after if any are applied.
+    # Returns lines reporting what was done, which are also logged.
+    def apply_migrations(self) -> list[str]:
+
+        _report = []
+
+        try:
+
+            _recorded = self._read_recorded_migrations()
+            _pending = [migration for migration in self._migrations if migration[0] not in _recorded]
+
+            for version, completed_at in sorted(_recorded.items()):
+                if completed_at is None:
+                    _report.append(f"Migration {version} hasn't completed. If no other process is applying it, "
+                                   f"delete its row from SchemaMigrations so that the next run applies it again")
+
+            if _pending:
+                _times_before = self.time_queries()
+
+                for version, description, statements in _pending:
+                    if not self._apply_migration(version, description, statements.get(self._engine.dialect.name,
+                                                                                       []), _report):
+                        break
+
+                _times_after = self.time_queries()
+
+                for name, seconds in _times_before.items():
+                    _report.append(f"{name}: {seconds * 1000:.1f} ms before, {_times_after[name] * 1000:.1f} ms "
+                                   f"after")
+
+        except sqlalchemy.exc.DBAPIError as ex:
+
+            self._error_service.handle_error(f"Database access error while migrating the schema: {ex}",
+                                             "Error", send_email=True, terminate=True, exc_info=ex)
+
+        for line in _report:
+            self._error_service.handle_error(line, "Info")
+
+        return _report
+
+    # Extremes from before records were kept for several stations have no StationId, and their temperatures can't
+    # go below zero
+    @staticmethod
+    def _add_extremes_station(connection) -> list[str]:
+
+        return ["ALTER TABLE Extremes ADD COLUMN IF NOT EXISTS StationId VARCHAR(20) NOT NULL DEFAULT '' "
+                "AFTER extremeId, MODIFY HighFloat FLOAT NOT NULL DEFAULT 0, "
+                "MODIFY LowFloat FLOAT NOT NULL DEFAULT 0"] + _create_indexes(Extreme)(connection)
+
+    # Splits next year's partition of observations off pFuture once it's needed, on MariaDB databases whose
+    # observations are partitioned by year. pFuture holds no observations until then, so this is quick. It reads
+    # the database catalogue, so it's done at the end of a run rather than in the check for migrations at startup.
+    def add_next_year_partition(self):
+
+        if self._engine.dialect.name != "mariadb":
+            return
+
+        _next_year = self._date_time_provider.now().year + 1
+
+        try:
+
+            with self._engine.connect() as connection:
+
+                _partitions = set(connection.execute(text("SELECT PARTITION_NAME FROM information_schema.PARTITIONS "
+                                                          "WHERE TABLE_SCHEMA = DATABASE() "
+                                                          "AND TABLE_NAME = 'Observations'")).scalars())
+
+                if "pFuture" not in _partitions or f"p{_next_year}" in _partitions:
+                    return
+
+                connection.execute(text(f"ALTER TABLE Observations REORGANIZE PARTITION pFuture INTO ("
+                                        f"PARTITION p{_next_year} VALUES LESS THAN ({_next_year + 1}), "
+                                        f"PARTITION pFuture VALUES LESS THAN MAXVALUE)"))
+                connection.commit()
+
+        except sqlalchemy.exc.DBAPIError as ex:
+
+            self._error_service.handle_error(f"Database access error while adding partition p{_next_year} of "
+                                             f"observations: {ex}", "Error", send_email=True, exc_info=ex)
+            return
+
+        self._error_service.handle_error(f"Added partition p{_next_year} of observations", "Info")
+
+    # Versions recorded in SchemaMigrations and when each completed. SchemaMigrations is read without first looking
+    # it up in the database catalogue, and only created if reading it fails because it doesn't exist yet.
+    def _read_recorded_migrations(self) -> dict:
+
+        _query = select(SchemaMigration.Version, SchemaMigration.CompletedAt)
+
+        with self._engine.connect() as connection:
+
+            try:
+                return {row.Version: row.CompletedAt for row in connection.execute(_query)}
+            except (sqlalchemy.exc.OperationalError, sqlalchemy.exc.ProgrammingError):
+                connection.rollback()
+
+            SchemaMigration.__table__.create(connection, checkfirst=True)
+            connection.commit()
+            return {row.Version: row.CompletedAt for row in connection.execute(_query)}
+
+    # Times the queries the migrations are meant to speed up, taking the best of three runs of each so a cold
+    # cache doesn't count. Returns the seconds taken by each.
+    def time_queries(self) -> dict:
+
+        _timings = {}
+
+        with self._engine.connect() as connection:
+
+            # Any station with observations will do if the configured one has none yet
+            _station_id = self._station_id
+            _latest = connection.execute(select(func.max(Observation.ObservationTime))
+                                         .where(Observation.StationId == _station_id)).scalar()
+
+            if _latest is None:
+                _station_id = connection.execute(select(Observation.StationId).limit(1)).scalar()
+                _latest = connection.execute(select(func.max(Observation.ObservationTime))
+                                             .where(Observation.StationId == _station_id)).scalar()
+
+            if _latest is None:
+                return _timings
+
+            _latest = as_datetime(_latest)
+            _month_ago = _latest - timedelta(days=30)
+            _queries = {
+                "Latest observation of a station":
+                    select(func.max(Observation.ObservationTime)).where(Observation.StationId == _station_id),
+                "Temperatures of a station over 30 days":
+                    select(Observation.ObservationTime, Observation.TemperatureHigh, Observation.TemperatureLow,
+                           Observation.TemperatureMean)
+                    .where(Observation.StationId == _station_id,
+                           Observation.ObservationTime >= _month_ago, Observation.ObservationTime <= _latest),
+                "Rainfall of a station over 30 days":
+                    select(func.date(Observation.ObservationTime), func.max(Observation.PrecipitationTotal))
+                    .where(Observation.StationId == _station_id,
+                           Observation.ObservationTime >= _month_ago, Observation.ObservationTime <= _latest)
+                    .group_by(func.date(Observation.ObservationTime)),
+                "Observations of every station on one day":
+                    select(func.count()).select_from(Observation)
+                    .where(Observation.ObservationTime >= _latest - timedelta(days=1),
+                           Observation.ObservationTime <= _latest),
+            }
+
+            for name, query in _queries.items():
+                _best = None
+
+                for _ in range(3):
+                    _start = time.perf_counter()
+                    connection.execute(query).all()
+                    _elapsed = time.perf_counter() - _start
+                    _best = _elapsed if _best is None else min(_best, _elapsed)
+
+                _timings[name] = _best
+
+        return _timings
+
+    # Applies one migration, first recording it as started. If another process has already recorded it, that
+    # process is applying it and nothing more is done. Returns False if the migration wasn't applied.
+    def _apply_migration(self, version: int, description: str, statements, report: list) -> bool:
+
+        _start = time.perf_counter()
+
+        with self._engine.connect() as connection:
+
+            try:
+                connection.execute(insert(SchemaMigration).values(Version=version, Description=description,
+                                                                  StartedAt=datetime.now()))
+                connection.commit()
+            except sqlalchemy.exc.IntegrityError:
+                report.append(f"Migration {version} is being applied by another process")
+                return False
+
+            try:
+
+                for statement in statements(connection) if callable(statements) else statements:
+                    connection.execute(text(statement))
+                connection.commit()
+
+            except sqlalchemy.exc.DBAPIError as ex:
+
+                # The schema is only ever extended, so downloading can carry on and the migration is tried again
+                # by the next run
+                connection.rollback()
+                connection.execute(delete(SchemaMigration).where(SchemaMigration.Version == version))
+                connection.commit()
+                self._error_service.handle_error(f"Migration {version} ({description}) failed and will be tried "
+                                                 f"again by the next run: {ex}",
+                                                 "Error", send_email=True, exc_info=ex)
+                return False
+
+            _duration = time.perf_counter() - _start
+            connection.execute(update(SchemaMigration).where(SchemaMigration.Version == version)
+                               .values(CompletedAt=datetime.now(), DurationSeconds=_duration))
+            connection.commit()
+
+        report.append(f"Applied migration {version}: {description}"
+                      f"{'' if statements else ', not needed on this backend'} ({_duration:.2f}s)")
+        return True
+
+    # Range partitions Observations on the year of each observation, so that queries over a time window only read
+    # the years they cover and old years can be archived or dropped a partition at a time. MariaDB requires every
+    # unique key to include the partitioning column, so the primary key becomes (ObservationId, ObservationTime).
+    # Years before _FIRST_PARTITION_YEAR share pHistory, each year from then to next year has its own partition and
+    # pFuture catches years not yet given their own. Each change is left out if an earlier attempt has made it.
+    def _partition_observations_by_year(self, connection) -> list[str]:
+
+        _statements = []
+        _primary_key = connection.execute(text("SELECT COLUMN_NAME FROM information_schema.KEY_COLUMN_USAGE "
+                                               "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'Observations' "
+                                               "AND CONSTRAINT_NAME = 'PRIMARY'")).scalars().all()
+        _partition_count = connection.execute(text("SELECT COUNT(PARTITION_NAME) FROM information_schema.PARTITIONS "
+                                                   "WHERE TABLE_SCHEMA = DATABASE() "
+                                                   "AND TABLE_NAME = 'Observations'")).scalar()
+
+        if sorted(_primary_key) != ["ObservationId", "ObservationTime"]:
+            _statements.append("ALTER TABLE Observations DROP PRIMARY KEY, "
+                               "ADD PRIMARY KEY (ObservationId, ObservationTime)")
+
+        if not _partition_count:
+            _partitions = [f"PARTITION pHistory VALUES LESS THAN ({_FIRST_PARTITION_YEAR})"] \
+                + [f"PARTITION p{year} VALUES LESS THAN ({year + 1})"
+                   for year in range(_FIRST_PARTITION_YEAR, self._date_time_provider.now().year + 2)] \
+                + ["PARTITION pFuture VALUES LESS THAN MAXVALUE"]
+            _statements.append(f"ALTER TABLE Observations PARTITION BY RANGE (YEAR(ObservationTime)) "
+                               f"({', '.join(_partitions)})")
+
+        return _statements
+
+
+# Indexes holding every column read by the common queries over a station's time window, so they're answered from
+# the index alone without reading the observation rows
+_COVERING_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS IX_Observations_StationTimeTemperature "
+    "ON Observations (StationId, ObservationTime, TemperatureHigh, TemperatureLow, TemperatureMean)",
+    "CREATE INDEX IF NOT EXISTS IX_Observations_StationTimePrecipitation "
+    "ON Observations (StationId, ObservationTime, PrecipitationRate, PrecipitationTotal)",
+]
+
+
+# Migration statements creating tables from their mappings, which give the storage options of each backend, along
+# with their indexes. SQLite databases already have them, as their tables are created when first used.
+def _create_tables(*models):
+
+    def _statements(connection) -> list[str]:
+        return [str(CreateTable(model.__table__, if_not_exists=True).compile(dialect=connection.dialect))
+                for model in models] + _create_indexes(*models)(connection)
+
+    return _statements
+
+
+# Migration statements creating the indexes of tables given by their mappings, if they don't exist
+def _create_indexes(*models):
+
+    def _statements(connection) -> list[str]:
+        return [str(CreateIndex(index, if_not_exists=True).compile(dialect=connection.dialect))
+                for model in models for index in sorted(model.__table__.indexes, key=lambda index: index.name)]
+
+    return _statements
@@ -0,0 +1,464 @@
+import csv
+import json
+import math
+import time
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+from IWMDatabaseService import IWMDatabaseService
+from IWMErrorService import IWMErrorService
+from RunMetrics import RunMetrics
+
+# Days of observations saved together. Each save commits in batches, so memory use doesn't grow with the size of
+# the file. Summaries and weather records are brought up to date once the whole file is saved.
+_DAYS_PER_SAVE = 31
+
+# Readings of a weather station in the order held by each record read from an export, all in metric units:
+# °C, %, km/h, degrees, hPa, mm, mm/h, W/m² and the UV index. "precipitation" is rain since the previous reading
+# and "daily_precipitation" rain since midnight. Exports give one or the other.
+_FIELDS = ("temperature", "humidity", "dew_point", "wind_speed", "wind_gust", "wind_direction", "pressure",
+           "precipitation_rate", "precipitation", "daily_precipitation", "solar_radiation", "uv", "wind_chill",
+           "heat_index")
+_FIELD_INDEXES = {field: index for index, field in enumerate(_FIELDS)}
+_TEMPERATURE, _HUMIDITY, _DEW_POINT, _WIND_SPEED, _WIND_CHILL, _HEAT_INDEX = \
+    (_FIELD_INDEXES[field] for field in ("temperature", "humidity", "dew_point", "wind_speed", "wind_chill",
+                                         "heat_index"))
+
+_FORMATS = ("wu", "weewx", "ecowitt")
+
+# Kind of unit each field is measured in, for those that exports give in other units
+_FIELD_UNIT_KINDS = {"temperature": "temperature", "dew_point": "temperature", "wind_chill": "temperature",
+                     "heat_index": "temperature", "wind_speed": "speed", "wind_gust": "speed",
+                     "pressure": "pressure", "precipitation_rate": "rain", "precipitation": "rain",
+                     "daily_precipitation": "rain"}
+
+# Conversions to metric from the units used by exports, by lower case unit name. Rain rates per hour are given
+# by their unit of length.
+_TO_METRIC = {"°f": lambda value: (value - 32) * 5 / 9,
+              "mph": lambda value: value * 1.609344,
+              "m/s": lambda value: value * 3.6,
+              "knots": lambda value: value * 1.852,
+              "inhg": lambda value: value * 33.8639,
+              "mmhg": lambda value: value * 1.333224,
+              "in": lambda value: value * 25.4,
+              "cm": lambda value: value * 10}
+
+# WeeWX archive columns and the units of each of its unit systems, given by the usUnits column of each record
+_WEEWX_COLUMNS = {"outTemp": "temperature", "outHumidity": "humidity", "dewpoint": "dew_point",
+                  "windSpeed": "wind_speed", "windGust": "wind_gust", "windDir": "wind_direction",
+                  "barometer": "pressure", "rainRate": "precipitation_rate", "rain": "precipitation",
+                  "radiation": "solar_radiation", "UV": "uv", "windchill": "wind_chill", "heatindex": "heat_index"}
+_WEEWX_UNITS = {1: {"temperature": "°f", "speed": "mph", "pressure": "inhg", "rain": "in"},
+                16: {"temperature": "°c", "speed": "km/h", "pressure": "hpa", "rain": "cm"},
+                17: {"temperature": "°c", "speed": "m/s", "pressure": "hpa", "rain": "mm"}}
+
+# Starts of Ecowitt export column names, in lower case, and their fields. Units are given in brackets after each
+# name, e.g. "Outdoor Temperature(℃)". Relative pressure is used, as that's what Weather Underground reports.
+_ECOWITT_COLUMNS = (("outdoor temperature", "temperature"), ("outdoor humidity", "humidity"),
+                    ("dew point", "dew_point"), ("wind speed", "wind_speed"), ("wind gust", "wind_gust"),
+                    ("wind direction", "wind_direction"), ("rel pressure", "pressure"),
+                    ("relative pressure", "pressure"), ("solar rad", "solar_radiation"), ("uvi", "uv"),
+                    ("uv index", "uv"), ("rain rate", "precipitation_rate"), ("daily rain", "daily_precipitation"))
+
+
+# Imports observations from files exported by a station's console or logging software, so that history already on
+# disk doesn't have to be downloaded from Weather Underground a day at a time. Files are read a line at a time
+# and saved a month at a time, so they can be any size. Formats are:
+#   wu      - JSON Lines of Weather Underground history responses, one response per line, saved as they are
+#   weewx   - CSV of the WeeWX archive table, e.g. from sqlite3 -csv -header weewx.sdb "SELECT * FROM archive"
+#   ecowitt - CSV exported from ecowitt.net or the WS View app
+# Readings from weewx and ecowitt files are combined into hourly observations the way Weather Underground does.
+# Observations are saved through the database service, so they're validated, quarantined, summarised and
+# written in bulk just as downloaded observations are.
+class WMObservationImporter:
+    _database_service: IWMDatabaseService
+    _error_service: IWMErrorService
+    _metrics: RunMetrics
+
+    def __init__(self, database_service: IWMDatabaseService, error_service: IWMErrorService,
+                 metrics: RunMetrics = None):
+
+        self._database_service = database_service
+        self._error_service = error_service
+        self._metrics = metrics if metrics is not None else RunMetrics()
+
+    # Imports a file of the given format for a station. Returns the number of hourly observations saved, before
+    # validation.
+    def import_file(self, file_name: str, file_format: str, station_id: str) -> int:
+
+        if file_format not in _FORMATS:
+            raise ValueError(f"Unknown import format '{file_format}', which should be one of {', '.join(_FORMATS)}")
+
+        _start_time = time.perf_counter()
+        _aggregator = _HourlyAggregator()
+
+        if file_format == "wu":
+            _days = _aggregator.split_into_days(_read_wu_observations(file_name))
+        elif file_format == "weewx":
+            _days = _aggregator.group_into_days(_read_weewx_records(file_name))
+        else:
+            _days = _aggregator.group_into_days(_read_ecowitt_records(file_name))
+
+        _hours_saved = 0
+        _pending_days = []
+        _dates_saved = set()
+
+        for day in _days:
+            _pending_days.append(day)
+
+            if len(_pending_days) >= _DAYS_PER_SAVE:
+                _hours_saved += self._save_days(_pending_days, station_id, file_name, _dates_saved)
+                _pending_days = []
+
+        if _pending_days:
+            _hours_saved += self._save_days(_pending_days, station_id, file_name, _dates_saved)
+
+        self._database_service.update_summaries_and_extremes(station_id, _dates_saved)
+        self._metrics.increment("records_imported", _aggregator.records_read)
+
+        if _aggregator.records_unreadable:
+            self._error_service.handle_error(f"Skipped {_aggregator.records_unreadable} readings in {file_name} "
+                                             f"in units that aren't known", "Warning")
+
+        if _aggregator.records_without_time:
+            self._error_service.handle_error(f"Skipped {_aggregator.records_without_time} readings in {file_name} "
+                                             f"whose times couldn't be read", "Warning")
+
+        if _aggregator.records_out_of_order:
+            self._error_service.handle_error(f"Skipped {_aggregator.records_out_of_order} readings in {file_name} "
+                                             f"that were earlier than the hour before them", "Warning")
+
+        self._error_service.handle_error(f"Imported {_hours_saved} hourly observations of {station_id} from "
+                                         f"{file_name} in {time.perf_counter() - _start_time:.2f}s", "Info")
+
+        return _hours_saved
+
+    # Saves days of observations, leaving the summaries to be updated for all of them at the end, as re-ranking
+    # the weather records after each save would take longer than saving. Adds the dates saved to dates_saved.
+    def _save_days(self, days: list, station_id: str, file_name: str, dates_saved: set) -> int:
+
+        self._match_stored_hours(days, station_id)
+        self._database_service.save_list_of_observations(days, station_id, update_summaries=False,
+                                                         check_daily_counts=False)
+        dates_saved.update(date.fromisoformat(day["observations"][-1]["obsTimeLocal"][0:10]) for day in days)
+
+        _hours = sum(len(day["observations"]) for day in days)
+        self._error_service.handle_error(f"Imported {_hours} hourly observations from {file_name} up to "
+                                         f"{days[-1]['observations'][-1]['obsTimeLocal'][0:10]}", "Info")
+        return _hours
+
+    # Gives observations the times of those already stored for the same station and hour, e.g. downloaded from
+    # Weather Underground, whose times within the hour differ from those of the readings imported. Saving them then
+    # replaces the stored hours rather than adding a second observation for each.
+    def _match_stored_hours(self, days: list, station_id: str):
+
+        _first_day = datetime.fromisoformat(days[0]["observations"][0]["obsTimeLocal"][0:10])
+        _last_day = datetime.fromisoformat(days[-1]["observations"][-1]["obsTimeLocal"][0:10])
+        _stored_times = {stored_time.replace(minute=0, second=0, microsecond=0): stored_time
+                         for stored_time, _ in self._database_service.get_observations(
+                             station_id, _first_day, _last_day + timedelta(days=1), ["TemperatureHigh"])}
+
+        if not _stored_times:
+            return
+
+        for day in days:
+            for observation in day["observations"]:
+                _hour = datetime.fromisoformat(observation["obsTimeLocal"]).replace(minute=0, second=0, microsecond=0)
+                _stored_time = _stored_times.get(_hour)
+
+                if _stored_time is not None:
+                    observation["obsTimeLocal"] = _stored_time.strftime("%Y-%m-%d %H:%M:%S")
+
+
+# Combines readings into hourly observations in the form returned by Weather Underground: the high, low and mean
+# of each reading over the hour, the wind direction averaged as a vector, the highest rain rate and the rain since
+# midnight at the end of the hour. Each observation is timed at the last reading of its hour.
+# Readings must be in time order. Any earlier than the hour being combined are counted and skipped, as are records
+# read without a time or readings as they couldn't be understood.
+class _HourlyAggregator:
+    records_out_of_order: int = 0
+    records_read: int = 0
+    records_unreadable: int = 0
+    records_without_time: int = 0
+
+    def __init__(self):
+
+        self.records_out_of_order = 0
+        self.records_read = 0
+        self.records_unreadable = 0
+        self.records_without_time = 0
+        self._daily_precipitation = 0.0
+        self._day = None
+
+    # Yields days of Weather Underground hourly observations, which are already combined
+    def split_into_days(self, observations):
+
+        _day_observations = []
+
+        for observation in observations:
+            self.records_read += 1
+
+            if _day_observations and observation["obsTimeLocal"][0:10] != _day_observations[-1]["obsTimeLocal"][0:10]:
+                yield {"observations": _day_observations}
+                _day_observations = []
+
+            _day_observations.append(observation)
+
+        if _day_observations:
+            yield {"observations": _day_observations}
+
+    # Yields days of hourly observations from (time, readings) records
+    def group_into_days(self, records):
+
+        _hour = None
+        _hour_records = []
+        _day_observations = []
+
+        for record_time, readings in records:
+            self.records_read += 1
+
+            if record_time is None:
+                self.records_without_time += 1
+                continue
+
+            if readings is None:
+                self.records_unreadable += 1
+                continue
+
+            _record_hour = record_time.replace(minute=0, second=0, microsecond=0)
+
+            if _hour is not None and _record_hour < _hour:
+                self.records_out_of_order += 1
+                continue
+
+            if _record_hour != _hour:
+
+                if _hour_records:
+                    _day_observations.append(self._create_observation(_hour_records))
+
+                    if _record_hour.date() != _hour.date():
+                        yield {"observations": _day_observations}
+                        _day_observations = []
+
+                _hour = _record_hour
+                _hour_records = []
+
+            _hour_records.append((record_time, readings))
+
+        if _hour_records:
+            _day_observations.append(self._create_observation(_hour_records))
+        if _day_observations:
+            yield {"observations": _day_observations}
+
+    def _create_observation(self, hour_records: list) -> dict:
+
+        _last_time = hour_records[-1][0]
+        _columns = list(zip(*(readings for _, readings in hour_records)))
+
+        def _values(field: str) -> list:
+            return [value for value in _columns[_FIELD_INDEXES[field]] if value is not None]
+
+        # Rain since midnight is either given or added up from the rain since each reading
+        if self._day != _last_time.date():
+            self._day = _last_time.date()
+            self._daily_precipitation = 0.0
+
+        _daily_precipitation = _values("daily_precipitation")
+
+        _precipitation = _values("precipitation")
+
+        if _daily_precipitation:
+            self._daily_precipitation = _daily_precipitation[-1]
+        else:
+            self._daily_precipitation += sum(_precipitation)
+
+        # Without rain rates, the rate is the rain that fell in the hour
+        _precipitation_rates = _values("precipitation_rate")
+        _precipitation_rate = _high(_precipitation_rates) if _precipitation_rates or not _precipitation \
+            else round(sum(_precipitation), 2)
+
+        _pressures = _values("pressure")
+        _humidities = _values("humidity")
+        _observation = {"obsTimeLocal": _last_time.strftime("%Y-%m-%d %H:%M:%S"),
+                        "solarRadiationHigh": _high(_values("solar_radiation")),
+                        "uvHigh": _high(_values("uv")),
+                        "winddirAvg": _mean_direction(_values("wind_direction")),
+                        "humidityHigh": None if not _humidities else round(max(_humidities)),
+                        "humidityLow": None if not _humidities else round(min(_humidities)),
+                        "humidityAvg": _mean(_humidities),
+                        "metric": {"pressureMax": _high(_pressures),
+                                   "pressureMin": _low(_pressures),
+                                   "pressureTrend": None if not _pressures else round(_pressures[-1] - _pressures[0],
+                                                                                      2),
+                                   "precipRate": _precipitation_rate,
+                                   "precipTotal": round(self._daily_precipitation, 2)}}
+
+        for field, name in (("temperature", "temp"), ("wind_speed", "windspeed"), ("wind_gust", "windgust"),
+                            ("dew_point", "dewpt"), ("wind_chill", "windchill"), ("heat_index", "heatindex")):
+            _field_values = _values(field)
+            _observation["metric"][f"{name}High"] = _high(_field_values)
+            _observation["metric"][f"{name}Low"] = _low(_field_values)
+            _observation["metric"][f"{name}Avg"] = _mean(_field_values)
+
+        return _observation
+
+
+# Yields the hourly observations in a file of Weather Underground history responses, one response per line
+def _read_wu_observations(file_name: str):
+
+    with open(file_name, encoding="utf-8") as wu_file:
+        for line in wu_file:
+            if line.strip():
+                yield from json.loads(line).get("observations") or []
+
+
+# Yields (time, readings) records from a CSV export of a WeeWX archive. Times are UNIX times, which are converted
+# to this computer's local time, so it should be in the station's time zone. Records whose time can't be read have
+# no time, and those of a unit system that isn't known have no readings.
+def _read_weewx_records(file_name: str):
+
+    with open(file_name, newline="", encoding="utf-8-sig") as weewx_file:
+
+        _reader = csv.reader(weewx_file)
+        _header = next(_reader)
+        _time_index = _header.index("dateTime")
+        _units_index = _header.index("usUnits")
+        _columns = [(index, _FIELD_INDEXES[_WEEWX_COLUMNS[name]], _FIELD_UNIT_KINDS.get(_WEEWX_COLUMNS[name]))
+                    for index, name in enumerate(_header) if name in _WEEWX_COLUMNS]
+        _converters = {unit_system: [(index, field_index, _TO_METRIC.get(units.get(unit_kind)))
+                                     for index, field_index, unit_kind in _columns]
+                       for unit_system, units in _WEEWX_UNITS.items()}
+
+        for row in _reader:
+            try:
+                _row_converters = _converters.get(int(float(row[_units_index])))
+            except (ValueError, IndexError):
+                _row_converters = None
+
+            try:
+                _record_time = datetime.fromtimestamp(float(row[_time_index]))
+            except (ValueError, IndexError, OverflowError, OSError):
+                yield None, None
+                continue
+
+            yield _record_time, \
+                None if _row_converters is None else _complete_readings(_convert_readings(row, _row_converters))
+
+
+# Yields (time, readings) records from an Ecowitt CSV export, whose units are given in its column names. Records
+# whose time can't be read have no time.
+def _read_ecowitt_records(file_name: str):
+
+    with open(file_name, newline="", encoding="utf-8-sig") as ecowitt_file:
+
+        _reader = csv.reader(ecowitt_file)
+        _header = next(_reader)
+        _time_index = [name.strip().lower() for name in _header].index("time")
+        _converters = []
+
+        for index, column_name in enumerate(_header):
+            _name, _, _unit = column_name.strip().lower().partition("(")
+            _unit = _unit.rstrip(")").replace("℃", "°c").replace("℉", "°f").removesuffix("/hr")
+
+            for name_start, field in _ECOWITT_COLUMNS:
+                if _name.startswith(name_start):
+                    _converters.append((index, _FIELD_INDEXES[field], _TO_METRIC.get(_unit)))
+                    break
+
+        for row in _reader:
+
+            try:
+                _record_time = _parse_time(row[_time_index])
+            except (ValueError, IndexError):
+                yield None, None
+                continue
+
+            yield _record_time, _complete_readings(_convert_readings(row, _converters))
+
+
+# Readings in field order from the text values of a row, given (column index, field index, conversion) of each
+# column read. Values that are empty or not numbers, e.g. "--", are missing.
+def _convert_readings(row: list, converters: list) -> list:
+
+    _readings = [None] * len(_FIELDS)
+
+    for index, field_index, to_metric in converters:
+
+        try:
+            _value = float(row[index])
+        except (ValueError, IndexError):
+            continue
+
+        _readings[field_index] = to_metric(_value) if to_metric else _value
+
+    return _readings
+
+
+# Works out the dew point, wind chill and heat index of readings that don't give them, with the formulas
+# Weather Underground uses: Magnus for the dew point, the North American wind chill index and the Rothfusz
+# regression for the heat index. Wind chill and heat index are the temperature outside their ranges. A humidity
+# outside 0 to 100% is left without a dew point, so the validator quarantines its hour rather than the import failing.
+def _complete_readings(readings: list) -> list:
+
+    _temperature = readings[_TEMPERATURE]
+    _humidity = readings[_HUMIDITY]
+
+    if _temperature is None:
+        return readings
+
+    if readings[_DEW_POINT] is None and _humidity is not None and 0 < _humidity <= 100:
+        _gamma = math.log(_humidity / 100) + 17.62 * _temperature / (243.12 + _temperature)
+        readings[_DEW_POINT] = 243.12 * _gamma / (17.62 - _gamma)
+
+    if readings[_WIND_CHILL] is None and readings[_WIND_SPEED] is not None:
+        _wind_speed = readings[_WIND_SPEED]
+        readings[_WIND_CHILL] = _temperature if _temperature > 10 or _wind_speed <= 4.8 else \
+            13.12 + 0.6215 * _temperature - 11.37 * _wind_speed ** 0.16 \
+            + 0.3965 * _temperature * _wind_speed ** 0.16
+
+    if readings[_HEAT_INDEX] is None and _humidity is not None:
+        if _temperature < 26.7:
+            readings[_HEAT_INDEX] = _temperature
+        else:
+            _fahrenheit = _temperature * 9 / 5 + 32
+            _heat_index = -42.379 + 2.04901523 * _fahrenheit + 10.14333127 * _humidity \
+                - 0.22475541 * _fahrenheit * _humidity - 0.00683783 * _fahrenheit ** 2 \
+                - 0.05481717 * _humidity ** 2 + 0.00122874 * _fahrenheit ** 2 * _humidity \
+                + 0.00085282 * _fahrenheit * _humidity ** 2 - 0.00000199 * _fahrenheit ** 2 * _humidity ** 2
+            readings[_HEAT_INDEX] = (_heat_index - 32) * 5 / 9
+
+    return readings
+
+
+# Ecowitt exports times as e.g. 2024-05-01 00:05 or 2024/5/1 0:05
+def _parse_time(value: str) -> datetime:
+
+    try:
+        return datetime.fromisoformat(value.strip())
+    except ValueError:
+        return datetime.strptime(value.strip(), "%Y/%m/%d %H:%M")
+
+
+def _high(values: list):
+    return None if not values else round(max(values), 2)
+
+
+def _low(values: list):
+    return None if not values else round(min(values), 2)
+
+
+def _mean(values: list):
+    return None if not values else round(sum(values) / len(values), 2)
+
+
+# Mean of compass directions as the direction of the sum of their unit vectors, so that 350° and 10° average to
+# 0° rather than 180°
+def _mean_direction(values: list):
+
+    if not values:
+        return None
+
+    _x = sum(math.sin(math.radians(value)) for value in values)
+    _y = sum(math.cos(math.radians(value)) for value in values)
+
+    return round(math.degrees(math.atan2(_x, _y))) % 360
@@ -0,0 +1,116 @@
+import math
+from sqlalchemy import Integer, Numeric, SmallInteger
+from WMSchema import Observation
+
+# Largest magnitude each integer column type holds
+_INTEGER_LIMITS = {SmallInteger: 2 ** 15, Integer: 2 ** 31}
+
+
+# Checks whole batches of observation rows against the rules of the Observations table before they're written:
+# that columns which can't be null have a value, values aren't below a column's CHECK minimum or above the maximum
+# of measurements such as humidity, and they fit the column's precision once rounded to its scale. One bad hour from
+# Weather Underground would otherwise fail the write of the whole batch. The checks are made column by column
+# across the batch with NumPy, so a batch that passes costs about a millisecond per thousand rows.
+class WMObservationValidator:
+    _first_checked: int
+    _maximums: list
+    _minimums: list
+    _names: list
+    _nullable: list
+    _scales: list
+    _upper_limits: list
+
+    # columns gives the names of the values in each row, in order. Columns from first_checked onwards are checked
+    # and must all be numeric.
+    def __init__(self, columns, first_checked: int = 2):
+
+        self._first_checked = first_checked
+        self._names = list(columns[first_checked:])
+        self._nullable = []
+        self._minimums = []
+        self._upper_limits = []
+        self._maximums = []
+        self._scales = []
+
+        for name in self._names:
+            _column = Observation.__table__.c[name]
+            self._nullable.append(_column.nullable)
+            self._minimums.append(_column.info.get("minimum", -math.inf))
+            self._upper_limits.append(_column.info.get("maximum", math.inf))
+
+            # Values are compared in units of the column's scale, e.g. tenths for DECIMAL(3,1), which can hold
+            # up to 999 tenths
+            if isinstance(_column.type, Numeric):
+                self._scales.append(10.0 ** (_column.type.scale or 0))
+                self._maximums.append(10.0 ** _column.type.precision)
+            else:
+                self._scales.append(1.0)
+                self._maximums.append(_INTEGER_LIMITS.get(type(_column.type), math.inf))
+
+    # Splits rows into those that pass and a list of (row, reason) of those that don't
+    def validate(self, rows: list) -> tuple[list, list]:
+
+        # Imported here so that runs which write nothing don't pay for loading NumPy
+        import numpy
+
+        if not rows:
+            return rows, []
+
+        _first = self._first_checked
+
+        # None becomes NaN, and anything that isn't a number is also treated as missing
+        try:
+            _values = numpy.array([row[_first:] for row in rows], dtype=float)
+            _not_numbers = numpy.zeros(_values.shape, dtype=bool)
+        except (TypeError, ValueError):
+            _values = numpy.array([[_as_number(value) for value in row[_first:]] for row in rows], dtype=float)
+            _not_numbers = numpy.array([[value is not None and math.isnan(_as_number(value)) for value in row[_first:]]
+                                        for row in rows], dtype=bool)
+
+        _missing = numpy.isnan(_values) & ~numpy.array(self._nullable) & ~_not_numbers
+        _below_minimum = _values < numpy.array(self._minimums)
+        _above_maximum = _values > numpy.array(self._upper_limits)
+        _too_large = numpy.abs(numpy.rint(_values * numpy.array(self._scales))) >= numpy.array(self._maximums)
+        _failed = _missing | _below_minimum | _above_maximum | _too_large | _not_numbers
+
+        if not _failed.any():
+            return rows, []
+
+        _valid_rows = []
+        _invalid_rows = []
+
+        for row, row_failed, row_missing, row_below_minimum, row_above_maximum, row_not_numbers \
+                in zip(rows, _failed, _missing, _below_minimum, _above_maximum, _not_numbers):
+
+            if not row_failed.any():
+                _valid_rows.append(row)
+                continue
+
+            _reasons = []
+
+            for index in numpy.flatnonzero(row_failed):
+                _name = self._names[index]
+                _value = row[_first + index]
+
+                if row_missing[index]:
+                    _reasons.append(f"{_name} is missing")
+                elif row_not_numbers[index]:
+                    _reasons.append(f"{_name} of {_value!r} isn't a number")
+                elif row_below_minimum[index]:
+                    _reasons.append(f"{_name} of {_value} is below {self._minimums[index]:g}")
+                elif row_above_maximum[index]:
+                    _reasons.append(f"{_name} of {_value} is above {self._upper_limits[index]:g}")
+                else:
+                    _reasons.append(f"{_name} of {_value} is too large for the column")
+
+            _invalid_rows.append((row, "; ".join(_reasons)))
+
+        return _valid_rows, _invalid_rows
+
+
+def _as_number(value) -> float:
+
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
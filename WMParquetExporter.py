@@ -0,0 +1,111 @@
+import os
+import sqlalchemy
+import threading
+from datetime import date
+from IWMErrorService import IWMErrorService
+from sqlalchemy import func, select
+from WMSchema import Observation, as_date, select_all_tiers
+
+# Columns left out of the exported files. The station is given by the partition directory.
+_EXCLUDED_COLUMNS = ("ObservationId", "StationId")
+
+
+# Exports the observations to Parquet files partitioned by station, year and month, e.g.
+# <export directory>/StationId=MYSTN1234/Year=2024/Month=03/Observations.parquet. The layout is the Hive
+# partitioning understood by pyarrow.dataset, pandas.read_parquet, DuckDB and Spark, so years of observations
+# can be scanned column-wise without querying the database. After the first full export only the partitions
+# for months that have been written to are exported again.
+class WMParquetExporter:
+    _compression: str = "zstd"
+    _engine = None
+    _error_service: IWMErrorService
+    _export_directory: str
+
+    def __init__(self, engine, error_service: IWMErrorService, export_directory: str, compression: str = "zstd"):
+
+        self._engine = engine
+        self._error_service = error_service
+        self._export_directory = export_directory
+        self._compression = compression
+
+        os.makedirs(export_directory, exist_ok=True)
+
+    # Exports the partitions for the given (station, year, month) tuples. Returns the number of partitions written.
+    def export_months(self, months) -> int:
+
+        _partitions_written = 0
+
+        try:
+
+            with self._engine.connect() as connection:
+                for station_id, year, month in sorted(set(months)):
+                    _partitions_written += self._export_partition(connection, station_id, year, month)
+
+        except sqlalchemy.exc.DBAPIError as ex:
+
+            self._error_service.handle_error(f"Database access error while exporting observations: {ex}",
+                                             "Error", send_email=True, terminate=True, exc_info=ex)
+
+        return _partitions_written
+
+    # Exports every month of every station's observations. Returns the number of partitions written.
+    def export_all(self) -> int:
+
+        try:
+
+            with self._engine.connect() as connection:
+                _observations = select_all_tiers(["StationId", "ObservationTime"])
+                _station_ranges = connection.execute(
+                    select(_observations.c.StationId, func.min(_observations.c.ObservationTime),
+                           func.max(_observations.c.ObservationTime))
+                    .group_by(_observations.c.StationId)).all()
+
+        except sqlalchemy.exc.DBAPIError as ex:
+
+            self._error_service.handle_error(f"Database access error while exporting observations: {ex}",
+                                             "Error", send_email=True, terminate=True, exc_info=ex)
+
+        _months = []
+
+        for station_id, first_time, last_time in _station_ranges:
+            _first, _last = as_date(first_time), as_date(last_time)
+
+            for month_number in range(_first.year * 12 + _first.month - 1, _last.year * 12 + _last.month):
+                _months.append((station_id, month_number // 12, month_number % 12 + 1))
+
+        return self.export_months(_months)
+
+    # Writes one month of a station's observations to its partition, replacing any earlier export.
+    # A month with no observations has its partition removed. Returns 1 if a partition was written.
+    def _export_partition(self, connection, station_id: str, year: int, month: int) -> int:
+
+        import pandas as pd
+        import pyarrow
+        import pyarrow.parquet
+
+        _first_day = date(year, month, 1)
+        _after_last_day = date(year + month // 12, month % 12 + 1, 1)
+        _columns = [column.name for column in Observation.__table__.columns if column.name not in _EXCLUDED_COLUMNS]
+        _month_observations = select_all_tiers(_columns, station_id, _first_day, _after_last_day)
+
+        _observations = pd.read_sql(select(_month_observations)
+                                    .order_by(_month_observations.c.ObservationTime), connection)
+
+        _file_name = os.path.join(self._export_directory, f"StationId={station_id}", f"Year={year:04d}",
+                                  f"Month={month:02d}", "Observations.parquet")
+
+        if _observations.empty:
+            if os.path.exists(_file_name):
+                os.remove(_file_name)
+            return 0
+
+        _observations["ObservationTime"] = pd.to_datetime(_observations["ObservationTime"])
+        os.makedirs(os.path.dirname(_file_name), exist_ok=True)
+
+        # Write to a temporary file first so a reader never sees a partly written partition
+        _temporary_file_name = f"{_file_name}.{os.getpid()}.{threading.get_ident()}.tmp"
+        pyarrow.parquet.write_table(pyarrow.Table.from_pandas(_observations, preserve_index=False),
+                                    _temporary_file_name, compression=self._compression)
+        os.replace(_temporary_file_name, _file_name)
+
+        return 1
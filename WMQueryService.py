@@ -0,0 +1,276 @@
+import sqlalchemy.exc
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from datetime import timedelta
+from IWMErrorService import IWMErrorService
+from RunMetrics import RunMetrics
+from sqlalchemy import Date, func, select
+from WMSchema import Observation, as_datetime, select_all_tiers
+
+# Columns of measurements that can be queried, in the order of the table's columns
+_MEASUREMENT_COLUMNS = tuple(column.name for column in Observation.__table__.columns
+                             if column.name not in ("ObservationId", "StationId", "ObservationTime"))
+
+_BUCKETS = ("hour", "day", "week")
+
+# Rough size of a cache entry besides its arrays, so that many tiny results can't exceed the budget unseen
+_ENTRY_OVERHEAD_BYTES = 512
+
+
+# How a measurement is combined when observations are downsampled into daily or weekly buckets: "max" for highs,
+# "min" for lows and "mean" for averages. Precipitation totals are accumulated since midnight, so a day's total is
+# its largest and a week's is the sum of its days. Wind directions can't be averaged arithmetically, as the mean of
+# 350° and 10° isn't 180°, so they aren't downsampled.
+def _combine(column_name: str):
+
+    if column_name == "WindDirectionMean":
+        return None
+    if column_name == "PrecipitationTotal":
+        return "total"
+    if column_name.endswith("Low"):
+        return "min"
+    if column_name.endswith("Mean") or column_name == "PressureTrend":
+        return "mean"
+    return "max"
+
+
+# Reads observations of a station over a time range for charts, reports and scripts, either hourly as stored or
+# downsampled into daily or weekly buckets by the database. Results are given as a generator of rows or as NumPy
+# arrays, with each measurement as a float and missing values as None or NaN.
+# Results are kept in a least recently used cache of up to cache_bytes, as NumPy arrays. Cached results are
+# dropped when observations of a day they cover are written through the same WMDatabaseService, so they're never
+# stale within a process. Writes by other processes aren't seen until a cached result is evicted.
+class WMQueryService:
+    _cache: OrderedDict
+    _cache_bytes: int = 0
+    _cached_bytes: int = 0
+    _engine = None
+    _error_service: IWMErrorService
+    _invalidations: int = 0
+    _metrics: RunMetrics
+
+    def __init__(self, engine, error_service: IWMErrorService, cache_bytes: int = 64 * 2 ** 20,
+                 metrics: RunMetrics = None):
+
+        self._engine = engine
+        self._error_service = error_service
+        self._cache_bytes = max(0, int(cache_bytes))
+        self._metrics = metrics if metrics is not None else RunMetrics()
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    # Yields (time, measurement, ...) for each hour or bucket of a station from start_time up to but not including
+    # end_time, where time is the start of the hour or bucket. columns defaults to every measurement that can be
+    # given for the bucket. Rows are streamed from the database unless the result is cached, holding a
+    # connection until the generator is exhausted or closed.
+    def get_observations(self, station_id: str, start_time, end_time, columns=None, bucket: str = "hour"):
+
+        _key = self._create_key(station_id, start_time, end_time, columns, bucket)
+        _cached = self._get_cached(_key)
+
+        if _cached is not None:
+            _times, _values = _cached
+            for observation_time, values in zip(_times.tolist(), _values.tolist()):
+                yield observation_time, *(None if value != value else value for value in values)
+            return
+
+        _invalidations = self._invalidations
+        _rows = []
+        _max_rows = self._max_cached_rows(_key)
+
+        try:
+
+            with self._engine.connect() as connection:
+
+                for row in connection.execution_options(stream_results=True, yield_per=1000) \
+                        .execute(self._create_query(*_key)):
+                    _row = (as_datetime(row[0]), *(None if value is None else float(value) for value in row[1:]))
+
+                    # Rows stop being kept once the result is too large to cache, so streaming it stays in
+                    # constant memory
+                    if _rows is not None:
+                        _rows.append(_row)
+                        if len(_rows) > _max_rows:
+                            _rows = None
+
+                    yield _row
+
+        except sqlalchemy.exc.DBAPIError as ex:
+
+            self._error_service.handle_error(f"Database access error while querying observations: {ex}",
+                                             "Error", send_email=True, terminate=True, exc_info=ex)
+
+        # Only a result read to the end is complete enough to cache
+        if _rows is not None:
+            self._put_cached(_key, _rows, _invalidations)
+
+    # Returns the same result as get_observations as a dict of NumPy arrays: "ObservationTime" of datetime64[s] and
+    # one of floats for each measurement, with NaN where values are missing
+    def get_observation_arrays(self, station_id: str, start_time, end_time, columns=None,
+                               bucket: str = "hour") -> dict:
+
+        _key = self._create_key(station_id, start_time, end_time, columns, bucket)
+        _cached = self._get_cached(_key)
+
+        if _cached is None:
+            _invalidations = self._invalidations
+
+            try:
+
+                with self._engine.connect() as connection:
+                    _rows = connection.execute(self._create_query(*_key)).all()
+
+            except sqlalchemy.exc.DBAPIError as ex:
+
+                self._error_service.handle_error(f"Database access error while querying observations: {ex}",
+                                                 "Error", send_email=True, terminate=True, exc_info=ex)
+
+            _cached = self._put_cached(_key, [(as_datetime(row[0]), *row[1:]) for row in _rows], _invalidations)
+
+        _times, _values = _cached
+        return {"ObservationTime": _times.copy(),
+                **{column: _values[:, index].copy() for index, column in enumerate(_key[4])}}
+
+    # Drops cached results of a station that cover any of the given days, as observations of those days have just
+    # been written
+    def invalidate(self, station_id: str, dates_written):
+
+        _days = [datetime.combine(day, datetime.min.time()) for day in dates_written]
+
+        if not _days:
+            return
+
+        with self._lock:
+            self._invalidations += 1
+
+            for key in [key for key in self._cache
+                        if key[0] == station_id
+                        and any(day < key[2] and key[1] < day + timedelta(days=1) for day in _days)]:
+                self._remove_cached(key)
+
+    # Drops every cached result, for changes to observations that aren't tied to days written
+    def clear(self):
+
+        with self._lock:
+            self._invalidations += 1
+            self._cache.clear()
+            self._cached_bytes = 0
+
+    # Checks the arguments of a query and returns them in the form used as its cache key:
+    # (station_id, start, end, bucket, columns) with the times as datetimes and the columns as a tuple
+    @staticmethod
+    def _create_key(station_id: str, start_time, end_time, columns, bucket: str) -> tuple:
+
+        if bucket not in _BUCKETS:
+            raise ValueError(f"Unknown bucket '{bucket}', which should be one of {', '.join(_BUCKETS)}")
+
+        if columns is None:
+            _columns = tuple(column for column in _MEASUREMENT_COLUMNS if bucket == "hour" or _combine(column))
+        else:
+            _columns = tuple(columns)
+
+        for column in _columns:
+            if column not in _MEASUREMENT_COLUMNS:
+                raise ValueError(f"Unknown observation column '{column}'")
+            if bucket != "hour" and not _combine(column):
+                raise ValueError(f"{column} can't be downsampled")
+
+        return station_id, as_datetime(start_time), as_datetime(end_time), bucket, _columns
+
+    # Observations are read from both the hot and archive tables. Hourly observations are selected as stored.
+    # Buckets are built from a grouping of the hours into days, which is grouped again by bucket, so that weekly
+    # precipitation totals are the sum of the daily totals. Means are carried as sums and counts so that buckets
+    # with missing hours are still weighted correctly.
+    def _create_query(self, station_id: str, start_time: datetime, end_time: datetime, bucket: str, columns: tuple):
+
+        _observations = select_all_tiers(("ObservationTime", *columns), station_id, start_time, end_time)
+
+        if bucket == "hour":
+            return select(_observations).order_by(_observations.c.ObservationTime)
+
+        _observation_date = func.date(_observations.c.ObservationTime, type_=Date)
+        _daily_aggregates = []
+
+        for column in columns:
+            _column = _observations.c[column]
+
+            if _combine(column) == "mean":
+                _daily_aggregates += [func.sum(_column).label(f"{column}Sum"),
+                                      func.count(_column).label(f"{column}Count")]
+            else:
+                _daily_aggregates.append((func.min if _combine(column) == "min" else func.max)(_column).label(column))
+
+        _days = select(_observation_date.label("Day"), *_daily_aggregates) \
+            .group_by(_observation_date).subquery()
+
+        _bucket = _days.c.Day if bucket == "day" else self._week_start(_days.c.Day)
+        _aggregates = []
+
+        for column in columns:
+            _combine_by = _combine(column)
+
+            if _combine_by == "mean":
+                _aggregates.append(func.sum(_days.c[f"{column}Sum"]) * 1.0
+                                   / func.nullif(func.sum(_days.c[f"{column}Count"]), 0))
+            else:
+                _aggregates.append({"max": func.max, "min": func.min, "total": func.sum}[_combine_by]
+                                   (_days.c[column]))
+
+        return select(_bucket.label("BucketStart"), *_aggregates).group_by(_bucket).order_by(_bucket)
+
+    # Monday of the week of a date
+    def _week_start(self, day):
+
+        if self._engine.dialect.name == "sqlite":
+            return func.date(day, "weekday 0", "-6 days", type_=Date)
+        return func.subdate(day, func.weekday(day), type_=Date)
+
+    def _get_cached(self, key: tuple):
+
+        with self._lock:
+            _cached = self._cache.get(key)
+
+            if _cached is not None:
+                self._cache.move_to_end(key)
+                self._metrics.increment("query_cache_hits")
+                return _cached[0]
+
+        return None
+
+    # Most rows of a result that fit in the cache, at 8 bytes for the time and for each measurement as in _put_cached
+    def _max_cached_rows(self, key: tuple) -> int:
+
+        return max(0, self._cache_bytes - _ENTRY_OVERHEAD_BYTES) // (8 * (1 + len(key[4])))
+
+    # Converts rows of (time, measurement, ...) to arrays and caches them, unless observations have been written
+    # since the query started, as the result may then be stale. Returns the arrays.
+    def _put_cached(self, key: tuple, rows: list, invalidations: int) -> tuple:
+
+        # Imported here so that runs which never query don't pay for loading NumPy
+        import numpy
+
+        _times = numpy.array([row[0] for row in rows], dtype="datetime64[s]")
+        _values = numpy.array([row[1:] for row in rows], dtype=float).reshape(len(rows), len(key[4]))
+        _bytes = _times.nbytes + _values.nbytes + _ENTRY_OVERHEAD_BYTES
+
+        with self._lock:
+
+            if invalidations == self._invalidations and _bytes <= self._cache_bytes:
+
+                if key in self._cache:
+                    self._remove_cached(key)
+
+                self._cache[key] = ((_times, _values), _bytes)
+                self._cached_bytes += _bytes
+
+                while self._cached_bytes > self._cache_bytes:
+                    self._remove_cached(next(iter(self._cache)))
+
+        return _times, _values
+
+    # Called holding the lock
+    def _remove_cached(self, key: tuple):
+
+        _, _bytes = self._cache.pop(key)
+        self._cached_bytes -= _bytes
@@ -0,0 +1,120 @@
+import sqlalchemy.exc
+import time
+from datetime import datetime
+from datetime import timedelta
+from DateTimeProvider import DateTimeProvider
+from IDateTimeProvider import IDateTimeProvider
+from IWMErrorService import IWMErrorService
+from RunMetrics import RunMetrics
+from sqlalchemy import bindparam, delete, func, insert, select
+from WMSchema import ArchivedObservation, Observation, as_datetime
+
+# Columns copied to the archive, all but ObservationId
+_ARCHIVED_COLUMNS = [column.name for column in ArchivedObservation.__table__.columns]
+
+
+# Keeps the Observations table small by moving hourly observations older than archive_after_days into the
+# ArchivedObservations table, which is stored compressed. Queries read both tables through select_all_tiers, so
+# moving observations changes no results, and summaries and weather records are unaffected.
+# Observations are moved a month of a station at a time, each in one transaction, so a run that's stopped part way
+# leaves every observation in exactly one table and the next run carries on.
+class WMRetentionService:
+    _archive_after_days: int = 0
+    _date_time_provider: IDateTimeProvider
+    _engine = None
+    _error_service: IWMErrorService
+    _metrics: RunMetrics
+
+    # Nothing is archived if archive_after_days is 0. Ages are counted back from today as given by
+    # date_time_provider.
+    def __init__(self, engine, error_service: IWMErrorService, archive_after_days: int = 0,
+                 metrics: RunMetrics = None, date_time_provider: IDateTimeProvider = None):
+
+        self._engine = engine
+        self._error_service = error_service
+        self._archive_after_days = max(0, int(archive_after_days))
+        self._metrics = metrics if metrics is not None else RunMetrics()
+        self._date_time_provider = date_time_provider if date_time_provider is not None else DateTimeProvider()
+
+    # Observations from before this time belong in the archive, or None if nothing is archived
+    @property
+    def archive_before(self):
+
+        if not self._archive_after_days:
+            return None
+        return datetime.combine(self._date_time_provider.now() - timedelta(days=self._archive_after_days),
+                                datetime.min.time())
+
+    # Moves every observation older than archive_after_days to the archive. Returns the number moved.
+    def archive_observations(self) -> int:
+
+        _archive_before = self.archive_before
+
+        if _archive_before is None:
+            return 0
+
+        _start_time = time.perf_counter()
+        _rows_archived = 0
+
+        try:
+
+            with self._engine.connect() as connection:
+
+                _oldest_by_station = connection.execute(select(Observation.StationId,
+                                                               func.min(Observation.ObservationTime))
+                                                        .where(Observation.ObservationTime < _archive_before)
+                                                        .group_by(Observation.StationId)).all()
+
+                for station_id, oldest_time in _oldest_by_station:
+                    _month_start = as_datetime(oldest_time).replace(day=1, hour=0, minute=0, second=0,
+                                                                    microsecond=0)
+
+                    while _month_start < _archive_before:
+                        _month_end = min((_month_start + timedelta(days=32)).replace(day=1), _archive_before)
+                        _rows_archived += self._archive_range(connection, station_id, _month_start, _month_end)
+                        _month_start = _month_end
+
+        except sqlalchemy.exc.DBAPIError as ex:
+
+            self._error_service.handle_error(f"Database access error while archiving observations: {ex}",
+                                             "Error", send_email=True, terminate=True, exc_info=ex)
+
+        if _rows_archived:
+            self._metrics.increment("rows_archived", _rows_archived)
+            self._error_service.handle_error(f"Archived {_rows_archived} observations from before "
+                                             f"{_archive_before.date()} in {time.perf_counter() - _start_time:.2f}s",
+                                             "Info")
+
+        return _rows_archived
+
+    # Removes archived copies of observations that are being saved to Observations again, e.g. when an old day is
+    # downloaded again, through a connection or session whose transaction the caller commits. rows are
+    # (StationId, ObservationTime) pairs. The next archive run moves them back.
+    @staticmethod
+    def remove_archived_observations(connection, rows):
+
+        if rows:
+            _table = ArchivedObservation.__table__
+            connection.execute(delete(_table)
+                               .where(_table.c.StationId == bindparam("archived_station_id"),
+                                      _table.c.ObservationTime == bindparam("archived_time")),
+                               [{"archived_station_id": station_id, "archived_time": observation_time}
+                                for station_id, observation_time in rows])
+
+    # Copies a station's observations from start_time up to end_time to the archive and deletes them from
+    # Observations in one transaction. Returns the number moved.
+    @staticmethod
+    def _archive_range(connection, station_id: str, start_time: datetime, end_time: datetime) -> int:
+
+        _in_range = (Observation.StationId == station_id,
+                     Observation.ObservationTime >= start_time,
+                     Observation.ObservationTime < end_time)
+
+        connection.execute(insert(ArchivedObservation)
+                           .from_select(_ARCHIVED_COLUMNS,
+                                        select(*(getattr(Observation, column) for column in _ARCHIVED_COLUMNS))
+                                        .where(*_in_range)))
+        _rows_moved = connection.execute(delete(Observation).where(*_in_range)).rowcount
+        connection.commit()
+
+        return _rows_moved
@@ -0,0 +1,237 @@
+# Declarative mapping of the Weather Manager database tables. Must be kept in step with DatabaseInitialBuild.sql.
+# Mapping the tables here rather than reflecting them means no schema queries are made at startup.
+
+from datetime import date
+from datetime import datetime
+from sqlalchemy import Date, DateTime, Float, Index, Integer, Numeric, SmallInteger, String, Text, UniqueConstraint
+from sqlalchemy import select, union_all
+from sqlalchemy.orm import DeclarativeBase, mapped_column
+
+
+class WMBase(DeclarativeBase):
+    pass
+
+
+# Decimal columns are returned as floats. A minimum mirrors a CHECK constraint in DatabaseInitialBuild.sql and is
+# kept in the column's info for WMObservationValidator, as is a maximum for measurements that can't go above one.
+def _decimal(precision: int, scale: int = 0, nullable: bool = False, minimum: float = None, maximum: float = None):
+    return mapped_column(Numeric(precision, scale, asdecimal=False), nullable=nullable,
+                         info={name: limit for name, limit in (("minimum", minimum), ("maximum", maximum))
+                               if limit is not None})
+
+
+# Measurements of each hourly observation, held by both the hot and archive tables of observations
+class _ObservationMeasures:
+    SolarRadiationHigh = _decimal(5, 1, minimum=0)
+    UvHigh = _decimal(4, 1, minimum=0)
+    WindDirectionMean = _decimal(3, minimum=0)
+    # Humidities are percentages. The whole number ones are TINYINT columns, which couldn't hold more than 127.
+    HumidityHigh = mapped_column(SmallInteger, nullable=False, info={"minimum": 0, "maximum": 100})
+    HumidityLow = mapped_column(SmallInteger, nullable=False, info={"minimum": 0, "maximum": 100})
+    HumidityMean = _decimal(4, 1, minimum=0, maximum=100)
+    TemperatureHigh = _decimal(3, 1)
+    TemperatureLow = _decimal(3, 1)
+    TemperatureMean = _decimal(3, 1)
+    WindSpeedHigh = _decimal(4, 1)
+    WindSpeedLow = _decimal(4, 1)
+    WindSpeedMean = _decimal(4, 1)
+    WindGustHigh = _decimal(4, 1)
+    WindGustLow = _decimal(4, 1)
+    WindGustMean = _decimal(4, 1)
+    DewPointHigh = _decimal(3, 1)
+    DewPointLow = _decimal(3, 1)
+    DewPointMean = _decimal(3, 1)
+    WindChillHigh = _decimal(3, 1)
+    WindChillLow = _decimal(3, 1)
+    WindChillMean = _decimal(3, 1)
+    HeatIndexHigh = _decimal(3, 1)
+    HeatIndexLow = _decimal(3, 1)
+    HeatIndexMean = _decimal(3, 1)
+    PressureHigh = _decimal(6, 2, minimum=0)
+    PressureLow = _decimal(6, 2, minimum=0)
+    PressureTrend = _decimal(4, 2, nullable=True)
+    PrecipitationRate = _decimal(5, 2, minimum=0)
+    PrecipitationTotal = _decimal(5, 2, minimum=0)
+
+
+class Observation(_ObservationMeasures, WMBase):
+    __tablename__ = "Observations"
+    __table_args__ = (UniqueConstraint("StationId", "ObservationTime", name="UQ_Observations_StationTime"),)
+
+    ObservationId = mapped_column(Integer, primary_key=True, autoincrement=True)
+    StationId = mapped_column(String(20), nullable=False, default="")
+    ObservationTime = mapped_column(DateTime, nullable=False)
+
+
+# Hourly observations moved out of Observations by WMRetentionService once they're older than ArchiveAfterDays.
+# An hour is only ever in one of the two tables, so reading both with select_all_tiers gives every observation.
+# MariaDB stores the rows compressed. SQLite has no compressed tables, so the table is stored WITHOUT ROWID,
+# clustered on its key, which saves the ObservationId column and the index on station and time.
+class ArchivedObservation(_ObservationMeasures, WMBase):
+    __tablename__ = "ArchivedObservations"
+    __table_args__ = {"mariadb_row_format": "COMPRESSED", "sqlite_with_rowid": False}
+
+    StationId = mapped_column(String(20), primary_key=True)
+    ObservationTime = mapped_column(DateTime, primary_key=True)
+
+
+# Selects the named columns of observations from both the hot and archive tables as one subquery, limited to a
+# station and to times from start_time up to but not including end_time where given. The limits are applied to
+# each table so that both are read through their index on station and time.
+def select_all_tiers(column_names, station_id: str = None, start_time=None, end_time=None):
+
+    _selects = []
+
+    for table in (Observation, ArchivedObservation):
+        _criteria = []
+
+        if station_id is not None:
+            _criteria.append(table.StationId == station_id)
+        if start_time is not None:
+            _criteria.append(table.ObservationTime >= start_time)
+        if end_time is not None:
+            _criteria.append(table.ObservationTime < end_time)
+
+        _selects.append(select(*(getattr(table, column_name) for column_name in column_names)).where(*_criteria))
+
+    return union_all(*_selects).subquery("AllObservations")
+
+
+class DownloadAttempt(WMBase):
+    __tablename__ = "DownloadAttempts"
+
+    StationId = mapped_column(String(20), primary_key=True)
+    ObservationDate = mapped_column(Date, primary_key=True)
+    Attempts = mapped_column(Integer, nullable=False, default=0)
+    ObservationCount = mapped_column(SmallInteger, nullable=False, default=0)
+    LastAttempt = mapped_column(DateTime, nullable=False)
+
+
+# Measures held by each of the daily, monthly and yearly summaries of the observations
+class _SummaryMeasures:
+    ObservationCount = mapped_column(Integer, nullable=False)
+    TemperatureHigh = mapped_column(Float)
+    TemperatureLow = mapped_column(Float)
+    TemperatureMean = mapped_column(Float)
+    DewPointHigh = mapped_column(Float)
+    DewPointLow = mapped_column(Float)
+    DewPointMean = mapped_column(Float)
+    HumidityHigh = mapped_column(Float)
+    HumidityLow = mapped_column(Float)
+    HumidityMean = mapped_column(Float)
+    PressureHigh = mapped_column(Float)
+    PressureLow = mapped_column(Float)
+    WindSpeedHigh = mapped_column(Float)
+    WindSpeedMean = mapped_column(Float)
+    WindGustHigh = mapped_column(Float)
+    SolarRadiationHigh = mapped_column(Float)
+    UvHigh = mapped_column(Float)
+    PrecipitationRateHigh = mapped_column(Float)
+    PrecipitationTotal = mapped_column(Float)
+
+
+class DailySummary(_SummaryMeasures, WMBase):
+    __tablename__ = "DailySummaries"
+
+    StationId = mapped_column(String(20), primary_key=True)
+    SummaryDate = mapped_column(Date, primary_key=True)
+
+
+class MonthlySummary(_SummaryMeasures, WMBase):
+    __tablename__ = "MonthlySummaries"
+
+    StationId = mapped_column(String(20), primary_key=True)
+    SummaryYear = mapped_column(SmallInteger, primary_key=True)
+    SummaryMonth = mapped_column(SmallInteger, primary_key=True)
+    DayCount = mapped_column(SmallInteger, nullable=False)
+
+
+class YearlySummary(_SummaryMeasures, WMBase):
+    __tablename__ = "YearlySummaries"
+
+    StationId = mapped_column(String(20), primary_key=True)
+    SummaryYear = mapped_column(SmallInteger, primary_key=True)
+    DayCount = mapped_column(SmallInteger, nullable=False)
+
+
+# Ranked weather records such as the hottest day or the wettest March. The value of a record where the highest
+# value wins is held in HighFloat and one where the lowest wins in LowFloat.
+class Extreme(WMBase):
+    __tablename__ = "Extremes"
+    __table_args__ = (Index("IX_Extremes_StationName", "StationId", "Name"),)
+
+    extremeId = mapped_column(Integer, primary_key=True, autoincrement=True)
+    StationId = mapped_column(String(20), nullable=False, default="")
+    Name = mapped_column(String(50), nullable=False)
+    Date = mapped_column(DateTime, nullable=False)
+    Rank = mapped_column(SmallInteger, nullable=False, default=0)
+    HighInt = mapped_column(Integer, nullable=False, default=0)
+    LowInt = mapped_column(Integer, nullable=False, default=0)
+    HighFloat = mapped_column(Float, nullable=False, default=0)
+    LowFloat = mapped_column(Float, nullable=False, default=0)
+
+
+# Observations that failed validation against the rules of the Observations table, kept with the reason so they
+# can be looked at and corrected rather than failing the batch they came in. ObservationValues is the row as JSON.
+class QuarantinedObservation(WMBase):
+    __tablename__ = "QuarantinedObservations"
+    __table_args__ = (Index("IX_QuarantinedObservations_StationTime", "StationId", "ObservationTime"),)
+
+    QuarantineId = mapped_column(Integer, primary_key=True, autoincrement=True)
+    StationId = mapped_column(String(20), nullable=False)
+    ObservationTime = mapped_column(DateTime, nullable=False)
+    Reason = mapped_column(String(500), nullable=False)
+    ObservationValues = mapped_column(Text, nullable=False)
+    QuarantinedAt = mapped_column(DateTime, nullable=False)
+
+
+# Shards of a historical backfill, each a range of days of one station. Workers claim a shard by taking out a
+# lease on it, which they renew while working on it, so a shard whose worker has died can be claimed by another.
+class BackfillShard(WMBase):
+    __tablename__ = "BackfillShards"
+    __table_args__ = (UniqueConstraint("StationId", "FirstDate", name="UQ_BackfillShards_StationFirstDate"),
+                      Index("IX_BackfillShards_Status", "Status", "LeaseExpires"))
+
+    ShardId = mapped_column(Integer, primary_key=True, autoincrement=True)
+    StationId = mapped_column(String(20), nullable=False)
+    FirstDate = mapped_column(Date, nullable=False)
+    LastDate = mapped_column(Date, nullable=False)
+    Status = mapped_column(String(10), nullable=False, default="pending")
+    Attempts = mapped_column(Integer, nullable=False, default=0)
+    LeaseOwner = mapped_column(String(100))
+    LeaseExpires = mapped_column(DateTime)
+    DaysSaved = mapped_column(Integer, nullable=False, default=0)
+    LastError = mapped_column(String(500))
+    CompletedAt = mapped_column(DateTime)
+
+
+# Schema changes applied to the database by WMMigrationService, one row per migration version. A row is added
+# before its migration starts, so only one process applies each migration, and is completed once it has finished.
+class SchemaMigration(WMBase):
+    __tablename__ = "SchemaMigrations"
+
+    Version = mapped_column(Integer, primary_key=True, autoincrement=False)
+    Description = mapped_column(String(200), nullable=False)
+    StartedAt = mapped_column(DateTime, nullable=False)
+    CompletedAt = mapped_column(DateTime)
+    DurationSeconds = mapped_column(Float)
+
+
+# Database drivers return times and dates either as they're stored or, from SQLite and from aggregates such as
+# MAX() and DATE(), as ISO format strings
+def as_datetime(value) -> datetime:
+
+    if isinstance(value, datetime):
+        return value
+    if isinstance(value, date):
+        return datetime.combine(value, datetime.min.time())
+    return datetime.fromisoformat(str(value))
+
+
+def as_date(value) -> date:
+
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return date.fromisoformat(str(value)[0:10])
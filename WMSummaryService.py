@@ -0,0 +1,221 @@
+import sqlalchemy
+from datetime import date
+from datetime import timedelta
+from IWMErrorService import IWMErrorService
+from sqlalchemy import delete, func, insert, select, tuple_
+from WMSchema import DailySummary, MonthlySummary, YearlySummary, as_date, select_all_tiers
+
+# Measures summarised and how each is combined: "max" for highs, "min" for lows, "mean" for averages weighted
+# by observation count and "sum" for totals. Daily precipitation totals come from the maximum of the hourly
+# observations, as Weather Underground reports precipitation accumulated since midnight.
+_MEASURES = {
+    "TemperatureHigh": ("TemperatureHigh", "max"),
+    "TemperatureLow": ("TemperatureLow", "min"),
+    "TemperatureMean": ("TemperatureMean", "mean"),
+    "DewPointHigh": ("DewPointHigh", "max"),
+    "DewPointLow": ("DewPointLow", "min"),
+    "DewPointMean": ("DewPointMean", "mean"),
+    "HumidityHigh": ("HumidityHigh", "max"),
+    "HumidityLow": ("HumidityLow", "min"),
+    "HumidityMean": ("HumidityMean", "mean"),
+    "PressureHigh": ("PressureHigh", "max"),
+    "PressureLow": ("PressureLow", "min"),
+    "WindSpeedHigh": ("WindSpeedHigh", "max"),
+    "WindSpeedMean": ("WindSpeedMean", "mean"),
+    "WindGustHigh": ("WindGustHigh", "max"),
+    "SolarRadiationHigh": ("SolarRadiationHigh", "max"),
+    "UvHigh": ("UvHigh", "max"),
+    "PrecipitationRateHigh": ("PrecipitationRate", "max"),
+    "PrecipitationTotal": ("PrecipitationTotal", "sum"),
+}
+
+
+# Maintains the daily, monthly and yearly summaries of the observations so that analysis doesn't need to scan
+# the hourly observations. Summaries are updated for just the days that have been written, and can be
+# rebuilt from scratch.
+class WMSummaryService:
+    _engine = None
+    _error_service: IWMErrorService
+
+    def __init__(self, engine, error_service: IWMErrorService):
+
+        self._engine = engine
+        self._error_service = error_service
+
+    # Recalculates the daily summaries for the given days of a station, then the monthly and yearly summaries
+    # that include them
+    def update_summaries(self, station_id: str, dates_written) -> None:
+
+        _dates_written = sorted(set(dates_written))
+
+        if not _dates_written:
+            return
+
+        try:
+
+            with self._engine.connect() as connection:
+                self._update_daily_summaries(connection, station_id, _dates_written)
+                self._update_monthly_summaries(connection, station_id,
+                                               {(day.year, day.month) for day in _dates_written})
+                self._update_yearly_summaries(connection, station_id, {day.year for day in _dates_written})
+                connection.commit()
+
+        except sqlalchemy.exc.DBAPIError as ex:
+
+            self._error_service.handle_error(f"Database access error while updating summaries: {ex}",
+                                             "Error", send_email=True, terminate=True, exc_info=ex)
+
+    # Rebuilds every summary for every station from the observations. Returns the number of days summarised.
+    def rebuild_summaries(self) -> int:
+
+        try:
+
+            with self._engine.connect() as connection:
+                for summary in (DailySummary, MonthlySummary, YearlySummary):
+                    connection.execute(delete(summary))
+
+                _all_observations = select_all_tiers(["StationId"])
+                _station_ids = connection.execute(select(_all_observations.c.StationId).distinct()).scalars().all()
+                _days_summarised = 0
+
+                for station_id in _station_ids:
+                    _days_summarised += self._update_daily_summaries(connection, station_id, None)
+
+                    _months = connection.execute(
+                        select(DailySummary.SummaryDate).where(DailySummary.StationId == station_id)).scalars()
+                    _months = {(as_date(day).year, as_date(day).month) for day in _months}
+
+                    self._update_monthly_summaries(connection, station_id, _months)
+                    self._update_yearly_summaries(connection, station_id, {year for year, _ in _months})
+
+                connection.commit()
+
+            return _days_summarised
+
+        except sqlalchemy.exc.DBAPIError as ex:
+
+            self._error_service.handle_error(f"Database access error while rebuilding summaries: {ex}",
+                                             "Error", send_email=True, terminate=True, exc_info=ex)
+
+    # Replaces the daily summaries of the given days, or of every day if dates is None, with a grouped query
+    # over the observations. Returns the number of days summarised.
+    @staticmethod
+    def _update_daily_summaries(connection, station_id: str, dates) -> int:
+
+        _observation_columns = ["ObservationTime", *dict.fromkeys(column for column, _ in _MEASURES.values())]
+
+        if dates is None:
+            _observations = select_all_tiers(_observation_columns, station_id)
+        else:
+            _observations = select_all_tiers(_observation_columns, station_id, dates[0],
+                                             dates[-1] + timedelta(days=1))
+
+        _observation_date = func.date(_observations.c.ObservationTime)
+        _aggregates = [func.count().label("ObservationCount")]
+
+        for summary_column, (observation_column, combine) in _MEASURES.items():
+            _column = _observations.c[observation_column]
+            _aggregate = {"max": func.max, "min": func.min, "mean": func.avg, "sum": func.max}[combine]
+            _aggregates.append(_aggregate(_column).label(summary_column))
+
+        _query = select(_observation_date, *_aggregates).group_by(_observation_date)
+
+        if dates is not None:
+            _query = _query.where(_observation_date.in_(dates))
+            connection.execute(delete(DailySummary).where(DailySummary.StationId == station_id,
+                                                          DailySummary.SummaryDate.in_(dates)))
+
+        _rows = []
+
+        for row in connection.execute(_query):
+            _summary = dict(row._mapping)
+            _summary["SummaryDate"] = as_date(_summary.pop(next(iter(_summary))))
+            _summary["StationId"] = station_id
+            _rows.append(_summary)
+
+        if _rows:
+            connection.execute(insert(DailySummary), _rows)
+
+        return len(_rows)
+
+    # Replaces the monthly summaries of the given (year, month) pairs by combining their daily summaries
+    @staticmethod
+    def _update_monthly_summaries(connection, station_id: str, months) -> None:
+
+        if not months:
+            return
+
+        _first_day = date(*min(months), 1)
+        _last_year, _last_month = max(months)
+        _after_last_day = date(_last_year + _last_month // 12, _last_month % 12 + 1, 1)
+
+        _daily_summaries = connection.execute(
+            select(DailySummary).where(DailySummary.StationId == station_id,
+                                       DailySummary.SummaryDate >= _first_day,
+                                       DailySummary.SummaryDate < _after_last_day))
+
+        _grouped = {}
+        for row in _daily_summaries.mappings():
+            _day = as_date(row["SummaryDate"])
+            if (_day.year, _day.month) in months:
+                _grouped.setdefault((_day.year, _day.month), []).append(row)
+
+        connection.execute(delete(MonthlySummary).where(
+            MonthlySummary.StationId == station_id,
+            tuple_(MonthlySummary.SummaryYear, MonthlySummary.SummaryMonth).in_(list(months))))
+
+        _rows = [dict(_combine_summaries(summaries), StationId=station_id, SummaryYear=year, SummaryMonth=month)
+                 for (year, month), summaries in _grouped.items()]
+
+        if _rows:
+            connection.execute(insert(MonthlySummary), _rows)
+
+    # Replaces the yearly summaries of the given years by combining their monthly summaries
+    @staticmethod
+    def _update_yearly_summaries(connection, station_id: str, years) -> None:
+
+        if not years:
+            return
+
+        _monthly_summaries = connection.execute(
+            select(MonthlySummary).where(MonthlySummary.StationId == station_id,
+                                         MonthlySummary.SummaryYear.in_(list(years))))
+
+        _grouped = {}
+        for row in _monthly_summaries.mappings():
+            _grouped.setdefault(row["SummaryYear"], []).append(row)
+
+        connection.execute(delete(YearlySummary).where(YearlySummary.StationId == station_id,
+                                                       YearlySummary.SummaryYear.in_(list(years))))
+
+        _rows = [dict(_combine_summaries(summaries), StationId=station_id, SummaryYear=year)
+                 for year, summaries in _grouped.items()]
+
+        if _rows:
+            connection.execute(insert(YearlySummary), _rows)
+
+
+# Combines daily or monthly summaries into the summary of a longer period
+def _combine_summaries(summaries) -> dict:
+
+    _observation_count = sum(summary["ObservationCount"] for summary in summaries)
+    _combined = {"ObservationCount": _observation_count,
+                 "DayCount": sum(summary.get("DayCount", 1) for summary in summaries)}
+
+    for summary_column, (_, combine) in _MEASURES.items():
+        _values = [(summary[summary_column], summary["ObservationCount"]) for summary in summaries
+                   if summary[summary_column] is not None]
+
+        if not _values:
+            _combined[summary_column] = None
+        elif combine == "max":
+            _combined[summary_column] = max(value for value, _ in _values)
+        elif combine == "min":
+            _combined[summary_column] = min(value for value, _ in _values)
+        elif combine == "sum":
+            _combined[summary_column] = sum(value for value, _ in _values)
+        else:
+            _combined[summary_column] = sum(value * count for value, count in _values) / \
+                sum(count for _, count in _values)
+
+    return _combined
@@ -1,57 +1,222 @@
-import requests
+import time
+from ApiQuotaLedger import ApiQuotaLedger
+from ApiRetryPolicy import ApiRetryPolicy, parse_retry_after, RETRYABLE_STATUSES
 from datetime import date
 from IWeatherUndergroundApiService import IWeatherUndergroundApiService
-from requests.adapters import HTTPAdapter, Retry
+from RateLimiter import RateLimiter
+from RunMetrics import RunMetrics
 from WuApiException import WuApiException
+from WuApiUnavailableException import WuApiUnavailableException
+from WuResponseCache import WuResponseCache
+
+# orjson decodes the response bytes several times faster than the standard library, so it's used where installed
+try:
+    from orjson import loads as _decode_json
+except ImportError:
+    from json import loads as _decode_json
+
+# Seconds to wait to connect and then for each read of a response, so that a connection that hangs is retried
+_REQUEST_TIMEOUT_SECONDS = (10, 60)
 
 
 # Service to handle retrieval of observations from the Weather Underground API.
 class WeatherUndergroundApiService(IWeatherUndergroundApiService):
     _api_key = ""
     _api_session = None
+    _connection_pool_size = 10
+    _metrics: RunMetrics = None
+    _offline = False
+    _quota_ledger: ApiQuotaLedger = None
+    _rate_limiter: RateLimiter = None
+    _response_cache: WuResponseCache = None
+    _retry_policy: ApiRetryPolicy = None
     _station_id = ""
     _weather_underground_url = "https://api.weather.com/v2/pws/history/"
 
-    def __init__(self, station_id, api_key):
+    def __init__(self, station_id, api_key,
+                 rate_limiter: RateLimiter = None,
+                 connection_pool_size: int = 10,
+                 api_url: str = None,
+                 response_cache: WuResponseCache = None,
+                 offline: bool = False,
+                 quota_ledger: ApiQuotaLedger = None,
+                 metrics: RunMetrics = None,
+                 retry_policy: ApiRetryPolicy = None):
         self.__validate_constructor_parameters(station_id, api_key)
 
         self._api_key = api_key
         self._station_id = station_id
+        self._rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+        self._connection_pool_size = connection_pool_size
+
+        # The API url can be overridden, e.g. to point at a local stub server for testing
+        if api_url:
+            self._weather_underground_url = api_url
+
+        # When offline, observations are only replayed from the response cache and the API is never called
+        if offline and response_cache is None:
+            raise WuApiException("Offline replay requires a response cache")
+
+        self._response_cache = response_cache
+        self._offline = offline
+        self._quota_ledger = quota_ledger
+        self._metrics = metrics if metrics is not None else RunMetrics()
+        self._retry_policy = retry_policy if retry_policy is not None else ApiRetryPolicy(metrics=self._metrics)
+
+    # Retrieves a full set of observations for a specific date, for the given station or by default
+    # the station the service was created for.
+    # Safe to call from several threads at once; calls are paced by the shared rate limiter.
+    # The response cache, if there is one, is checked before going to the network.
+    def get_hourly_observations_for_date(self, date_required: date, station_id: str = None):
 
-    # Retrieves a full set of observations for a specific date.
-    def get_hourly_observations_for_date(self, date_required: date):
+        station_id = station_id or self._station_id
+
+        if self._response_cache is not None:
+            _cached_response = self._response_cache.get(station_id, date_required)
+
+            if _cached_response is not None:
+                self._metrics.increment("cache_hits")
+
+                with self._metrics.time("json_decode"):
+                    return _decode_json(_cached_response)
+
+            if self._offline:
+                return None
 
         # Configure the api call
         _api_url = "{}hourly?stationId={}&format=json&units=m&numericPrecision=decimal&date={}&apiKey={}" \
             .format(self._weather_underground_url,
-                    self._station_id,
+                    station_id,
                     date_required.strftime("%Y%m%d"),
                     self._api_key)
 
-        # Make the api call and check response
-        _api_response = self._api_session.get(_api_url)
+        _api_response = self._call_api(_api_url)
 
         match _api_response.status_code:
-            case requests.codes.ok:
-                return _api_response.json()
+            case 200:  # OK
+                with self._metrics.time("json_decode"):
+                    _retrieved_observations = _decode_json(_api_response.content)
+
+                if self._response_cache is not None and _retrieved_observations.get("observations"):
+                    self._response_cache.put(station_id, date_required, _api_response.content)
+
+                return _retrieved_observations
             case 204:  # No content
                 return None
             case _:
+                # Errors that retrying wouldn't fix, such as an invalid API key
                 raise WuApiException("Weather Underground API returned {} '{}'".format(_api_response.status_code,
                                                                                        _api_response.reason))
 
-    # Prepares the Weather Underground API for querying
+    # Number of calls left in the rolling 24 hour window, or None if calls aren't being recorded
+    def get_remaining_api_calls(self):
+
+        if self._quota_ledger is None:
+            return None
+
+        return self._quota_ledger.remaining_calls()
+
+    # Retries left in this run's retry budget
+    def get_remaining_retries(self):
+
+        return self._retry_policy.remaining_retries
+
+    # Starts a new retry budget, e.g. when a daemon starts its day's catching up
+    def reset_retry_budget(self):
+
+        self._retry_policy.reset_budget()
+
+    # Prepares the Weather Underground API for querying. The connection pool is sized so that
+    # each concurrent fetch worker can hold its own connection. Each session starts a new retry budget.
+    # Failed calls are retried by the retry policy rather than by urllib3, so every retry is paced, recorded in the
+    # quota ledger and counted against the budget.
     def start_wu_api_session(self):
 
+        # Imported here so that runs which never call the API don't pay for loading requests
+        import requests
+        from requests.adapters import HTTPAdapter
+
         self._api_session = requests.session()
-        _retry_data = Retry(total=3, backoff_factor=1, status_forcelist=[502, 503, 504])
-        self._api_session.mount("https://", HTTPAdapter(max_retries=_retry_data))
+        _adapter = HTTPAdapter(pool_maxsize=self._connection_pool_size, max_retries=0)
+        self._api_session.mount("https://", _adapter)
+        self._api_session.mount("http://", _adapter)
+        self._retry_policy.reset_budget()
 
-    # Closes the Weather Underground API session
+    # Closes the Weather Underground API session and trims the response cache
     def stop_wu_api_session(self):
 
         self._api_session.close()
 
+        if self._response_cache is not None:
+            self._response_cache.evict()
+
+    # Makes an API call, retrying it as the retry policy allows while WU is throttling calls, failing or can't be
+    # reached. Returns the response, which may be an error that retrying wouldn't fix.
+    def _call_api(self, api_url: str):
+
+        _attempt = 0
+
+        while True:
+            _attempt += 1
+
+            # Calls wait here while the circuit breaker is open
+            if not self._retry_policy.before_call(retry=_attempt > 1):
+                self._metrics.increment("api_calls_given_up")
+                raise WuApiUnavailableException("Weather Underground API calls are failing and the retry budget for "
+                                                "this run is spent")
+
+            # Every call made is recorded in the quota ledger. No call is made once the daily limit is reached.
+            if self._quota_ledger is not None and not self._quota_ledger.try_reserve_call():
+                self._retry_policy.abandon_call()
+                raise WuApiException("Daily Weather Underground API call limit reached")
+
+            self._rate_limiter.acquire()
+            _api_response = None
+
+            try:
+
+                with self._metrics.time("http_request"):
+                    _api_response = self._api_session.get(api_url, timeout=_REQUEST_TIMEOUT_SECONDS)
+
+                _failure = f"returned {_api_response.status_code} '{_api_response.reason}'"
+
+            except OSError as ex:
+
+                _failure = f"couldn't be reached: {ex}"
+
+            except BaseException:
+
+                self._retry_policy.abandon_call()
+                raise
+
+            self._metrics.increment("http_requests")
+
+            if _attempt > 1:
+                self._metrics.increment("http_retries")
+
+            if _api_response is not None and _api_response.status_code not in RETRYABLE_STATUSES:
+                self._retry_policy.record_success()
+                return _api_response
+
+            self._metrics.increment("http_failures")
+            _retry_after = None
+
+            if _api_response is not None:
+                _retry_after = parse_retry_after(_api_response.headers.get("Retry-After"))
+
+                if _api_response.status_code == 429:
+                    self._metrics.increment("http_throttled")
+
+            _delay = self._retry_policy.record_failure(_attempt, _retry_after)
+
+            if _delay is None:
+                self._metrics.increment("api_calls_given_up")
+                raise WuApiUnavailableException(f"Weather Underground API {_failure}, given up on attempt "
+                                                f"{_attempt}")
+
+            with self._metrics.time("retry_wait"):
+                time.sleep(_delay)
+
     @staticmethod
     def __validate_constructor_parameters(station_id, api_key):
         if not station_id and not station_id.isspace():
@@ -0,0 +1,7 @@
+from WuApiException import WuApiException
+
+
+# Exception raised in the Weather Underground Api service when the API is throttling calls or unavailable and
+# retrying has been given up for this run. Days not downloaded are downloaded by a later run.
+class WuApiUnavailableException(WuApiException):
+    pass
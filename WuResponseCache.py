@@ -0,0 +1,119 @@
+import gzip
+import hashlib
+import os
+import threading
+import time
+from datetime import date
+from datetime import timedelta
+from IDateTimeProvider import IDateTimeProvider
+
+
+# On-disk cache of raw Weather Underground responses, one gzip compressed JSON blob per station and date.
+# Only days older than the two-day settle window are cached. Once cached they're never rewritten, so the
+# cache can be used to rebuild the database without making any API calls.
+# Blobs are stored alongside a SHA-256 of their content which is checked on every read.
+class WuResponseCache:
+    _cache_directory: str
+    _date_time_provider: IDateTimeProvider
+    _max_age_days: int = 0
+    _max_size_bytes: int = 0
+
+    # A max_size_mb or max_age_days of zero means that limit is not applied
+    def __init__(self, cache_directory: str, date_time_provider: IDateTimeProvider,
+                 max_size_mb: float = 0, max_age_days: int = 0):
+
+        self._cache_directory = cache_directory
+        self._date_time_provider = date_time_provider
+        self._max_size_bytes = int(max_size_mb * 1024 * 1024)
+        self._max_age_days = max_age_days
+
+        os.makedirs(cache_directory, exist_ok=True)
+
+    # Returns the cached response bytes for a station and date, or None if it isn't cached
+    def get(self, station_id: str, date_required: date):
+
+        _blob_file_name = self._blob_file_name(station_id, date_required)
+
+        try:
+            with open(_blob_file_name, "rb") as blob_file:
+                _stored_digest = blob_file.readline().strip().decode("ascii")
+                _content = gzip.decompress(blob_file.read())
+
+        except (OSError, EOFError):
+            return None
+
+        if hashlib.sha256(_content).hexdigest() != _stored_digest:
+            os.remove(_blob_file_name)
+            return None
+
+        # Only the access time is updated, so that size based eviction removes the least recently used first.
+        # The modified time is left as the time the blob was fetched, which is what age based eviction goes by.
+        os.utime(_blob_file_name, (time.time(), os.stat(_blob_file_name).st_mtime))
+        return _content
+
+    # Stores the response bytes for a station and date. Days still inside the settle window may yet change
+    # on Weather Underground so they're not stored, and blobs that are already stored are never replaced.
+    def put(self, station_id: str, date_required: date, content: bytes):
+
+        if date_required > self._date_time_provider.now() - timedelta(days=2):
+            return
+
+        _blob_file_name = self._blob_file_name(station_id, date_required)
+
+        if os.path.exists(_blob_file_name):
+            return
+
+        os.makedirs(os.path.dirname(_blob_file_name), exist_ok=True)
+
+        # Write to a temporary file first so a partly written blob is never visible to readers
+        _temporary_file_name = f"{_blob_file_name}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+        with open(_temporary_file_name, "wb") as blob_file:
+            blob_file.write(hashlib.sha256(content).hexdigest().encode("ascii") + b"\n")
+            blob_file.write(gzip.compress(content))
+
+        os.replace(_temporary_file_name, _blob_file_name)
+
+    # Removes blobs fetched longer ago than the maximum age, then the least recently used blobs until the cache
+    # is within its maximum size. Returns the number of blobs removed.
+    def evict(self) -> int:
+
+        _blobs = []
+
+        for directory, _, file_names in os.walk(self._cache_directory):
+            for file_name in file_names:
+                if file_name.endswith(".json.gz"):
+                    _full_name = os.path.join(directory, file_name)
+                    _status = os.stat(_full_name)
+                    _blobs.append((_status.st_atime, _status.st_mtime, _status.st_size, _full_name))
+
+        _kept_blobs = []
+        _removed = 0
+        _oldest_allowed = time.time() - self._max_age_days * 86400
+
+        for accessed_time, fetched_time, size, full_name in _blobs:
+
+            if self._max_age_days > 0 and fetched_time < _oldest_allowed:
+                os.remove(full_name)
+                _removed += 1
+            else:
+                _kept_blobs.append((accessed_time, size, full_name))
+
+        _kept_blobs.sort()
+        _total_size = sum(size for _, size, _ in _kept_blobs)
+
+        for _, size, full_name in _kept_blobs:
+
+            if not 0 < self._max_size_bytes < _total_size:
+                break
+
+            os.remove(full_name)
+            _total_size -= size
+            _removed += 1
+
+        return _removed
+
+    def _blob_file_name(self, station_id: str, date_required: date) -> str:
+
+        return os.path.join(self._cache_directory, station_id, date_required.strftime("%Y"),
+                            f"{date_required.strftime('%Y%m%d')}.json.gz")
@@ -0,0 +1,173 @@
+# A local stand-in for the Weather Underground hourly history API. Serves synthetic observations
+# with a configurable response latency and error rate so that fetching can be exercised without spending API calls.
+#
+# Run the server:           python WuStubServer.py --port 8085 --latency 0.25 --error-rate 0.02
+# Compare fetch throughput: python WuStubServer.py --latency 0.25 --compare 60 --workers 8
+#
+# To point WMDownloader at the stub, set ApiUrl = http://localhost:8085/v2/pws/history/ in the
+# [WeatherUnderground] section of config.ini.
+
+import argparse
+import json
+import math
+import random
+import threading
+import time
+from datetime import datetime
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import parse_qs
+from urllib.parse import urlparse
+
+
+# Builds a day of 24 hourly observations in the same shape as the Weather Underground response.
+# Temperatures follow the season and the time of day, with a little noise that is the same every time
+# a station and day are generated.
+def create_synthetic_day(station_id: str, date_required: datetime) -> dict:
+
+    _observations = []
+    _random = random.Random(f"{station_id}{date_required:%Y%m%d}")
+    _seasonal = 10 - 8 * math.cos(2 * math.pi * (date_required.timetuple().tm_yday - 15) / 365.25)
+    _day_offset = _random.uniform(-4, 4)
+    _rain = max(0.0, _random.gauss(-1, 3))
+
+    for hour in range(24):
+        _time = date_required + timedelta(hours=hour)
+        _temperature = round(_seasonal + _day_offset + 8 * (1 - abs(hour - 14) / 14) - 4, 1)
+
+        _observations.append({
+            "stationID": station_id,
+            "obsTimeLocal": _time.strftime("%Y-%m-%d %H:%M:%S"),
+            "solarRadiationHigh": 0.0 if hour < 6 or hour > 20 else 350.0,
+            "uvHigh": 0.0 if hour < 6 or hour > 20 else 3.0,
+            "winddirAvg": 225,
+            "humidityHigh": 90,
+            "humidityLow": 70,
+            "humidityAvg": 80.0,
+            "metric": {
+                "tempHigh": _temperature + 0.5, "tempLow": _temperature - 0.5, "tempAvg": _temperature,
+                "windspeedHigh": 12.0, "windspeedLow": 0.0, "windspeedAvg": 5.0,
+                "windgustHigh": 20.0, "windgustLow": 0.0, "windgustAvg": 8.0,
+                "dewptHigh": 8.0, "dewptLow": 6.0, "dewptAvg": 7.0,
+                "windchillHigh": _temperature, "windchillLow": _temperature - 1, "windchillAvg": _temperature,
+                "heatindexHigh": _temperature + 0.5, "heatindexLow": _temperature - 0.5,
+                "heatindexAvg": _temperature,
+                "pressureMax": 1015.2, "pressureMin": 1013.8, "pressureTrend": 0.1,
+                "precipRate": round(_rain / 24, 2), "precipTotal": round(_rain * (hour + 1) / 24, 2)
+            }
+        })
+
+    return {"observations": _observations}
+
+
+# error_rate is the fraction of requests answered with 503 Service Unavailable and throttle_rate the fraction
+# answered with 429 Too Many Requests asking to retry after retry_after seconds, both of which the downloader retries.
+# Every request is answered with 503 for the first outage_seconds, as if WU were down.
+def _create_handler(latency: float, error_rate: float = 0.0, throttle_rate: float = 0.0, retry_after: int = 1,
+                    outage_seconds: float = 0.0):
+
+    _outage_ends = time.monotonic() + outage_seconds
+
+    class _StubHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            _url = urlparse(self.path)
+            _query = parse_qs(_url.query)
+
+            if not _url.path.endswith("/history/hourly") or "date" not in _query:
+                self.send_error(404)
+                return
+
+            time.sleep(latency)
+
+            if time.monotonic() < _outage_ends or random.random() < error_rate:
+                self.send_error(503)
+                return
+
+            if random.random() < throttle_rate:
+                self.send_response(429)
+                self.send_header("Retry-After", str(retry_after))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+            _date_required = datetime.strptime(_query["date"][0], "%Y%m%d")
+            _body = json.dumps(create_synthetic_day(_query.get("stationId", ["STUB"])[0],
+                                                    _date_required)).encode("utf-8")
+
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(_body)))
+            self.end_headers()
+            self.wfile.write(_body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return _StubHandler
+
+
+# Starts the stub server on a background thread and returns it
+def start_stub_server(port: int = 0, latency: float = 0.0, error_rate: float = 0.0, throttle_rate: float = 0.0,
+                      retry_after: int = 1, outage_seconds: float = 0.0) -> ThreadingHTTPServer:
+
+    _server = ThreadingHTTPServer(("127.0.0.1", port),
+                                  _create_handler(latency, error_rate, throttle_rate, retry_after, outage_seconds))
+    threading.Thread(target=_server.serve_forever, daemon=True).start()
+    return _server
+
+
+# Times fetching a number of days from the stub sequentially and then concurrently
+def _compare_fetch_throughput(server: ThreadingHTTPServer, days: int, workers: int):
+
+    from concurrent.futures import ThreadPoolExecutor
+    from RateLimiter import RateLimiter
+    from WeatherUndergroundApiService import WeatherUndergroundApiService
+
+    _dates = [datetime(2020, 1, 1).date() + timedelta(days=n) for n in range(days)]
+    _url = f"http://127.0.0.1:{server.server_address[1]}/v2/pws/history/"
+
+    for _worker_count in (1, workers):
+        _service = WeatherUndergroundApiService("STUB", "stubkey", RateLimiter(),
+                                                connection_pool_size=_worker_count, api_url=_url)
+        _service.start_wu_api_session()
+        _start = time.perf_counter()
+
+        with ThreadPoolExecutor(max_workers=_worker_count) as executor:
+            list(executor.map(_service.get_hourly_observations_for_date, _dates))
+
+        _elapsed = time.perf_counter() - _start
+        _service.stop_wu_api_session()
+        print(f"{_worker_count} worker(s): {days} days in {_elapsed:.2f}s ({days / _elapsed:.1f} days/sec)")
+
+
+if __name__ == "__main__":
+    _parser = argparse.ArgumentParser(description="Local stub of the Weather Underground hourly history API")
+    _parser.add_argument("--port", type=int, default=8085)
+    _parser.add_argument("--latency", type=float, default=0.25, help="Seconds to delay each response")
+    _parser.add_argument("--error-rate", type=float, default=0.0,
+                         help="Fraction of requests answered with 503 Service Unavailable")
+    _parser.add_argument("--throttle-rate", type=float, default=0.0,
+                         help="Fraction of requests answered with 429 Too Many Requests")
+    _parser.add_argument("--retry-after", type=int, default=1,
+                         help="Seconds given in the Retry-After header of 429 responses")
+    _parser.add_argument("--outage", type=float, default=0.0, metavar="SECONDS",
+                         help="Answer every request with 503 for this long after starting")
+    _parser.add_argument("--compare", type=int, metavar="DAYS",
+                         help="Fetch DAYS days sequentially and concurrently, report timings and exit")
+    _parser.add_argument("--workers", type=int, default=8, help="Worker count used with --compare")
+    _arguments = _parser.parse_args()
+
+    if _arguments.compare:
+        _compare_fetch_throughput(start_stub_server(0, _arguments.latency, _arguments.error_rate,
+                                                    _arguments.throttle_rate, _arguments.retry_after,
+                                                    _arguments.outage),
+                                  _arguments.compare, _arguments.workers)
+    else:
+        print(f"Serving stub Weather Underground API on http://127.0.0.1:{_arguments.port}/v2/pws/history/")
+        _stub_server = ThreadingHTTPServer(("127.0.0.1", _arguments.port),
+                                           _create_handler(_arguments.latency, _arguments.error_rate,
+                                                           _arguments.throttle_rate, _arguments.retry_after,
+                                                           _arguments.outage))
+        _stub_server.serve_forever()
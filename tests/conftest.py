@@ -0,0 +1,157 @@
+import configparser
+import os
+import sys
+import pytest
+
+# The modules live in the root of the repository rather than in a package
+REPOSITORY_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPOSITORY_DIRECTORY)
+
+
+# Writes a configuration file for a SQLite database in the test's temporary directory. sections overrides or adds
+# options, e.g. {"WeatherUnderground": {"StationIds": "A, B"}}, and an option given as None is left out.
+@pytest.fixture
+def write_config(tmp_path):
+
+    def _write_config(sections: dict = None) -> str:
+
+        _config = configparser.ConfigParser(interpolation=None)
+        _config.optionxform = str
+        _config.read_dict({
+            "Downloader": {"LogFile": str(tmp_path / "WMDownloader.log")},
+            "WeatherUnderground": {"StationId": "TEST1", "ApiKey": "key", "InitialObservationDate": "2024-01-01",
+                                   "ApiUrl": "http://127.0.0.1:9/v2/pws/history/"},
+            "Database": {"Backend": "sqlite", "IPAddress": "", "Port": "", "UserId": "", "Password": "",
+                         "DatabaseName": str(tmp_path / "weather.db")},
+            "EMail": {"Host": "127.0.0.1", "Port": "1", "Username": "", "Password": "", "FromAddress": "a@b",
+                      "FromName": "Test", "ToAddress": "a@b", "ToName": "Test"},
+        })
+
+        for section, options in (sections or {}).items():
+            if not _config.has_section(section):
+                _config.add_section(section)
+            for option, value in options.items():
+                if value is None:
+                    _config.remove_option(section, option)
+                else:
+                    _config.set(section, option, value)
+
+        (tmp_path / "WMDownloader.log").touch()
+        _file_name = tmp_path / "config.ini"
+
+        with open(_file_name, "w") as config_file:
+            _config.write(config_file)
+
+        return str(_file_name)
+
+    return _write_config
+
+
+# Runs one of the command line programs with a configuration file, returning the completed process
+@pytest.fixture
+def run_program():
+
+    import subprocess
+
+    def _run_program(program: str, *arguments: str):
+
+        return subprocess.run([sys.executable, os.path.join(REPOSITORY_DIRECTORY, program), *arguments],
+                              capture_output=True, text=True, timeout=120, cwd=REPOSITORY_DIRECTORY)
+
+    return _run_program
+
+
+# Records what would have been logged or e-mailed, and ends the program as WMErrorService does when asked to
+class RecordingErrorService:
+
+    def __init__(self):
+        self.messages = []
+
+    def finalise_error_handling(self):
+        pass
+
+    def handle_error(self, message: str, severity: str = 'Warning', send_email: bool = False,
+                     batch_message: bool = False, terminate: bool = False, exc_info=None):
+        self.messages.append((severity, message))
+        if terminate:
+            raise SystemExit(message)
+
+    def with_severity(self, severity: str) -> list[str]:
+        return [message for message_severity, message in self.messages if message_severity == severity]
+
+
+# Supplies a fixed date as today
+class FixedDateTimeProvider:
+
+    def __init__(self, today):
+        self.today = today
+
+    def now(self):
+        return self.today
+
+
+@pytest.fixture
+def error_service():
+
+    return RecordingErrorService()
+
+
+# A local stand-in for the Weather Underground API, serving synthetic observations
+@pytest.fixture
+def stub_server():
+
+    from WuStubServer import start_stub_server
+
+    _server = start_stub_server()
+    yield _server
+    _server.shutdown()
+    _server.server_close()
+
+
+# Creates database services on a SQLite database in the test's temporary directory
+@pytest.fixture
+def create_database_service(tmp_path, error_service):
+
+    from WMDatabaseService import WMDatabaseService
+
+    _services = []
+
+    def _create_database_service(**options):
+
+        _options = {"station_id": "TEST1", "backend": "sqlite"} | options
+        _service = WMDatabaseService("", "", "", "", str(tmp_path / "weather.db"), error_service, **_options)
+        _services.append(_service)
+        return _service
+
+    yield _create_database_service
+
+    for service in _services:
+        service.dispose()
+
+
+# Creates a MainRoutine downloading from the stub server into a SQLite database, with today fixed. stations maps
+# each station to its initial observation date, as a string as in config.ini.
+@pytest.fixture
+def create_main_routine(tmp_path, error_service, stub_server, create_database_service):
+
+    from MainRoutine import MainRoutine
+    from RateLimiter import RateLimiter
+    from RunMetrics import RunMetrics
+    from WeatherUndergroundApiService import WeatherUndergroundApiService
+
+    def _create_main_routine(today, stations: dict, retry_policy=None, **options):
+
+        _metrics = RunMetrics()
+        _date_time_provider = FixedDateTimeProvider(today)
+        _database_service = create_database_service(station_id=next(iter(stations)), metrics=_metrics,
+                                                    date_time_provider=_date_time_provider)
+        _wu_service = WeatherUndergroundApiService(next(iter(stations)), "key", RateLimiter(),
+                                                   api_url=f"http://127.0.0.1:{stub_server.server_address[1]}"
+                                                           f"/v2/pws/history/",
+                                                   metrics=_metrics, retry_policy=retry_policy)
+        _main_routine = MainRoutine(_database_service, _date_time_provider, _wu_service, error_service, "0",
+                                    next(iter(stations.values())), str(tmp_path / "WMDownloader.log"),
+                                    station_initial_observation_dates=stations, metrics=_metrics, **options)
+        return _main_routine, _database_service
+
+    return _create_main_routine
@@ -0,0 +1,97 @@
+import sqlite3
+import threading
+import time
+from datetime import date
+from ApiQuotaLedger import ApiQuotaLedger
+from sqlalchemy import func, select
+from WMSchema import Observation
+
+_HOURS = 60 * 60
+
+
+def _record_calls(ledger_file_name: str, ledger: ApiQuotaLedger, hours_ago: list[float]):
+
+    with sqlite3.connect(ledger_file_name) as connection:
+        connection.executemany("INSERT INTO ApiCalls (KeyHash, CallTime) VALUES (?, ?)",
+                               [(ledger._key_hash, time.time() - hours * _HOURS) for hours in hours_ago])
+
+
+def _ledger_rows(ledger_file_name: str) -> int:
+
+    with sqlite3.connect(ledger_file_name) as connection:
+        return connection.execute("SELECT COUNT(*) FROM ApiCalls").fetchone()[0]
+
+
+def test_calls_are_shared_by_ledgers_on_the_same_file_and_key(tmp_path):
+
+    _ledger_file_name = str(tmp_path / "quota.db")
+    _ledger = ApiQuotaLedger(_ledger_file_name, "key", 3)
+    _same_key = ApiQuotaLedger(_ledger_file_name, "key", 3)
+    _other_key = ApiQuotaLedger(_ledger_file_name, "other", 3)
+
+    assert _ledger.try_reserve_call()
+    assert _same_key.try_reserve_call()
+
+    assert _ledger.calls_in_window() == 2
+    assert _same_key.remaining_calls() == 1
+    assert _other_key.remaining_calls() == 3
+
+
+def test_calls_stop_counting_after_a_day_and_are_deleted_after_two(tmp_path):
+
+    _ledger_file_name = str(tmp_path / "quota.db")
+    _ledger = ApiQuotaLedger(_ledger_file_name, "key", 10)
+    _record_calls(_ledger_file_name, _ledger, [1, 23, 25, 47, 49])
+
+    assert _ledger.calls_in_window() == 2
+
+    ApiQuotaLedger(_ledger_file_name, "key", 10)
+
+    assert _ledger_rows(_ledger_file_name) == 4
+
+
+def test_concurrent_reservations_never_overspend_the_limit(tmp_path):
+
+    _ledger_file_name = str(tmp_path / "quota.db")
+    _reserved = []
+
+    def _reserve_calls():
+        # Each thread has its own ledger, as each process would
+        _ledger = ApiQuotaLedger(_ledger_file_name, "key", 25)
+        _reserved.extend(_ledger.try_reserve_call() for _ in range(10))
+
+    _ledger = ApiQuotaLedger(_ledger_file_name, "key", 25)
+    _workers = [threading.Thread(target=_reserve_calls) for _ in range(4)]
+
+    for worker in _workers:
+        worker.start()
+    for worker in _workers:
+        worker.join()
+
+    assert _reserved.count(True) == 25
+    assert _ledger.calls_in_window() == 25
+    assert not _ledger.try_reserve_call()
+
+
+def test_runs_are_planned_from_the_calls_left_in_the_ledger(tmp_path, create_main_routine, error_service):
+
+    _ledger_file_name = str(tmp_path / "quota.db")
+
+    def _run():
+        _main_routine, _database_service = create_main_routine(date(2024, 3, 31), {"TEST1": "2024-03-01"},
+                                                               api_call_reserve=2)
+        _main_routine._wu_service._quota_ledger = ApiQuotaLedger(_ledger_file_name, "key", 10)
+        _main_routine.download_recent_observations()
+
+        with _database_service.engine.connect() as connection:
+            return connection.execute(select(func.count(func.distinct(func.date(Observation.ObservationTime))))
+                                      .select_from(Observation)).scalar()
+
+    # One call checks today's observations and the reserve is kept back, leaving seven for the days required
+    assert _run() == 7
+    assert ApiQuotaLedger(_ledger_file_name, "key", 10).calls_in_window() == 8
+
+    # The calls made carry over to the next run, which has too few left to download anything more
+    assert _run() == 7
+    assert any("No Weather Underground API calls left for today" in message
+               for message in error_service.with_severity("Info"))
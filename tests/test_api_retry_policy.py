@@ -0,0 +1,195 @@
+import threading
+import time
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+from email.utils import format_datetime
+import pytest
+from ApiRetryPolicy import ApiRetryPolicy, parse_retry_after
+from RateLimiter import RateLimiter
+from RunMetrics import RunMetrics
+from WeatherUndergroundApiService import WeatherUndergroundApiService
+from WuApiUnavailableException import WuApiUnavailableException
+from WuStubServer import start_stub_server
+
+
+def _create_policy(**options) -> ApiRetryPolicy:
+
+    return ApiRetryPolicy(**({"base_delay_seconds": 0.01, "breaker_pause_seconds": 0.05} | options))
+
+
+def test_delay_grows_with_each_attempt_up_to_the_maximum():
+
+    _policy = _create_policy(max_attempts=10, base_delay_seconds=1, max_delay_seconds=3, breaker_threshold=100)
+
+    for attempt in range(1, 10):
+        assert 0 <= _policy.record_failure(attempt) <= min(3, 2 ** (attempt - 1))
+
+
+def test_failed_call_is_given_up_after_max_attempts():
+
+    _policy = _create_policy(max_attempts=3)
+
+    assert _policy.record_failure(2) is not None
+    assert _policy.record_failure(3) is None
+
+
+def test_retry_after_is_waited_for_unless_too_long():
+
+    _policy = _create_policy(max_delay_seconds=10, breaker_threshold=100)
+
+    assert 5 <= _policy.record_failure(1, retry_after=5) <= 5.01
+    assert _policy.record_failure(1, retry_after=11) is None
+
+
+def test_retries_are_counted_against_the_budget_only_when_made():
+
+    _policy = _create_policy(retry_budget=2)
+
+    assert _policy.before_call()
+    assert _policy.remaining_retries == 2
+    assert _policy.before_call(retry=True)
+    assert _policy.before_call(retry=True)
+    assert _policy.remaining_retries == 0
+    assert not _policy.before_call(retry=True)
+    assert _policy.record_failure(1) is None
+
+    _policy.reset_budget()
+
+    assert _policy.remaining_retries == 2
+
+
+def test_breaker_opens_after_failures_in_a_row_and_closes_after_a_trial_call():
+
+    _metrics = RunMetrics()
+    _policy = _create_policy(breaker_threshold=3, metrics=_metrics)
+
+    for attempt in range(1, 4):
+        _policy.record_failure(attempt)
+
+    _start = time.perf_counter()
+    assert _policy.before_call()
+    assert time.perf_counter() - _start >= 0.04
+    assert _metrics.counter("circuit_breaker_opens") == 1
+
+    # Other calls wait for the trial call's outcome
+    _other_call = threading.Thread(target=_policy.before_call)
+    _other_call.start()
+    _other_call.join(0.1)
+    assert _other_call.is_alive()
+
+    _policy.record_success()
+    _other_call.join(1)
+    assert not _other_call.is_alive()
+
+    _start = time.perf_counter()
+    assert _policy.before_call()
+    assert time.perf_counter() - _start < 0.04
+
+
+def test_failed_trial_call_doubles_the_pause():
+
+    _metrics = RunMetrics()
+    _policy = _create_policy(breaker_threshold=1, metrics=_metrics)
+    _policy.record_failure(1)
+    _policy.before_call()
+
+    _policy.record_failure(1)
+    _start = time.perf_counter()
+    _policy.before_call()
+
+    assert time.perf_counter() - _start >= 0.09
+    assert _metrics.counter("circuit_breaker_opens") == 2
+
+
+def test_abandoned_trial_call_lets_another_through():
+
+    _policy = _create_policy(breaker_threshold=1, breaker_pause_seconds=0)
+    _policy.record_failure(1)
+    _policy.before_call()
+    _policy.abandon_call()
+
+    _other_call = threading.Thread(target=_policy.before_call)
+    _other_call.start()
+    _other_call.join(1)
+
+    assert not _other_call.is_alive()
+
+
+def test_calls_fail_fast_while_the_breaker_is_open_and_the_budget_is_spent():
+
+    _policy = _create_policy(retry_budget=0, breaker_threshold=1, breaker_pause_seconds=60)
+    _policy.record_failure(1)
+
+    _start = time.perf_counter()
+    assert not _policy.before_call()
+    assert time.perf_counter() - _start < 1
+
+
+@pytest.mark.parametrize("value, expected", [("120", 120), ("0", 0), ("-5", 0), ("", None), (None, None),
+                                             ("soon", None)])
+def test_parse_retry_after_seconds(value, expected):
+
+    assert parse_retry_after(value) == expected
+
+
+def test_parse_retry_after_http_date():
+
+    _retry_at = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=30), usegmt=True)
+
+    assert 25 <= parse_retry_after(_retry_at) <= 30
+
+
+# Downloads a day from a stub server started with the given options, through a retry policy
+def _download_day(retry_policy: ApiRetryPolicy, metrics: RunMetrics, **stub_options):
+
+    _server = start_stub_server(**stub_options)
+    _wu_service = WeatherUndergroundApiService("TEST1", "key", RateLimiter(),
+                                               api_url=f"http://127.0.0.1:{_server.server_address[1]}"
+                                                       f"/v2/pws/history/",
+                                               metrics=metrics, retry_policy=retry_policy)
+    _wu_service.start_wu_api_session()
+
+    try:
+        return _wu_service.get_hourly_observations_for_date(date(2024, 3, 1))
+    finally:
+        _wu_service.stop_wu_api_session()
+        _server.shutdown()
+        _server.server_close()
+
+
+def test_throttled_calls_are_retried_after_retry_after():
+
+    _metrics = RunMetrics()
+
+    with pytest.raises(WuApiUnavailableException):
+        _download_day(_create_policy(max_attempts=3, breaker_threshold=10, metrics=_metrics), _metrics,
+                      throttle_rate=1, retry_after=0)
+
+    assert _metrics.counter("http_throttled") == 3
+    assert _metrics.counter("http_retries") == 2
+
+
+def test_calls_resume_once_an_outage_ends():
+
+    _metrics = RunMetrics()
+    _policy = _create_policy(max_attempts=10, retry_budget=10, breaker_threshold=2, breaker_pause_seconds=0.1,
+                             metrics=_metrics)
+
+    _observations = _download_day(_policy, _metrics, outage_seconds=0.3)
+
+    assert len(_observations["observations"]) == 24
+    assert _metrics.counter("circuit_breaker_opens") >= 1
+
+
+def test_outage_gives_up_within_the_retry_budget():
+
+    _metrics = RunMetrics()
+    _policy = _create_policy(max_attempts=10, retry_budget=3, breaker_threshold=2, metrics=_metrics)
+
+    with pytest.raises(WuApiUnavailableException):
+        _download_day(_policy, _metrics, outage_seconds=60)
+
+    assert _metrics.counter("http_requests") == 4
+    assert _policy.remaining_retries == 0
@@ -0,0 +1,119 @@
+import threading
+from datetime import date
+from datetime import datetime
+from sqlalchemy import update
+from WMBackfillService import WMBackfillService
+from WMSchema import BackfillShard
+
+_FIRST_DATE = date(2024, 1, 1)
+
+
+def _create_backfill_service(create_database_service, error_service, days: int = 10, shard_days: int = 5,
+                             max_attempts: int = 3) -> WMBackfillService:
+
+    _backfill_service = WMBackfillService(create_database_service().engine, error_service, max_attempts=max_attempts)
+    _backfill_service.create_shards("TEST1", _FIRST_DATE, date(2024, 1, days), shard_days)
+    return _backfill_service
+
+
+# Lets every lease run out, as if their workers had died
+def _expire_leases(backfill_service: WMBackfillService):
+
+    with backfill_service._engine.connect() as connection:
+        connection.execute(update(BackfillShard).values(LeaseExpires=datetime(2000, 1, 1)))
+        connection.commit()
+
+
+def test_shards_are_created_once_and_extended(create_database_service, error_service):
+
+    _backfill_service = _create_backfill_service(create_database_service, error_service, days=12)
+
+    assert _backfill_service.create_shards("TEST1", _FIRST_DATE, date(2024, 1, 12), 5) == 0
+    assert _backfill_service.create_shards("TEST1", _FIRST_DATE, date(2024, 1, 20), 5) == 2
+    assert _backfill_service.get_progress(["TEST1"])["pending"] == {"shards": 5, "days": 20}
+
+
+def test_shards_are_added_only_for_days_not_already_sharded(create_database_service, error_service):
+
+    _backfill_service = WMBackfillService(create_database_service().engine, error_service)
+    _backfill_service.create_shards("TEST1", date(2024, 1, 4), date(2024, 1, 8), 5)
+
+    assert _backfill_service.create_shards("TEST1", _FIRST_DATE, date(2024, 1, 12), 5) == 2
+    assert [(shard.FirstDate.day, shard.LastDate.day)
+            for shard in iter(lambda: _backfill_service.claim_shard("a", ["TEST1"]), None)] == \
+        [(1, 3), (4, 8), (9, 12)]
+
+
+def test_workers_claim_different_shards_earliest_first(create_database_service, error_service):
+
+    _backfill_service = _create_backfill_service(create_database_service, error_service)
+
+    _first_shard = _backfill_service.claim_shard("a", ["TEST1"])
+    _second_shard = _backfill_service.claim_shard("b", ["TEST1"])
+
+    assert (_first_shard.FirstDate, _first_shard.LastDate) == (_FIRST_DATE, date(2024, 1, 5))
+    assert _second_shard.FirstDate == date(2024, 1, 6)
+    assert _backfill_service.claim_shard("c", ["TEST1"]) is None
+
+
+def test_concurrent_claims_never_share_a_shard(create_database_service, error_service):
+
+    _backfill_service = _create_backfill_service(create_database_service, error_service, days=30, shard_days=1)
+    _claimed = []
+
+    def _claim_all(worker_id: str):
+        while (shard := _backfill_service.claim_shard(worker_id, ["TEST1"])) is not None:
+            _claimed.append(shard.ShardId)
+
+    _workers = [threading.Thread(target=_claim_all, args=(str(worker),)) for worker in range(4)]
+
+    for worker in _workers:
+        worker.start()
+    for worker in _workers:
+        worker.join()
+
+    assert sorted(_claimed) == sorted(set(_claimed))
+    assert len(_claimed) == 30
+
+
+def test_shard_of_a_dead_worker_is_claimed_by_another(create_database_service, error_service):
+
+    _backfill_service = _create_backfill_service(create_database_service, error_service, days=5)
+    _shard = _backfill_service.claim_shard("a", ["TEST1"])
+
+    assert _backfill_service.renew_leases({_shard.ShardId: "a"}) == set()
+
+    _expire_leases(_backfill_service)
+
+    assert _backfill_service.claim_shard("b", ["TEST1"]).ShardId == _shard.ShardId
+    assert _backfill_service.renew_leases({_shard.ShardId: "a"}) == {_shard.ShardId}
+    assert not _backfill_service.complete_shard(_shard.ShardId, "a", 5)
+    assert _backfill_service.complete_shard(_shard.ShardId, "b", 5)
+    assert _backfill_service.get_progress(["TEST1"])["done"] == {"shards": 1, "days": 5}
+
+
+def test_failed_shard_is_retried_until_it_runs_out_of_attempts(create_database_service, error_service):
+
+    _backfill_service = _create_backfill_service(create_database_service, error_service, days=5, max_attempts=2)
+
+    for _ in range(2):
+        _shard = _backfill_service.claim_shard("a", ["TEST1"])
+        assert _backfill_service.fail_shard(_shard.ShardId, "a", "Outage")
+        assert _backfill_service.claim_shard("b", ["TEST1"]) is None
+        _expire_leases(_backfill_service)
+
+    assert _backfill_service.claim_shard("a", ["TEST1"]) is None
+    assert _backfill_service.get_progress(["TEST1"])["abandoned"] == {"shards": 1, "days": 5}
+
+
+def test_released_shard_is_claimed_again_without_using_an_attempt(create_database_service, error_service):
+
+    _backfill_service = _create_backfill_service(create_database_service, error_service, days=5, max_attempts=1)
+    _shard = _backfill_service.claim_shard("a", ["TEST1"])
+
+    assert _backfill_service.release_shard(_shard.ShardId, "a")
+
+    _shard = _backfill_service.claim_shard("b", ["TEST1"])
+
+    assert _shard.Attempts == 1
+    assert _shard.LeaseOwner == "b"
@@ -0,0 +1,21 @@
+import json
+
+
+def test_scenario_runs_the_downloader_and_records_its_measurements(tmp_path, write_config, run_program):
+
+    _config_file_name = write_config({"WeatherUnderground": {"StationIds": "REAL1, REAL2"}})
+    _results_file_name = str(tmp_path / "results.json")
+
+    for _ in range(2):
+        _benchmark = run_program("WMBenchmark.py", _config_file_name, "--scenario", "daily", "--days", "3",
+                                 "--latency", "0", "--results", _results_file_name)
+        assert _benchmark.returncode == 0, _benchmark.stderr
+
+    with open(_results_file_name, encoding="utf-8") as results_file:
+        _results = json.load(results_file)
+
+    # Three days for the benchmark station, plus the check of today's observations
+    assert [(result["scenario"], result["rows"], result["http_calls"]) for result in _results] == \
+        [("daily", 72, 4), ("daily", 72, 4)]
+    assert all(result["peak_rss_mb"] > 0 for result in _results)
+    assert "compared with" in _benchmark.stdout
@@ -0,0 +1,76 @@
+from datetime import date
+from datetime import timedelta
+import pytest
+from sqlalchemy import func, select
+from WMSchema import Observation
+from WuApiUnavailableException import WuApiUnavailableException
+
+_TODAY = date(2024, 3, 15)
+# Days from the day after the initial observation date up to two days ago
+_DATES_REQUIRED = [date(2024, 3, 2) + timedelta(days=day) for day in range(12)]
+
+
+def _dates_saved(database_service) -> list[date]:
+
+    with database_service.engine.connect() as connection:
+        return [date.fromisoformat(day) for day in
+                connection.execute(select(func.distinct(func.date(Observation.ObservationTime)))
+                                   .order_by(func.date(Observation.ObservationTime))).scalars()]
+
+
+# Wraps the WU service so the days required are recorded, and WU is unavailable from unavailable_from onwards
+def _record_dates(main_routine, dates_requested: list, unavailable_from: date = None):
+
+    _get_hourly_observations_for_date = main_routine._wu_service.get_hourly_observations_for_date
+
+    def _get_or_fail(date_required, station_id=None):
+        if date_required in _DATES_REQUIRED:
+            dates_requested.append(date_required)
+            if unavailable_from is not None and date_required >= unavailable_from:
+                raise WuApiUnavailableException("Weather Underground is unavailable")
+        return _get_hourly_observations_for_date(date_required, station_id)
+
+    main_routine._wu_service.get_hourly_observations_for_date = _get_or_fail
+
+
+@pytest.mark.parametrize("fetch_workers", [1, 4])
+def test_days_before_an_outage_are_kept_and_the_rest_downloaded_next_run(create_main_routine, error_service,
+                                                                          fetch_workers):
+
+    _main_routine, _database_service = create_main_routine(_TODAY, {"TEST1": "2024-03-01"},
+                                                           checkpoint_days=4, fetch_workers=fetch_workers)
+    _record_dates(_main_routine, [], unavailable_from=date(2024, 3, 8))
+
+    _main_routine.download_recent_observations()
+
+    assert _dates_saved(_database_service) == _DATES_REQUIRED[:6]
+    assert any("Downloading stopped, later days will be downloaded by the next run" in message
+               for message in error_service.with_severity("Warning"))
+
+    _main_routine, _database_service = create_main_routine(_TODAY, {"TEST1": "2024-03-01"},
+                                                           checkpoint_days=4, fetch_workers=fetch_workers)
+    _dates_requested = []
+    _record_dates(_main_routine, _dates_requested)
+
+    _main_routine.download_recent_observations()
+
+    assert sorted(_dates_requested) == _DATES_REQUIRED[6:]
+    assert _dates_saved(_database_service) == _DATES_REQUIRED
+
+
+def test_days_are_saved_every_checkpoint_days(create_main_routine):
+
+    _main_routine, _database_service = create_main_routine(_TODAY, {"TEST1": "2024-03-01"}, checkpoint_days=5)
+    _days_per_save = []
+    _save_list_of_observations = _database_service.save_list_of_observations
+
+    def _record_save(days, station_id, **options):
+        _days_per_save.append(len(days))
+        _save_list_of_observations(days, station_id, **options)
+
+    _database_service.save_list_of_observations = _record_save
+
+    _main_routine.download_recent_observations()
+
+    assert _days_per_save == [5, 5, 2]
+    assert _dates_saved(_database_service) == _DATES_REQUIRED
@@ -0,0 +1,42 @@
+import configparser
+import pytest
+from WMConfiguration import read_station_ids
+
+
+def _config(options: dict) -> configparser.ConfigParser:
+
+    _config = configparser.ConfigParser(interpolation=None)
+    _config.read_dict({"WeatherUnderground": options})
+    return _config
+
+
+@pytest.mark.parametrize("options, station_ids", [
+    ({"StationId": "ONE"}, ["ONE"]),
+    ({"StationIds": "ONE, TWO ,THREE"}, ["ONE", "TWO", "THREE"]),
+    ({"StationId": "ONE", "StationIds": "TWO, THREE"}, ["TWO", "THREE"]),
+    ({"StationId": "ONE", "StationIds": ""}, ["ONE"]),
+    ({}, []),
+])
+def test_read_station_ids(options, station_ids):
+
+    assert read_station_ids(_config(options)) == station_ids
+
+
+def test_downloader_starts_with_only_station_ids(write_config, run_program):
+
+    _config_file = write_config({"WeatherUnderground": {"StationId": None, "StationIds": "ONE, TWO"}})
+
+    _process = run_program("WMDownloader.py", _config_file, "--migrate")
+
+    assert _process.returncode == 0, _process.stderr
+    assert "NoOptionError" not in _process.stderr
+
+
+def test_deduplicate_runs_with_only_station_id(write_config, run_program):
+
+    _config_file = write_config()
+
+    _process = run_program("WMDeduplicate.py", _config_file)
+
+    assert _process.returncode == 0, _process.stderr
+    assert "Removed 0 duplicate observations" in _process.stdout
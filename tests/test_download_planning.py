@@ -0,0 +1,125 @@
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+from conftest import FixedDateTimeProvider
+from sqlalchemy import func, select
+from WMSchema import DownloadAttempt, Observation, QuarantinedObservation
+from WuStubServer import create_synthetic_day
+
+_FIRST_DAY = date(2024, 3, 1)
+_TODAY = date(2024, 3, 15)
+
+
+def _save_day(database_service, day: date, hours: int = 24):
+
+    _observations = create_synthetic_day("TEST1", datetime.combine(day, datetime.min.time()))
+    _observations["observations"] = _observations["observations"][:hours]
+    database_service.save_list_of_observations([_observations], "TEST1")
+
+
+def _incomplete_dates(database_service, max_download_attempts: int = 3) -> list[int]:
+
+    return [incomplete_date.day for incomplete_date in database_service.get_incomplete_observation_dates(
+        _FIRST_DAY, _FIRST_DAY + timedelta(days=4), max_download_attempts, "TEST1")]
+
+
+def test_missing_and_partial_days_are_planned_in_upsert_mode(create_database_service):
+
+    _database_service = create_database_service()
+    _save_day(_database_service, date(2024, 3, 2))
+    _save_day(_database_service, date(2024, 3, 3), hours=10)
+
+    assert _incomplete_dates(_database_service) == [1, 3, 4, 5]
+
+
+def test_partial_days_are_left_alone_in_bulk_mode(create_database_service):
+
+    _database_service = create_database_service(write_mode="bulk")
+    _save_day(_database_service, date(2024, 3, 2))
+    _save_day(_database_service, date(2024, 3, 3), hours=10)
+
+    assert _incomplete_dates(_database_service) == [1, 4, 5]
+
+
+def test_days_are_given_up_on_after_max_download_attempts(create_database_service):
+
+    _database_service = create_database_service()
+    _save_day(_database_service, date(2024, 3, 3), hours=10)
+
+    for _ in range(3):
+        _database_service.record_download_attempt(date(2024, 3, 3), 10, "TEST1")
+    _database_service.record_download_attempt(date(2024, 3, 4), 0, "TEST1")
+
+    assert _incomplete_dates(_database_service) == [1, 2, 4, 5]
+    assert _incomplete_dates(_database_service, max_download_attempts=4) == [1, 2, 3, 4, 5]
+
+
+def test_days_planned_run_from_after_the_initial_date_to_two_days_ago(create_main_routine):
+
+    _main_routine, _ = create_main_routine(_TODAY, {"TEST1": "2024-03-01"})
+
+    _dates_required = _main_routine._get_dates_required("TEST1", "2024-03-01")
+
+    assert _dates_required[0] == date(2024, 3, 2)
+    assert _dates_required[-1] == date(2024, 3, 13)
+
+
+def test_api_calls_left_are_shared_fairly_between_stations(create_main_routine):
+
+    _main_routine, _ = create_main_routine(_TODAY, {"ONE": "2024-03-01", "TWO": "2024-03-01"})
+    _main_routine._wu_service.get_remaining_api_calls = lambda: 8
+    _dates = [_FIRST_DAY + timedelta(days=day) for day in range(10)]
+
+    _planned = _main_routine._apply_api_throttling_limit({"ONE": _dates[:2], "TWO": _dates})
+
+    # ONE's unused share passes to TWO
+    assert _planned == {"ONE": _dates[:2], "TWO": _dates[:6]}
+
+    _main_routine._api_throttling_limit = "3"
+
+    assert _main_routine._apply_api_throttling_limit({"ONE": _dates[:2], "TWO": _dates}) == \
+        {"ONE": _dates[:2], "TWO": _dates[:3]}
+
+
+def test_run_completes_partial_days(create_main_routine):
+
+    _main_routine, _database_service = create_main_routine(_TODAY, {"TEST1": "2024-03-10"})
+    _save_day(_database_service, date(2024, 3, 12), hours=10)
+
+    _main_routine.download_recent_observations()
+
+    with _database_service.engine.connect() as connection:
+        assert connection.execute(select(func.count()).select_from(Observation)).scalar() == 3 * 24
+
+
+def test_attempts_and_quarantines_are_recorded_on_the_provided_day(create_database_service):
+
+    _database_service = create_database_service(date_time_provider=FixedDateTimeProvider(_TODAY))
+    _database_service.record_download_attempt(date(2024, 3, 3), 10, "TEST1")
+    _day = create_synthetic_day("TEST1", datetime(2024, 3, 4))
+    _day["observations"][5]["humidityHigh"] = 120
+    _database_service.save_list_of_observations([_day], "TEST1")
+
+    with _database_service.engine.connect() as connection:
+        assert {last_attempt.date() for last_attempt in
+                connection.execute(select(DownloadAttempt.LastAttempt)).scalars()} == {_TODAY}
+        assert connection.execute(select(QuarantinedObservation.QuarantinedAt)).scalar().date() == _TODAY
+
+
+def test_todays_observations_are_checked_on_the_provided_day(create_main_routine):
+
+    _main_routine, _ = create_main_routine(_TODAY, {"TEST1": "2024-03-01"})
+    _dates_checked = []
+    _get_hourly_observations_for_date = _main_routine._wu_service.get_hourly_observations_for_date
+
+    def _record_date(date_required, station_id=None):
+        _dates_checked.append(date_required)
+        return _get_hourly_observations_for_date(date_required, station_id)
+
+    _main_routine._wu_service.get_hourly_observations_for_date = _record_date
+    _main_routine._wu_service.start_wu_api_session()
+
+    _main_routine._not_currently_gathering_data_warner("TEST1")
+
+    _main_routine._wu_service.stop_wu_api_session()
+    assert _dates_checked == [_TODAY]
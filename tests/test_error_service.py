@@ -0,0 +1,110 @@
+import threading
+import time
+import pytest
+from WMErrorService import WMErrorService
+
+
+# Creates an error service whose e-mails are recorded rather than sent
+def _create_error_service(**options) -> tuple[WMErrorService, list]:
+
+    _error_service = WMErrorService("127.0.0.1", 1, "", "", "a@b", "Test", "a@b", "Test",
+                                    **({"coalesce_seconds": 0.1} | options))
+    _emails = []
+    _error_service._deliver_email = _emails.append
+    return _error_service, _emails
+
+
+def test_alerts_close_together_are_sent_in_one_email():
+
+    _error_service, _emails = _create_error_service()
+
+    for message in ("Disk full", "Outage", "Disk full", "Disk full"):
+        _error_service.handle_error(message, send_email=True)
+
+    _error_service.finalise_error_handling()
+
+    assert _emails == ["Disk full (repeated 3 times)\nOutage"]
+
+
+def test_alert_sent_recently_is_not_sent_again():
+
+    _error_service, _emails = _create_error_service()
+    _error_service.handle_error("Outage", send_email=True)
+    _error_service.finalise_error_handling()
+
+    _error_service.handle_error("Outage", send_email=True)
+    _error_service.handle_error("Disk full", send_email=True)
+    _error_service.finalise_error_handling()
+
+    assert _emails == ["Outage", "Disk full"]
+
+
+def test_steady_stream_of_alerts_is_sent_as_it_arrives():
+
+    _error_service, _emails = _create_error_service(max_coalesce_seconds=0.3)
+
+    for index in range(20):
+        _error_service.handle_error(f"Alert {index}", send_email=True)
+        time.sleep(0.05)
+
+    assert len(_emails) >= 2
+
+    _error_service.finalise_error_handling()
+
+    assert "\n".join(_emails).split("\n") == [f"Alert {index}" for index in range(20)]
+
+
+def test_email_holds_at_most_max_alerts():
+
+    _error_service, _emails = _create_error_service(max_alerts_per_email=2)
+
+    for index in range(5):
+        _error_service.handle_error(f"Alert {index}", send_email=True)
+
+    _error_service.finalise_error_handling()
+
+    assert _emails == ["Alert 0\nAlert 1", "Alert 2\nAlert 3", "Alert 4"]
+
+
+def test_batched_messages_from_many_threads_are_all_sent():
+
+    _error_service, _emails = _create_error_service()
+
+    def _report(worker: int):
+        for index in range(200):
+            _error_service.handle_error(f"Worker {worker} shard {index} failed", send_email=True, batch_message=True)
+
+    _workers = [threading.Thread(target=_report, args=(worker,)) for worker in range(8)]
+
+    for worker in _workers:
+        worker.start()
+    for worker in _workers:
+        worker.join()
+
+    _error_service.finalise_error_handling()
+
+    assert len(_emails) == 1
+    assert len(set(_emails[0].split("\n"))) == 8 * 200
+
+
+def test_finalising_waits_a_limited_time_for_a_slow_mail_server():
+
+    _error_service, _ = _create_error_service(flush_timeout_seconds=0.2)
+    _error_service._deliver_email = lambda message: time.sleep(2)
+    _error_service.handle_error("Outage", send_email=True)
+
+    _start = time.perf_counter()
+    _error_service.finalise_error_handling()
+
+    assert time.perf_counter() - _start < 1
+
+
+def test_terminating_sends_queued_alerts_first():
+
+    _error_service, _emails = _create_error_service()
+    _error_service.handle_error("Batched", send_email=True, batch_message=True)
+
+    with pytest.raises(SystemExit):
+        _error_service.handle_error("Fatal", "Error", send_email=True, terminate=True)
+
+    assert "\n".join(_emails).split("\n") == ["Fatal", "Batched"]
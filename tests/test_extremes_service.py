@@ -0,0 +1,107 @@
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+from sqlalchemy import select
+from WMSchema import DailySummary, Extreme
+from WuStubServer import create_synthetic_day
+
+_DAYS = [date(2024, 3, 1) + timedelta(days=day) for day in range(10)]
+
+
+# A synthetic day, with every hour's temperature high changed if one is given
+def _synthetic_day(day: date, temperature_high: float = None) -> dict:
+
+    _day = create_synthetic_day("TEST1", datetime.combine(day, datetime.min.time()))
+
+    if temperature_high is not None:
+        for hour in _day["observations"]:
+            hour["metric"]["tempHigh"] = temperature_high
+
+    return _day
+
+
+def _save_days(database_service, days, temperature_high: float = None):
+
+    database_service.save_list_of_observations([_synthetic_day(day, temperature_high) for day in days], "TEST1")
+
+
+# The places of a record, as (date, high value) in rank order
+def _places(database_service, name: str) -> list[tuple]:
+
+    with database_service.engine.connect() as connection:
+        return [(_date.date(), _high) for _date, _high in
+                connection.execute(select(Extreme.Date, Extreme.HighFloat).where(Extreme.Name == name)
+                                   .order_by(Extreme.Rank))]
+
+
+def _all_records(database_service) -> list[tuple]:
+
+    with database_service.engine.connect() as connection:
+        return connection.execute(select(Extreme.Name, Extreme.Date, Extreme.Rank, Extreme.HighFloat,
+                                         Extreme.LowFloat).order_by(Extreme.Name, Extreme.Rank)).all()
+
+
+def _hottest_days(database_service, places: int) -> list[tuple]:
+
+    with database_service.engine.connect() as connection:
+        return [(_day, float(_high)) for _day, _high in
+                connection.execute(select(DailySummary.SummaryDate, DailySummary.TemperatureHigh)
+                                   .order_by(DailySummary.TemperatureHigh.desc(), DailySummary.SummaryDate)
+                                   .limit(places))]
+
+
+def test_days_are_ranked_to_the_rank_depth(create_database_service):
+
+    _database_service = create_database_service(extremes_rank_depth=3)
+    _save_days(_database_service, _DAYS)
+
+    assert _places(_database_service, "Hottest day") == _hottest_days(_database_service, 3)
+    assert _places(_database_service, "Hottest day in March") == _hottest_days(_database_service, 3)
+    assert _places(_database_service, "Hottest day in April") == []
+
+
+def test_records_kept_up_to_date_match_a_rebuild(create_database_service):
+
+    _database_service = create_database_service(extremes_rank_depth=3)
+
+    for first_day in range(0, len(_DAYS), 3):
+        _save_days(_database_service, _DAYS[first_day:first_day + 3])
+
+    _kept_up_to_date = _all_records(_database_service)
+
+    assert _database_service.rebuild_extremes() == len(_kept_up_to_date)
+    assert _all_records(_database_service) == _kept_up_to_date
+
+
+def test_record_day_saved_again_lower_gives_up_its_place(create_database_service):
+
+    _database_service = create_database_service(extremes_rank_depth=3)
+    _save_days(_database_service, _DAYS)
+    _hottest_day = _places(_database_service, "Hottest day")[0][0]
+
+    _save_days(_database_service, [_hottest_day], temperature_high=-5.0)
+
+    assert _hottest_day not in [day for day, _ in _places(_database_service, "Hottest day")]
+    assert _places(_database_service, "Hottest day") == _hottest_days(_database_service, 3)
+
+
+def test_new_first_places_are_reported(create_database_service, error_service):
+
+    _database_service = create_database_service()
+    _save_days(_database_service, _DAYS)
+
+    _save_days(_database_service, [date(2024, 3, 11)], temperature_high=40.0)
+
+    assert "New record for TEST1: Hottest day of 40 on 2024-03-11" in error_service.with_severity("Info")
+    assert "New record for TEST1: Hottest day in March of 40 on 2024-03-11" in error_service.with_severity("Info")
+
+
+def test_only_complete_months_are_ranked(create_database_service):
+
+    _database_service = create_database_service()
+    _save_days(_database_service, [date(2024, 2, 1) + timedelta(days=day) for day in range(29)])
+    _save_days(_database_service, _DAYS)
+
+    assert [day for day, _ in _places(_database_service, "Warmest month")] == [date(2024, 2, 1)]
+    assert [day for day, _ in _places(_database_service, "Wettest February")] == [date(2024, 2, 1)]
+    assert _places(_database_service, "Wettest March") == []
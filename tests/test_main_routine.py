@@ -0,0 +1,88 @@
+from datetime import date
+from datetime import timedelta
+from sqlalchemy import func, select
+from WMSchema import DailySummary, Observation
+
+_TODAY = date(2024, 3, 15)
+
+
+def _count(database_service, model, *conditions) -> int:
+
+    with database_service.engine.connect() as connection:
+        return connection.execute(select(func.count()).select_from(model).where(*conditions)).scalar()
+
+
+def test_run_updates_summaries_once_per_station(create_main_routine):
+
+    _main_routine, _database_service = create_main_routine(_TODAY, {"ONE": "2024-03-01", "TWO": "2024-03-03"})
+    _updates = []
+    _update_summaries_and_extremes = _database_service.update_summaries_and_extremes
+
+    def _record_update(station_id, dates_written):
+        if dates_written:
+            _updates.append((station_id, sorted(dates_written)))
+        _update_summaries_and_extremes(station_id, dates_written)
+
+    _database_service.update_summaries_and_extremes = _record_update
+
+    _main_routine.download_recent_observations()
+
+    # Days from the day after the initial observation date up to two days ago
+    assert [(station_id, len(dates)) for station_id, dates in _updates] == [("ONE", 12), ("TWO", 10)]
+    assert _count(_database_service, DailySummary) == 22
+    assert _count(_database_service, Observation) == 22 * 24
+
+
+def test_daemon_summarises_polled_days_once_stopped(create_main_routine, error_service):
+
+    import threading
+
+    _main_routine, _database_service = create_main_routine(_TODAY, {"ONE": "2024-03-10"})
+    _stop_event = threading.Event()
+    _main_routine._download_latest_observations = _stop_after(_main_routine._download_latest_observations, _stop_event)
+
+    _main_routine.run_daemon(0, _stop_event)
+
+    assert _count(_database_service, DailySummary, DailySummary.SummaryDate == _TODAY) == 1
+    assert _count(_database_service, DailySummary, DailySummary.SummaryDate == _TODAY - timedelta(days=1)) == 1
+    assert "Daemon stopped" in error_service.with_severity("Info")
+
+
+def test_daemon_stops_between_outstanding_days(create_main_routine, error_service):
+
+    import threading
+
+    _main_routine, _database_service = create_main_routine(_TODAY, {"ONE": "2024-01-01", "TWO": "2024-01-01"})
+    _stop_event = threading.Event()
+    _database_service.save_list_of_observations = _stop_after(_database_service.save_list_of_observations,
+                                                              _stop_event)
+
+    _main_routine.run_daemon(0, _stop_event)
+
+    # Only the first day of the first station is saved, and today isn't polled
+    assert _count(_database_service, Observation) == 24
+    assert _count(_database_service, DailySummary) == 1
+    assert "Daemon stopped" in error_service.with_severity("Info")
+
+
+def test_run_with_nothing_to_download_exits_without_archiving(create_main_routine, error_service):
+
+    _main_routine, _database_service = create_main_routine(_TODAY, {"ONE": "2024-03-10"})
+    _main_routine.download_recent_observations()
+    _archive_calls = []
+    _database_service.archive_observations = lambda: _archive_calls.append(True)
+
+    _main_routine.download_recent_observations()
+
+    assert "Observations are already up to date" in error_service.with_severity("Info")
+    assert _archive_calls == []
+
+
+# Wraps a method so that stop_event is set once it has been called
+def _stop_after(method, stop_event):
+
+    def _call_then_stop(*arguments, **options):
+        method(*arguments, **options)
+        stop_event.set()
+
+    return _call_then_stop
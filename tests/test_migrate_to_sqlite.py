@@ -0,0 +1,67 @@
+from datetime import date
+from datetime import datetime
+from sqlalchemy import create_engine, select
+from WMBackfillService import WMBackfillService
+from WMSchema import WMBase
+from WuStubServer import create_synthetic_day
+
+
+def _all_rows(engine) -> dict:
+
+    with engine.connect() as connection:
+        return {table.name: connection.execute(select(table).order_by(*table.primary_key)).all()
+                for table in WMBase.metadata.sorted_tables}
+
+
+def _fill_database(create_database_service, error_service):
+
+    _database_service = create_database_service()
+    _day = create_synthetic_day("TEST1", datetime(2024, 3, 1))
+    _day["observations"][5]["humidityHigh"] = 120
+    _database_service.save_list_of_observations([_day, create_synthetic_day("TEST1", datetime(2024, 3, 2))],
+                                                "TEST1")
+    _database_service.record_download_attempt(date(2024, 3, 3), 10, "TEST1")
+    WMBackfillService(_database_service.engine, error_service).create_shards("TEST1", date(2024, 1, 1),
+                                                                             date(2024, 1, 10), 5)
+    return _database_service
+
+
+def test_every_table_is_copied_as_it_is(tmp_path, create_database_service, error_service, write_config,
+                                        run_program):
+
+    _database_service = _fill_database(create_database_service, error_service)
+
+    _copy = run_program("WMMigrateToSqlite.py", write_config(), str(tmp_path / "copy.db"))
+
+    assert _copy.returncode == 0, _copy.stderr
+    assert "Copied 47 rows of Observations" in _copy.stdout
+    assert _all_rows(create_engine(f"sqlite:///{tmp_path / 'copy.db'}")) == _all_rows(_database_service.engine)
+
+
+def test_existing_file_is_only_replaced_when_asked(tmp_path, create_database_service, error_service, write_config,
+                                                   run_program):
+
+    _fill_database(create_database_service, error_service)
+    (tmp_path / "copy.db").write_bytes(b"not a database")
+
+    _refused = run_program("WMMigrateToSqlite.py", write_config(), str(tmp_path / "copy.db"))
+
+    assert "already exists" in _refused.stdout
+    assert (tmp_path / "copy.db").read_bytes() == b"not a database"
+
+    _replaced = run_program("WMMigrateToSqlite.py", write_config(), str(tmp_path / "copy.db"), "--overwrite")
+
+    assert _replaced.returncode == 0, _replaced.stderr
+    assert "Copied 47 rows of Observations" in _replaced.stdout
+
+
+def test_database_is_never_copied_over_itself(tmp_path, create_database_service, error_service, write_config,
+                                              run_program):
+
+    _database_service = _fill_database(create_database_service, error_service)
+    _rows = _all_rows(_database_service.engine)
+
+    _refused = run_program("WMMigrateToSqlite.py", write_config(), str(tmp_path / "weather.db"), "--overwrite")
+
+    assert "is the database being copied" in _refused.stdout
+    assert _all_rows(_database_service.engine) == _rows
@@ -0,0 +1,93 @@
+from datetime import date
+from conftest import FixedDateTimeProvider
+from sqlalchemy import event, select, text
+from WMMigrationService import WMMigrationService
+from WMSchema import SchemaMigration
+
+
+def _applied_versions(database_service) -> list[int]:
+
+    with database_service.engine.connect() as connection:
+        return list(connection.execute(select(SchemaMigration.Version).order_by(SchemaMigration.Version)).scalars())
+
+
+def test_migrations_are_applied_once(create_database_service):
+
+    _database_service = create_database_service()
+
+    _report = _database_service.migrate_schema()
+
+    assert _report[0].startswith("Applied migration 1:")
+    assert _applied_versions(_database_service) == list(range(1, len(_report) + 1))
+    assert _database_service.migrate_schema() == []
+
+
+def test_schema_up_to_date_is_checked_with_one_query(create_database_service):
+
+    _database_service = create_database_service()
+    _database_service.migrate_schema()
+    _statements = []
+
+    @event.listens_for(_database_service.engine, "before_cursor_execute")
+    def _record_statement(connection, cursor, statement, parameters, context, executemany):
+        _statements.append(statement)
+
+    _database_service.migrate_schema()
+
+    assert len(_statements) == 1
+    assert "SchemaMigrations" in _statements[0]
+
+
+def test_missing_migrations_table_is_created(create_database_service):
+
+    _database_service = create_database_service()
+
+    with _database_service.engine.connect() as connection:
+        connection.execute(text("DROP TABLE SchemaMigrations"))
+        connection.commit()
+
+    assert _database_service.migrate_schema()
+    assert _applied_versions(_database_service)
+
+
+# Answers the catalogue queries of the partitioning migration as a MariaDB database would
+class _CatalogueConnection:
+
+    def __init__(self, primary_key: list, partition_count: int):
+        self._answers = {"KEY_COLUMN_USAGE": primary_key, "PARTITIONS": partition_count}
+
+    def execute(self, statement):
+        return _CatalogueResult(next(answer for table, answer in self._answers.items() if table in str(statement)))
+
+
+class _CatalogueResult:
+
+    def __init__(self, answer):
+        self._answer = answer
+
+    def scalar(self):
+        return self._answer
+
+    def scalars(self):
+        return self
+
+    def all(self):
+        return self._answer
+
+
+def test_observations_are_partitioned_from_the_first_partition_year_to_next_year(error_service):
+
+    _migration_service = WMMigrationService(None, error_service,
+                                            date_time_provider=FixedDateTimeProvider(date(2026, 5, 1)))
+
+    _statements = _migration_service._partition_observations_by_year(_CatalogueConnection(["ObservationId"], 0))
+
+    assert _statements[0].endswith("ADD PRIMARY KEY (ObservationId, ObservationTime)")
+    assert "PARTITION pHistory VALUES LESS THAN (2000), PARTITION p2000 VALUES LESS THAN (2001)" in _statements[1]
+    assert "PARTITION p2027 VALUES LESS THAN (2028), PARTITION pFuture VALUES LESS THAN MAXVALUE" in _statements[1]
+
+    # Changes made by an earlier attempt that failed part way aren't made again
+    assert len(_migration_service._partition_observations_by_year(
+        _CatalogueConnection(["ObservationId", "ObservationTime"], 0))) == 1
+    assert _migration_service._partition_observations_by_year(
+        _CatalogueConnection(["ObservationId", "ObservationTime"], 30)) == []
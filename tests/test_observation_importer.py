@@ -0,0 +1,130 @@
+import csv
+from datetime import datetime
+from datetime import timedelta
+from sqlalchemy import func, select
+from WMObservationImporter import WMObservationImporter
+from WMSchema import DailySummary, Observation, QuarantinedObservation
+from WuStubServer import create_synthetic_day
+
+
+def _count(database_service, model) -> int:
+
+    with database_service.engine.connect() as connection:
+        return connection.execute(select(func.count()).select_from(model)).scalar()
+
+
+# Writes a WeeWX archive export of readings every five minutes in US units over a number of days. The first rows
+# can be given a unit system that isn't known or a humidity that's impossible.
+def _write_weewx_file(file_name, start: datetime, days: int, unknown_unit_rows: int = 0, bad_humidity_rows: int = 0):
+
+    with open(file_name, "w", newline="") as weewx_file:
+        _writer = csv.writer(weewx_file)
+        _writer.writerow(["dateTime", "usUnits", "outTemp", "outHumidity", "windSpeed", "windGust", "windDir",
+                          "barometer", "rain", "radiation", "UV"])
+
+        for index in range(days * 24 * 12):
+            _time = start + timedelta(minutes=5 * index)
+            _units = 99 if index < unknown_unit_rows else 1
+            _humidity = -5 if index < bad_humidity_rows else 60
+            _writer.writerow([int(_time.timestamp()), _units, 50 + index % 20, _humidity, 5, 9, 180, 29.92, 0.01,
+                              200, 3])
+
+
+# Writes an Ecowitt export of readings every five minutes in metric units over a number of days, with the times of
+# the given rows garbled
+def _write_ecowitt_file(file_name, start: datetime, days: int, bad_time_rows=(), temperature: float = 12.0):
+
+    with open(file_name, "w", newline="", encoding="utf-8") as ecowitt_file:
+        _writer = csv.writer(ecowitt_file)
+        _writer.writerow(["Time", "Outdoor Temperature(℃)", "Outdoor Humidity(%)", "Wind Speed(km/h)",
+                          "Wind Gust(km/h)", "Wind Direction(°)", "Rel Pressure(hPa)", "Solar Rad(w/m2)", "UVI",
+                          "Rain Rate(mm/hr)", "Daily Rain(mm)"])
+
+        for index in range(days * 24 * 12):
+            _time = "2024-13-45 25:00" if index in bad_time_rows else \
+                f"{start + timedelta(minutes=5 * index):%Y/%m/%d %H:%M}"
+            _writer.writerow([_time, temperature, 70, 6, 11, 200, 1012.5, 150, 2, 0, 0])
+
+
+def test_weewx_import_summarises_once_at_end(tmp_path, create_database_service, error_service):
+
+    _file_name = tmp_path / "weewx.csv"
+    _write_weewx_file(_file_name, datetime(2024, 3, 1), 40)
+    _database_service = create_database_service()
+    _updates = []
+    _update_summaries_and_extremes = _database_service.update_summaries_and_extremes
+
+    def _record_update(station_id, dates_written):
+        _updates.append((station_id, len(dates_written)))
+        _update_summaries_and_extremes(station_id, dates_written)
+
+    _database_service.update_summaries_and_extremes = _record_update
+
+    _hours_saved = WMObservationImporter(_database_service, error_service).import_file(str(_file_name), "weewx",
+                                                                                       "TEST1")
+
+    assert _hours_saved == 40 * 24
+    assert _updates == [("TEST1", 40)]
+    assert _count(_database_service, Observation) == 40 * 24
+    assert _count(_database_service, DailySummary) == 40
+
+
+def test_weewx_import_skips_unknown_unit_systems(tmp_path, create_database_service, error_service):
+
+    _file_name = tmp_path / "weewx.csv"
+    _write_weewx_file(_file_name, datetime(2024, 3, 1), 1, unknown_unit_rows=12)
+    _database_service = create_database_service()
+
+    _hours_saved = WMObservationImporter(_database_service, error_service).import_file(str(_file_name), "weewx",
+                                                                                       "TEST1")
+
+    assert _hours_saved == 23
+    assert any("Skipped 12 readings" in message for message in error_service.with_severity("Warning"))
+
+
+def test_hour_with_an_impossible_humidity_is_quarantined(tmp_path, create_database_service, error_service):
+
+    _file_name = tmp_path / "weewx.csv"
+    _write_weewx_file(_file_name, datetime(2024, 3, 1), 1, bad_humidity_rows=3)
+    _database_service = create_database_service()
+
+    _hours_saved = WMObservationImporter(_database_service, error_service).import_file(str(_file_name), "weewx",
+                                                                                       "TEST1")
+
+    assert _hours_saved == 24
+    assert _count(_database_service, Observation) == 23
+    assert _count(_database_service, QuarantinedObservation) == 1
+
+
+def test_readings_with_times_that_cannot_be_read_are_skipped(tmp_path, create_database_service, error_service):
+
+    _file_name = tmp_path / "ecowitt.csv"
+    _write_ecowitt_file(_file_name, datetime(2024, 3, 1), 1, bad_time_rows=(0, 1, 100))
+    _database_service = create_database_service()
+
+    _hours_saved = WMObservationImporter(_database_service, error_service).import_file(str(_file_name), "ecowitt",
+                                                                                       "TEST1")
+
+    assert _hours_saved == 24
+    assert _count(_database_service, Observation) == 24
+    assert f"Skipped 3 readings in {_file_name} whose times couldn't be read" in \
+        error_service.with_severity("Warning")
+
+
+def test_imported_hours_replace_those_downloaded(tmp_path, create_database_service, error_service):
+
+    _file_name = tmp_path / "ecowitt.csv"
+    _write_ecowitt_file(_file_name, datetime(2024, 3, 1), 2, temperature=31.0)
+    _database_service = create_database_service()
+    _database_service.save_list_of_observations([create_synthetic_day("TEST1", datetime(2024, 3, 1))], "TEST1")
+
+    WMObservationImporter(_database_service, error_service).import_file(str(_file_name), "ecowitt", "TEST1")
+
+    with _database_service.engine.connect() as connection:
+        _first_day = connection.execute(select(Observation.ObservationTime, Observation.TemperatureHigh)
+                                        .where(Observation.ObservationTime < datetime(2024, 3, 2))
+                                        .order_by(Observation.ObservationTime)).all()
+
+    # Downloaded hours keep WU's times, while hours only imported are timed at their last reading
+    assert _first_day == [(datetime(2024, 3, 1, hour), 31.0) for hour in range(24)]
+    assert _count(_database_service, Observation) == 48
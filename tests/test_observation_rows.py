@@ -0,0 +1,77 @@
+import importlib.util
+import json
+import os
+import sys
+from conftest import REPOSITORY_DIRECTORY
+from datetime import date
+from datetime import datetime
+from RateLimiter import RateLimiter
+from sqlalchemy import select
+from WMDatabaseService import _HOURLY_FIELDS, _METRIC_FIELDS, _ROW_COLUMNS
+from WMSchema import Observation, as_datetime
+from WuStubServer import create_synthetic_day
+
+_DAY = datetime(2024, 3, 1)
+
+
+def test_parameter_tuples_match_the_rows_they_replace(create_database_service):
+
+    _database_service = create_database_service()
+
+    for hour in create_synthetic_day("TEST1", _DAY)["observations"]:
+
+        _parameters = _database_service._create_observation_parameters(hour, "TEST1")
+        _row = _database_service._create_observation_row(hour, "TEST1")
+
+        assert len(_parameters) == len(_ROW_COLUMNS)
+        assert as_datetime(_parameters[1]) == _row["ObservationTime"]
+        assert (_parameters[0], *_parameters[2:]) == (_row["StationId"], *list(_row.values())[2:])
+
+
+def test_every_field_is_saved_in_its_own_column(create_database_service):
+
+    _database_service = create_database_service()
+    _hours = create_synthetic_day("TEST1", _DAY)["observations"]
+
+    _database_service.save_list_of_observations([{"observations": _hours}], "TEST1")
+
+    with _database_service.engine.connect() as connection:
+        _rows = connection.execute(select(Observation.__table__).order_by(Observation.ObservationTime)).mappings()
+
+        for hour, row in zip(_hours, _rows, strict=True):
+            assert row["ObservationTime"] == datetime.fromisoformat(hour["obsTimeLocal"])
+            assert {column: _number(row[column]) for column in _HOURLY_FIELDS} == \
+                {column: _number(hour[field]) for column, field in _HOURLY_FIELDS.items()}
+            assert {column: _number(row[column]) for column in _METRIC_FIELDS} == \
+                {column: _number(hour["metric"][field]) for column, field in _METRIC_FIELDS.items()}
+
+
+def test_responses_are_decoded_with_the_standard_library_without_orjson(monkeypatch, stub_server):
+
+    # A separate copy of the module is loaded while orjson can't be imported, leaving the one other tests use alone
+    monkeypatch.setitem(sys.modules, "orjson", None)
+    _spec = importlib.util.spec_from_file_location("WeatherUndergroundApiServiceWithoutOrjson",
+                                                   os.path.join(REPOSITORY_DIRECTORY,
+                                                                "WeatherUndergroundApiService.py"))
+    _module = importlib.util.module_from_spec(_spec)
+    _spec.loader.exec_module(_module)
+
+    assert _module._decode_json is json.loads
+
+    _wu_service = _module.WeatherUndergroundApiService("TEST1", "key", RateLimiter(),
+                                                       api_url=f"http://127.0.0.1:{stub_server.server_address[1]}"
+                                                               f"/v2/pws/history/")
+    _wu_service.start_wu_api_session()
+
+    try:
+        _observations = _wu_service.get_hourly_observations_for_date(date(2024, 3, 1))
+    finally:
+        _wu_service.stop_wu_api_session()
+
+    assert _observations == json.loads(json.dumps(create_synthetic_day("TEST1", _DAY)))
+
+
+# Values read back may be Decimals, so they're compared as floats to the precision of the columns
+def _number(value):
+
+    return None if value is None else round(float(value), 1)
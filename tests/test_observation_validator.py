@@ -0,0 +1,55 @@
+from datetime import datetime
+from sqlalchemy import func, select
+from WMObservationValidator import WMObservationValidator
+from WMSchema import Observation, QuarantinedObservation
+from WuStubServer import create_synthetic_day
+
+_COLUMNS = ("StationId", "ObservationTime", "HumidityHigh", "HumidityMean", "TemperatureHigh", "PressureTrend")
+_TIME = datetime(2024, 3, 1, 12)
+
+
+def _validate(*rows) -> tuple[list, list]:
+
+    return WMObservationValidator(_COLUMNS).validate([("TEST1", _TIME, *row) for row in rows])
+
+
+def test_valid_rows_pass():
+
+    _valid, _invalid = _validate((100, 80.5, -12.3, None), (0, 0, 99.9, -1.5))
+
+    assert len(_valid) == 2
+    assert _invalid == []
+
+
+def test_reasons_are_given_for_each_failed_column():
+
+    _, _invalid = _validate((None, 80, 20, None), (-1, 80, 20, None), (50, 80, 100, None), (50, "--", 20, None))
+
+    assert [reason for _, reason in _invalid] == ["HumidityHigh is missing",
+                                                  "HumidityHigh of -1 is below 0",
+                                                  "TemperatureHigh of 100 is too large for the column",
+                                                  "HumidityMean of '--' isn't a number"]
+
+
+def test_humidity_above_100_percent_fails():
+
+    _valid, _invalid = _validate((101, 80, 20, None), (90, 100.5, 20, None))
+
+    assert _valid == []
+    assert [reason for _, reason in _invalid] == ["HumidityHigh of 101 is above 100",
+                                                  "HumidityMean of 100.5 is above 100"]
+
+
+def test_failed_hours_are_quarantined(create_database_service, error_service):
+
+    _database_service = create_database_service()
+    _day = create_synthetic_day("TEST1", datetime(2024, 3, 1))
+    _day["observations"][5]["humidityHigh"] = 120
+
+    _database_service.save_list_of_observations([_day], "TEST1")
+
+    with _database_service.engine.connect() as connection:
+        assert connection.execute(select(func.count()).select_from(Observation)).scalar() == 23
+        assert connection.execute(select(QuarantinedObservation.Reason)).scalars().all() == \
+            ["HumidityHigh of 120 is above 100"]
+    assert any("Quarantined 1 observations" in message for message in error_service.with_severity("Warning"))
@@ -0,0 +1,103 @@
+from datetime import datetime
+import pytest
+from RunMetrics import RunMetrics
+from sqlalchemy import event, func, select
+from WMSchema import Observation, QuarantinedObservation
+from WuStubServer import create_synthetic_day
+
+_DAY = datetime(2024, 3, 1)
+
+
+def _count(database_service) -> int:
+
+    with database_service.engine.connect() as connection:
+        return connection.execute(select(func.count()).select_from(Observation)).scalar()
+
+
+def _temperature_high(database_service, hour: int) -> float:
+
+    with database_service.engine.connect() as connection:
+        return connection.execute(select(Observation.TemperatureHigh)
+                                  .where(Observation.ObservationTime == _DAY.replace(hour=hour))).scalar()
+
+
+def test_saving_a_day_again_updates_it_in_place(create_database_service):
+
+    _database_service = create_database_service()
+    _database_service.save_list_of_observations([create_synthetic_day("TEST1", _DAY)], "TEST1")
+
+    _revised_day = create_synthetic_day("TEST1", _DAY)
+    _revised_day["observations"][3]["metric"]["tempHigh"] = 30.5
+    _database_service.save_list_of_observations([_revised_day], "TEST1")
+
+    assert _count(_database_service) == 24
+    assert _temperature_high(_database_service, 3) == 30.5
+
+
+def test_partial_day_is_completed_by_downloading_it_again(create_database_service):
+
+    _database_service = create_database_service()
+    _partial_day = create_synthetic_day("TEST1", _DAY)
+    _partial_day["observations"] = _partial_day["observations"][:10]
+    _database_service.save_list_of_observations([_partial_day], "TEST1")
+
+    _database_service.save_list_of_observations([create_synthetic_day("TEST1", _DAY)], "TEST1")
+
+    assert _count(_database_service) == 24
+
+
+def test_stations_are_kept_apart(create_database_service):
+
+    _database_service = create_database_service()
+
+    for station_id in ("ONE", "TWO"):
+        _database_service.save_list_of_observations([create_synthetic_day(station_id, _DAY)], station_id)
+
+    assert _count(_database_service) == 48
+
+
+@pytest.mark.parametrize("write_mode", ["upsert", "bulk", "orm"])
+def test_write_modes_save_the_same_rows(create_database_service, write_mode):
+
+    _database_service = create_database_service(write_mode=write_mode)
+
+    _database_service.save_list_of_observations([create_synthetic_day("TEST1", _DAY)], "TEST1")
+
+    assert _count(_database_service) == 24
+    assert _temperature_high(_database_service, 12) == \
+        create_synthetic_day("TEST1", _DAY)["observations"][12]["metric"]["tempHigh"]
+
+
+def test_bulk_writes_are_batched_by_day_up_to_the_batch_size(create_database_service):
+
+    _metrics = RunMetrics()
+    _database_service = create_database_service(write_mode="bulk", batch_size=40, metrics=_metrics)
+    _batch_sizes = []
+
+    @event.listens_for(_database_service.engine, "before_cursor_execute")
+    def _record_batch(connection, cursor, statement, parameters, context, executemany):
+        if executemany and statement.startswith('INSERT INTO "Observations"'):
+            _batch_sizes.append(len(parameters))
+
+    _database_service.save_list_of_observations([create_synthetic_day("TEST1", _DAY.replace(day=day))
+                                                 for day in (1, 2, 3)], "TEST1")
+
+    # Whole days are added to a batch until it reaches the batch size
+    assert _batch_sizes == [48, 24]
+    assert _metrics.counter("rows_written") == 72
+    assert _count(_database_service) == 72
+
+
+def test_bulk_batch_saves_valid_rows_and_quarantines_the_rest(create_database_service):
+
+    _database_service = create_database_service(write_mode="bulk")
+    _day = create_synthetic_day("TEST1", _DAY)
+    _day["observations"][5]["humidityHigh"] = 120
+
+    _database_service.save_list_of_observations([_day], "TEST1")
+
+    assert _count(_database_service) == 23
+    assert _temperature_high(_database_service, 5) is None
+
+    with _database_service.engine.connect() as connection:
+        assert connection.execute(select(func.count()).select_from(QuarantinedObservation)).scalar() == 1
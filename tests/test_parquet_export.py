@@ -0,0 +1,98 @@
+import os
+import pyarrow.dataset
+import pyarrow.parquet
+from collections import Counter
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+from sqlalchemy import delete
+from WMSchema import Observation
+from WuStubServer import create_synthetic_day
+
+# Two days either side of the end of March
+_DAYS = [date(2024, 3, 30) + timedelta(days=day) for day in range(4)]
+
+
+def _save_days(database_service, station_id: str, days):
+
+    database_service.save_list_of_observations(
+        [create_synthetic_day(station_id, datetime.combine(day, datetime.min.time())) for day in days], station_id)
+
+
+def _partitions(export_directory) -> list[str]:
+
+    return sorted(os.path.relpath(os.path.join(directory, file_name), export_directory).replace(os.sep, "/")
+                  for directory, _, file_names in os.walk(export_directory) for file_name in file_names)
+
+
+# Rows in each partition, read back as a Hive partitioned dataset
+def _rows_by_partition(export_directory) -> dict:
+
+    _table = pyarrow.dataset.dataset(str(export_directory), format="parquet", partitioning="hive").to_table()
+
+    return dict(Counter(zip(*(_table.column(name).to_pylist() for name in ("StationId", "Year", "Month")))))
+
+
+def test_full_export_is_partitioned_by_station_year_and_month(tmp_path, create_database_service):
+
+    _database_service = create_database_service(export_directory=str(tmp_path / "export"))
+    _save_days(_database_service, "TEST1", _DAYS)
+    _save_days(_database_service, "TWO", _DAYS[1:2])
+
+    assert _database_service.export_all_observations() == 3
+    assert _partitions(tmp_path / "export") == ["StationId=TEST1/Year=2024/Month=03/Observations.parquet",
+                                                "StationId=TEST1/Year=2024/Month=04/Observations.parquet",
+                                                "StationId=TWO/Year=2024/Month=03/Observations.parquet"]
+    assert _rows_by_partition(tmp_path / "export") == {("TEST1", 2024, 3): 48, ("TEST1", 2024, 4): 48,
+                                                       ("TWO", 2024, 3): 24}
+
+
+def test_partition_columns_are_left_out_of_the_files(tmp_path, create_database_service):
+
+    _database_service = create_database_service(export_directory=str(tmp_path / "export"))
+    _save_days(_database_service, "TEST1", _DAYS[:1])
+    _database_service.export_all_observations()
+
+    _table = pyarrow.parquet.read_table(
+        tmp_path / "export" / "StationId=TEST1" / "Year=2024" / "Month=03" / "Observations.parquet")
+
+    assert "StationId" not in _table.column_names
+    assert "ObservationId" not in _table.column_names
+    assert _table.column("ObservationTime").to_pylist() == \
+        [datetime.combine(_DAYS[0], datetime.min.time()) + timedelta(hours=hour) for hour in range(24)]
+
+
+def test_only_months_written_since_the_last_export_are_exported_again(tmp_path, create_database_service):
+
+    _database_service = create_database_service(export_directory=str(tmp_path / "export"))
+    _exports = []
+    _export_months = _database_service._parquet_exporter.export_months
+
+    def _record_export(months):
+        _exports.append(sorted(months))
+        return _export_months(months)
+
+    _database_service._parquet_exporter.export_months = _record_export
+    _save_days(_database_service, "TEST1", _DAYS[:2])
+    _database_service.export_observations()
+
+    _save_days(_database_service, "TEST1", _DAYS[2:])
+    _database_service.export_observations()
+    _database_service.export_observations()
+
+    assert _exports == [[("TEST1", 2024, 3)], [("TEST1", 2024, 4)]]
+    assert _rows_by_partition(tmp_path / "export") == {("TEST1", 2024, 3): 48, ("TEST1", 2024, 4): 48}
+
+
+def test_month_with_no_observations_left_has_its_partition_removed(tmp_path, create_database_service):
+
+    _database_service = create_database_service(export_directory=str(tmp_path / "export"))
+    _save_days(_database_service, "TEST1", _DAYS)
+    _database_service.export_all_observations()
+
+    with _database_service.engine.connect() as connection:
+        connection.execute(delete(Observation).where(Observation.ObservationTime >= datetime(2024, 4, 1)))
+        connection.commit()
+
+    assert _database_service._parquet_exporter.export_months([("TEST1", 2024, 3), ("TEST1", 2024, 4)]) == 1
+    assert _partitions(tmp_path / "export") == ["StationId=TEST1/Year=2024/Month=03/Observations.parquet"]
@@ -0,0 +1,74 @@
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+from RunMetrics import RunMetrics
+from WuStubServer import create_synthetic_day
+
+_FIRST_DAY = datetime(2024, 3, 1)
+_COLUMNS = ["TemperatureHigh", "PrecipitationTotal"]
+
+
+def _save_days(database_service, days: int):
+
+    database_service.save_list_of_observations([create_synthetic_day("TEST1", _FIRST_DAY + timedelta(days=day))
+                                                for day in range(days)], "TEST1")
+
+
+def test_repeated_query_is_answered_from_cache(create_database_service):
+
+    _metrics = RunMetrics()
+    _database_service = create_database_service(metrics=_metrics)
+    _save_days(_database_service, 3)
+
+    _first = list(_database_service.get_observations("TEST1", _FIRST_DAY, _FIRST_DAY + timedelta(days=3), _COLUMNS))
+    _second = list(_database_service.get_observations("TEST1", _FIRST_DAY, _FIRST_DAY + timedelta(days=3), _COLUMNS))
+
+    assert len(_first) == 3 * 24
+    assert _second == _first
+    assert _metrics.counter("query_cache_hits") == 1
+
+
+def test_saving_a_day_drops_cached_results_covering_it(create_database_service):
+
+    _metrics = RunMetrics()
+    _database_service = create_database_service(metrics=_metrics)
+    _save_days(_database_service, 3)
+    _database_service.get_observation_arrays("TEST1", _FIRST_DAY, _FIRST_DAY + timedelta(days=3), _COLUMNS)
+
+    _save_days(_database_service, 1)
+    _database_service.get_observation_arrays("TEST1", _FIRST_DAY, _FIRST_DAY + timedelta(days=3), _COLUMNS)
+
+    assert _metrics.counter("query_cache_hits") == 0
+
+
+def test_result_larger_than_cache_is_streamed_without_being_kept(create_database_service):
+
+    # Room for a day of hourly rows of two measurements, but not three days
+    _database_service = create_database_service(query_cache_bytes=512 + 24 * 8 * 3)
+    _save_days(_database_service, 3)
+    _query_service = _database_service._query_service
+    _rows_cached = []
+    _put_cached = _query_service._put_cached
+
+    def _record_put_cached(key, rows, invalidations):
+        _rows_cached.append(len(rows))
+        return _put_cached(key, rows, invalidations)
+
+    _query_service._put_cached = _record_put_cached
+
+    _rows = list(_database_service.get_observations("TEST1", _FIRST_DAY, _FIRST_DAY + timedelta(days=3), _COLUMNS))
+    list(_database_service.get_observations("TEST1", _FIRST_DAY, _FIRST_DAY + timedelta(days=1), _COLUMNS))
+
+    assert len(_rows) == 3 * 24
+    assert _rows_cached == [24]
+
+
+def test_daily_buckets(create_database_service):
+
+    _database_service = create_database_service()
+    _save_days(_database_service, 3)
+
+    _days = list(_database_service.get_observations("TEST1", _FIRST_DAY, _FIRST_DAY + timedelta(days=3), _COLUMNS,
+                                                    bucket="day"))
+
+    assert [row[0].date() for row in _days] == [date(2024, 3, 1), date(2024, 3, 2), date(2024, 3, 3)]
@@ -0,0 +1,50 @@
+import threading
+import time
+from RateLimiter import RateLimiter
+
+
+def _time_calls(rate_limiter: RateLimiter, calls: int) -> float:
+
+    _start = time.perf_counter()
+
+    for _ in range(calls):
+        rate_limiter.acquire()
+
+    return time.perf_counter() - _start
+
+
+def test_calls_are_not_limited_without_limits():
+
+    assert _time_calls(RateLimiter(), 1000) < 0.5
+
+
+def test_burst_up_to_the_limit_then_calls_are_paced():
+
+    _rate_limiter = RateLimiter(requests_per_second=20)
+
+    assert _time_calls(_rate_limiter, 20) < 0.05
+    assert 0.45 <= _time_calls(_rate_limiter, 10) < 0.75
+
+
+def test_per_minute_limit_is_applied_with_the_per_second_limit():
+
+    _rate_limiter = RateLimiter(requests_per_second=1000, requests_per_minute=120)
+
+    assert _time_calls(_rate_limiter, 120) < 0.5
+    assert 0.45 <= _time_calls(_rate_limiter, 1) < 0.75
+
+
+def test_limit_is_shared_between_threads():
+
+    _rate_limiter = RateLimiter(requests_per_second=20)
+    _rate_limiter.acquire()
+    _threads = [threading.Thread(target=_time_calls, args=(_rate_limiter, 10)) for _ in range(3)]
+    _start = time.perf_counter()
+
+    for thread in _threads:
+        thread.start()
+    for thread in _threads:
+        thread.join()
+
+    # 19 calls are left from the burst and the other 11 are made at 20 a second
+    assert 0.5 <= time.perf_counter() - _start < 0.85
@@ -0,0 +1,69 @@
+import os
+import time
+from conftest import FixedDateTimeProvider
+from datetime import date
+from WuResponseCache import WuResponseCache
+
+_DAYS = [date(2024, 3, day) for day in (1, 2, 3)]
+_DAY_SECONDS = 86400
+
+
+def _create_cache(tmp_path, **limits) -> WuResponseCache:
+
+    _cache = WuResponseCache(str(tmp_path / "cache"), FixedDateTimeProvider(date(2024, 3, 15)), **limits)
+
+    for day in _DAYS:
+        _cache.put("TEST1", day, f'{{"day": "{day}"}}'.encode("ascii") * 100)
+
+    return _cache
+
+
+# Sets when a day's blob was last read and when it was fetched, in days ago
+def _set_times(cache: WuResponseCache, day: date, accessed_days_ago: float, fetched_days_ago: float):
+
+    os.utime(cache._blob_file_name("TEST1", day),
+             (time.time() - accessed_days_ago * _DAY_SECONDS, time.time() - fetched_days_ago * _DAY_SECONDS))
+
+
+def _cached_days(cache: WuResponseCache) -> list[date]:
+
+    return [day for day in _DAYS if os.path.exists(cache._blob_file_name("TEST1", day))]
+
+
+def test_blobs_are_evicted_by_the_time_they_were_fetched_not_last_read(tmp_path):
+
+    _cache = _create_cache(tmp_path, max_age_days=5)
+    _set_times(_cache, _DAYS[0], 10, 10)
+    _set_times(_cache, _DAYS[1], 1, 1)
+
+    assert _cache.get("TEST1", _DAYS[0]) is not None
+    assert _cache.evict() == 1
+    assert _cached_days(_cache) == _DAYS[1:]
+
+
+def test_least_recently_read_blobs_are_evicted_to_fit_the_size(tmp_path):
+
+    _cache = _create_cache(tmp_path)
+    _blob_size = os.path.getsize(_cache._blob_file_name("TEST1", _DAYS[0]))
+
+    for days_ago, day in enumerate(_DAYS, 1):
+        _set_times(_cache, day, days_ago, days_ago)
+
+    _cache.get("TEST1", _DAYS[2])
+    _cache._max_size_bytes = 2 * _blob_size
+
+    assert _cache.evict() == 1
+    assert _cached_days(_cache) == [_DAYS[0], _DAYS[2]]
+
+
+def test_unsettled_days_are_not_cached_and_corrupt_blobs_are_dropped(tmp_path):
+
+    _cache = _create_cache(tmp_path)
+    _cache.put("TEST1", date(2024, 3, 14), b"{}")
+
+    with open(_cache._blob_file_name("TEST1", _DAYS[0]), "r+b") as blob_file:
+        blob_file.write(b"0")
+
+    assert _cache.get("TEST1", date(2024, 3, 14)) is None
+    assert _cache.get("TEST1", _DAYS[0]) is None
+    assert _cached_days(_cache) == _DAYS[1:]
@@ -0,0 +1,67 @@
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+from conftest import FixedDateTimeProvider
+from sqlalchemy import func, select
+from WMSchema import ArchivedObservation, Observation
+from WuStubServer import create_synthetic_day
+
+_FIRST_DAY = datetime(2024, 3, 1)
+
+
+def _count(database_service, model) -> int:
+
+    with database_service.engine.connect() as connection:
+        return connection.execute(select(func.count()).select_from(model)).scalar()
+
+
+def _create_archiving_service(create_database_service, today: date, days: int = 10):
+
+    _database_service = create_database_service(archive_after_days=10,
+                                                date_time_provider=FixedDateTimeProvider(today))
+    _database_service.save_list_of_observations([create_synthetic_day("TEST1", _FIRST_DAY + timedelta(days=day))
+                                                 for day in range(days)], "TEST1")
+    return _database_service
+
+
+def test_observations_are_archived_by_age_from_the_provided_date(create_database_service):
+
+    _database_service = _create_archiving_service(create_database_service, date(2024, 3, 15))
+
+    # Days before 5 March are more than 10 days old
+    assert _database_service.archive_observations() == 4 * 24
+    assert _count(_database_service, ArchivedObservation) == 4 * 24
+    assert _count(_database_service, Observation) == 6 * 24
+    assert _database_service.archive_observations() == 0
+
+
+def test_nothing_is_archived_while_observations_are_recent(create_database_service):
+
+    _database_service = _create_archiving_service(create_database_service, date(2024, 3, 11))
+
+    assert _database_service.archive_observations() == 0
+    assert _count(_database_service, Observation) == 10 * 24
+
+
+def test_queries_read_both_tiers(create_database_service):
+
+    _database_service = _create_archiving_service(create_database_service, date(2024, 3, 15))
+    _before = list(_database_service.get_observations("TEST1", _FIRST_DAY, _FIRST_DAY + timedelta(days=10),
+                                                      ["TemperatureHigh"]))
+
+    _database_service.archive_observations()
+    _after = list(_database_service.get_observations("TEST1", _FIRST_DAY, _FIRST_DAY + timedelta(days=10),
+                                                     ["TemperatureHigh"]))
+
+    assert len(_after) == 10 * 24
+    assert _after == _before
+
+
+def test_archived_day_saved_again_is_held_once(create_database_service):
+
+    _database_service = _create_archiving_service(create_database_service, date(2024, 3, 15))
+    _database_service.archive_observations()
+
+    _database_service.save_list_of_observations([create_synthetic_day("TEST1", _FIRST_DAY)], "TEST1")
+
+    assert _count(_database_service, Observation) + _count(_database_service, ArchivedObservation) == 10 * 24
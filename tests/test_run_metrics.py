@@ -0,0 +1,47 @@
+import threading
+from datetime import date
+from datetime import timedelta
+from RunMetrics import RunMetrics
+
+
+def test_reset_starts_a_new_run(tmp_path):
+
+    _metrics = RunMetrics(prometheus_file_name=str(tmp_path / "metrics.prom"))
+    _metrics.increment("rows_written", 24)
+    _metrics.observe("database_write", 0.5)
+
+    _metrics.reset()
+    _metrics.increment("rows_written", 3)
+    _metrics.publish()
+
+    assert _metrics.counter("rows_written") == 3
+    assert _metrics.timer("database_write") == (0, 0.0)
+    assert "wmdownloader_rows_written_total 3\n" in (tmp_path / "metrics.prom").read_text()
+    assert "database_write" not in (tmp_path / "metrics.prom").read_text()
+
+
+def test_daemon_publishes_each_days_run_on_its_own(create_main_routine):
+
+    _main_routine, _ = create_main_routine(date(2024, 3, 15), {"ONE": "2024-03-10"})
+    _stop_event = threading.Event()
+    _published = []
+    _polls = []
+
+    def _record_publish():
+        _published.append(_main_routine._metrics.counter("days_downloaded"))
+
+    # The date rolls over after the first poll and the daemon is stopped after the second
+    def _poll_then_move_on(*arguments):
+        _polls.append(arguments[0])
+        if len(_polls) == 1:
+            _main_routine._date_time_provider.today += timedelta(days=1)
+        else:
+            _stop_event.set()
+
+    _main_routine._metrics.publish = _record_publish
+    _main_routine._download_latest_observations = _poll_then_move_on
+
+    _main_routine.run_daemon(0, _stop_event)
+
+    # Three days up to two days ago on the first day, then the one day that has become two days old
+    assert _published == [3, 1]
@@ -0,0 +1,94 @@
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+import pytest
+from sqlalchemy import select
+from WMSchema import DailySummary, MonthlySummary, YearlySummary
+from WuStubServer import create_synthetic_day
+
+# Two days either side of the end of March
+_DAYS = [date(2024, 3, 30) + timedelta(days=day) for day in range(4)]
+
+
+# A synthetic day, with the temperature high at noon changed if one is given
+def _synthetic_day(day: date, noon_temperature_high: float = None) -> dict:
+
+    _day = create_synthetic_day("TEST1", datetime.combine(day, datetime.min.time()))
+
+    if noon_temperature_high is not None:
+        _day["observations"][12]["metric"]["tempHigh"] = noon_temperature_high
+
+    return _day
+
+
+def _summaries(database_service, model) -> list[dict]:
+
+    with database_service.engine.connect() as connection:
+        return [dict(row) for row in connection.execute(select(model.__table__)
+                                                         .order_by(*model.__table__.primary_key)).mappings()]
+
+
+def _save_days(create_database_service):
+
+    _database_service = create_database_service()
+    _database_service.save_list_of_observations([_synthetic_day(day) for day in _DAYS], "TEST1")
+    return _database_service
+
+
+def test_daily_summary_combines_the_hours(create_database_service):
+
+    _database_service = _save_days(create_database_service)
+    _hours = _synthetic_day(_DAYS[0])["observations"]
+    _summary = next(summary for summary in _summaries(_database_service, DailySummary)
+                    if summary["SummaryDate"] == _DAYS[0])
+
+    assert _summary["ObservationCount"] == 24
+    assert float(_summary["TemperatureHigh"]) == max(hour["metric"]["tempHigh"] for hour in _hours)
+    assert float(_summary["TemperatureLow"]) == min(hour["metric"]["tempLow"] for hour in _hours)
+    assert float(_summary["TemperatureMean"]) == \
+        pytest.approx(sum(hour["metric"]["tempAvg"] for hour in _hours) / 24, abs=0.01)
+    # Weather Underground's precipitation total accumulates through the day
+    assert float(_summary["PrecipitationTotal"]) == pytest.approx(_hours[-1]["metric"]["precipTotal"])
+
+
+def test_months_and_years_combine_their_days(create_database_service):
+
+    _database_service = _save_days(create_database_service)
+    _daily = _summaries(_database_service, DailySummary)
+    _monthly = {summary["SummaryMonth"]: summary for summary in _summaries(_database_service, MonthlySummary)}
+    _yearly = _summaries(_database_service, YearlySummary)
+
+    assert [(month, summary["DayCount"], summary["ObservationCount"]) for month, summary in _monthly.items()] == \
+        [(3, 2, 48), (4, 2, 48)]
+    assert float(_monthly[3]["PrecipitationTotal"]) == \
+        pytest.approx(sum(float(summary["PrecipitationTotal"]) for summary in _daily[:2]))
+    assert float(_monthly[4]["TemperatureHigh"]) == max(float(summary["TemperatureHigh"]) for summary in _daily[2:])
+    assert [(summary["SummaryYear"], summary["DayCount"]) for summary in _yearly] == [(2024, 4)]
+    assert float(_yearly[0]["TemperatureMean"]) == \
+        pytest.approx(sum(float(summary["TemperatureMean"]) for summary in _daily) / 4)
+
+
+def test_day_saved_again_updates_every_summary_that_includes_it(create_database_service):
+
+    _database_service = _save_days(create_database_service)
+
+    _database_service.save_list_of_observations([_synthetic_day(_DAYS[3], noon_temperature_high=35.0)], "TEST1")
+
+    assert float(_summaries(_database_service, DailySummary)[3]["TemperatureHigh"]) == 35.0
+    assert float(_summaries(_database_service, MonthlySummary)[1]["TemperatureHigh"]) == 35.0
+    assert float(_summaries(_database_service, YearlySummary)[0]["TemperatureHigh"]) == 35.0
+
+
+def test_rebuilt_summaries_match_those_kept_up_to_date(create_database_service):
+
+    _database_service = create_database_service()
+
+    for day in _DAYS:
+        _database_service.save_list_of_observations([_synthetic_day(day)], "TEST1")
+
+    _kept_up_to_date = [_summaries(_database_service, model) for model in (DailySummary, MonthlySummary,
+                                                                           YearlySummary)]
+
+    assert _database_service.rebuild_summaries() == 4
+    assert [_summaries(_database_service, model) for model in (DailySummary, MonthlySummary, YearlySummary)] == \
+        _kept_up_to_date